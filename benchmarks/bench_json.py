@@ -0,0 +1,49 @@
+"""
+Micro-benchmark de las librerías de parseo de json sobre tweets y comentarios de YouTube.
+
+Uso (desde la raíz del repo):
+    python -m benchmarks.bench_json --records 50000
+"""
+import argparse
+import time
+from etl.decoders import DECODERS
+from benchmarks.payloads import sample_tweet, sample_yt_comment, encode
+
+def bench(loads, bodies, repeat):
+    """
+    Devuelve el mejor tiempo (en segundos) de parsear todos los bodies.
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for body in bodies:
+            loads(body)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--records', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    payloads = {
+        'Tweet': [encode(sample_tweet(i)) for i in range(args.records)],
+        'YoutubeComment': [encode(sample_yt_comment(i)) for i in range(args.records)],
+    }
+
+    for source, bodies in payloads.items():
+        print(f'{source} ({args.records} registros, {sum(map(len, bodies)) / len(bodies):.0f} bytes/registro)')
+        baseline = None
+        for name, get_loads in reversed(DECODERS.items()):
+            try:
+                loads = get_loads()
+            except ImportError:
+                print(f'  {name:<8} no instalado')
+                continue
+            elapsed = bench(loads, bodies, args.repeat)
+            baseline = baseline or elapsed
+            print(f'  {name:<8} {elapsed / len(bodies) * 1e6:7.2f} µs/registro  x{baseline / elapsed:.2f}')
+
+if __name__ == '__main__':
+    main()
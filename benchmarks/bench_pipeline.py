@@ -0,0 +1,160 @@
+"""
+Benchmark de extremo a extremo de la ETL con un bucket local (etl.fakes.LocalBucket) y un cliente de
+BigQuery falso (etl.fakes.FakeBigQueryClient). Mide registros por segundo y pico de memoria de
+extract, check_unique, upload_raw_data y aggregated_tables, y de la alternativa a esta última con
+aggregation_mode 'delta' (conteos de cada lote sumados con un MERGE por tabla, aggregate_deltas).
+
+Uso (desde la raíz del repo):
+    python -m benchmarks.bench_pipeline --records 20000 --days 3 --output resultados.json
+    python -m benchmarks.bench_pipeline --records 20000 --days 3 --baseline resultados.json
+
+Con --baseline el script termina con error si algún paso es más lento o consume más memoria que
+la referencia por encima de la tolerancia (--tolerance, 20% por defecto).
+"""
+import argparse
+import json
+import sys
+import tempfile
+import time
+import tracemalloc
+from etl.aggregate import aggregated_tables, AggregateDeltas
+from etl.extract import extract
+from etl.fakes import FakeBigQueryClient
+from etl.load import check_unique, upload_raw_data
+from etl.sources import load_sources
+from etl.utils import connect_s3, load_yaml_to_dict
+from benchmarks.generate import generate_bucket
+
+def measure(name, records, func, *args, **kwargs):
+    """
+    Ejecuta una función midiendo el tiempo y el pico de memoria.
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    stats = {
+        'stage': name,
+        'records': records,
+        'seconds': elapsed,
+        'records_per_second': records / elapsed if elapsed > 0 else float('inf'),
+        'peak_mib': peak / 2 ** 20,
+    }
+    return stats, result
+
+def consume(batches):
+    """
+    Recorre los lotes de extract sin guardarlos y devuelve el número de registros.
+    """
+    return sum(len(all_data) for all_data, _, _ in batches)
+
+def run(args, root):
+    generate_bucket(root, args.records, args.start_date, args.days, [args.source])
+    bucket = connect_s3(f'file://{root}')
+    bucket.meta.client.latency = args.latency_ms / 1000
+    dataset_id, table_id, project_id = args.source.lower(), 'raw', 'bench'
+    extract_kwargs = dict(max_workers=args.max_workers, batch_size=args.batch_size, list_workers=args.list_workers)
+
+    results = []
+    stats, total = measure('extract', args.records, consume, extract('all', args.source, bucket, **extract_kwargs))
+    results.append(stats)
+
+    # Se recogen los lotes para los siguientes pasos fuera de la medición
+    bucket.meta.client.latency = 0
+    batches = list(extract('all', args.source, bucket, **extract_kwargs))
+
+    # Cliente de BQ con una parte de los registros ya cargada, para que check_unique descarte algo
+    bq_client = FakeBigQueryClient(project_id)
+    existing = [record for all_data, _, _ in batches for record in all_data[:int(len(all_data) * args.duplicates)]]
+    bq_client.tables[f'{project_id}.{dataset_id}.{table_id}'] = list(existing)
+
+    def dedup():
+        return [check_unique(all_data, ids, bq_client, 'id', dates, project_id, dataset_id, table_id)
+                for all_data, ids, dates in batches]
+    stats, to_upload = measure('check_unique', total, dedup)
+    results.append(stats)
+
+    def upload():
+        for data in to_upload:
+            if data:
+                upload_raw_data(data, project_id, dataset_id, table_id, bq_client, args.load_format)
+    stats, _ = measure('upload_raw_data', sum(map(len, to_upload)), upload)
+    results.append(stats)
+
+    dates = sorted({date for _, _, batch_dates in batches for date in batch_dates})
+    stats, _ = measure('aggregated_tables', total, aggregated_tables, project_id, dataset_id, table_id, bq_client, dates)
+    results.append(stats)
+
+    deltas = AggregateDeltas(project_id, dataset_id)
+    def apply_deltas():
+        for data in to_upload:
+            if data:
+                deltas.apply(data, bq_client)
+    stats, _ = measure('aggregate_deltas', sum(map(len, to_upload)), apply_deltas)
+    results.append(stats)
+    return results
+
+def compare(results, baseline, tolerance):
+    """
+    Compara con una ejecución de referencia y devuelve la lista de regresiones.
+    """
+    reference = {stats['stage']: stats for stats in baseline}
+    regressions = []
+    for stats in results:
+        ref = reference.get(stats['stage'])
+        if ref is None:
+            continue
+        # Los pasos que tardan muy poco tienen demasiado ruido para compararlos
+        slow_enough = ref['seconds'] >= 0.05
+        if slow_enough and stats['records_per_second'] < ref['records_per_second'] * (1 - tolerance):
+            regressions.append(f"{stats['stage']}: {stats['records_per_second']:.0f} rec/s frente a {ref['records_per_second']:.0f}")
+        if stats['peak_mib'] > ref['peak_mib'] * (1 + tolerance) + 1:
+            regressions.append(f"{stats['stage']}: {stats['peak_mib']:.1f} MiB frente a {ref['peak_mib']:.1f}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--source', default='Tweet', choices=['Tweet', 'YoutubeComment'])
+    parser.add_argument('--records', type=int, default=20000)
+    parser.add_argument('--days', type=int, default=3)
+    parser.add_argument('--start-date', default='2024/08/01')
+    parser.add_argument('--duplicates', type=float, default=0.1, help='fracción de registros que ya existen en BQ')
+    parser.add_argument('--max-workers', type=int, default=16)
+    parser.add_argument('--batch-size', type=int, default=5000)
+    parser.add_argument('--list-workers', type=int, default=1, help='listados simultáneos del bucket')
+    parser.add_argument('--latency-ms', type=float, default=0, help='latencia simulada por petición a s3')
+    parser.add_argument('--load-format', default='json', choices=['json', 'parquet'])
+    parser.add_argument('--root', help='carpeta donde generar el bucket (por defecto, una temporal)')
+    parser.add_argument('--output', help='guarda los resultados en un json')
+    parser.add_argument('--baseline', help='json de una ejecución anterior con el que comparar')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+    load_sources(load_yaml_to_dict('config.yaml'))
+
+    if args.root:
+        results = run(args, args.root)
+    else:
+        with tempfile.TemporaryDirectory() as root:
+            results = run(args, root)
+
+    print(f"\n{'paso':<18} {'registros':>10} {'segundos':>9} {'rec/s':>10} {'pico MiB':>9}")
+    for stats in results:
+        print(f"{stats['stage']:<18} {stats['records']:>10} {stats['seconds']:>9.3f} "
+              f"{stats['records_per_second']:>10.0f} {stats['peak_mib']:>9.1f}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f'Regresión en {regression}')
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""
+Benchmark del arranque en frío de la Cloud Function. En procesos nuevos (como una instancia nueva)
+mide el tiempo de importar cloud_function/main.py y la latencia de la primera petición frente a las
+siguientes, que reutilizan la configuración, las conexiones y el índice de ids ya creados.
+
+Se usa un bucket local generado (etl.fakes.LocalBucket) y un cliente de BigQuery falso
+(etl.fakes.FakeBigQueryClient), así que la diferencia entre la primera petición y las siguientes
+es sobre todo la importación de las librerías pesadas y la creación de los recursos.
+
+Uso (desde la raíz del repo):
+    python -m benchmarks.bench_startup --runs 5 --requests 3
+    python -m benchmarks.bench_startup --runs 5 --output resultados.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import yaml
+from benchmarks.generate import generate_bucket
+
+CLOUD_FUNCTION = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cloud_function')
+
+# Script que se ejecuta en cada proceso nuevo. El cliente de BQ falso se importa dentro de
+# bq_connect para que su importación cuente en la primera petición, como la del cliente real
+CHILD = '''
+import json, sys, time
+start = time.perf_counter()
+import main
+import_seconds = time.perf_counter() - start
+
+import etl.utils
+def bq_connect(credentials, pool_size=None):
+    from etl.fakes import FakeBigQueryClient
+    return FakeBigQueryClient()
+etl.utils.bq_connect = bq_connect
+
+class Request:
+    def get_json(self, silent=False):
+        return {}
+
+requests = []
+for _ in range(int(sys.argv[2])):
+    start = time.perf_counter()
+    main.main(Request())
+    requests.append(time.perf_counter() - start)
+
+with open(sys.argv[1], 'w') as f:
+    json.dump({'import_seconds': import_seconds, 'requests': requests}, f)
+'''
+
+# Importación directa de las librerías pesadas, como referencia de lo que se ahorra al arrancar
+EAGER = '''
+import json, sys, time
+start = time.perf_counter()
+import boto3, pyarrow, requests
+from google.cloud import bigquery
+with open(sys.argv[1], 'w') as f:
+    json.dump({'import_seconds': time.perf_counter() - start}, f)
+'''
+
+def write_config(workdir, bucket_root, date):
+    """
+    Copia el config.yaml de la Cloud Function apuntando al bucket local, sin registro de estado y con
+    el índice de ids y los puntos de avance en la carpeta temporal.
+    Las rutas de los esquemas se hacen absolutas, ya que el proceso se lanza en otra carpeta.
+    """
+    with open(os.path.join(CLOUD_FUNCTION, 'config.yaml')) as f:
+        yaml_vars = yaml.safe_load(f)
+    yaml_vars['env-vars']['date_to_upload'] = date
+    yaml_vars['bucket']['bucket_name'] = f'file://{bucket_root}'
+    yaml_vars['state']['backend'] = 'none'
+    yaml_vars['id_index']['path'] = os.path.join(workdir, 'etl_ids.db')
+    yaml_vars['checkpoint']['path'] = os.path.join(workdir, 'etl_checkpoints')
+    for source in yaml_vars['sources'].values():
+        source['schema'] = os.path.join(CLOUD_FUNCTION, source['schema'])
+    with open(os.path.join(workdir, 'config.yaml'), 'w') as f:
+        yaml.safe_dump(yaml_vars, f, allow_unicode=True)
+
+def run_child(script, workdir, *args):
+    """
+    Ejecuta un script en un proceso nuevo, con la carpeta de la Cloud Function en el path,
+    y devuelve lo que ha escrito en su fichero de resultados.
+    """
+    output = os.path.join(workdir, 'result.json')
+    env = dict(os.environ, PYTHONPATH=CLOUD_FUNCTION)
+    subprocess.run([sys.executable, '-c', script, output, *map(str, args)], cwd=workdir, env=env,
+                   check=True, stdout=subprocess.DEVNULL)
+    with open(output) as f:
+        return json.load(f)
+
+def run(args, workdir):
+    bucket_root = os.path.join(workdir, 'bucket')
+    generate_bucket(bucket_root, args.records, args.date, 1, ['Tweet', 'YoutubeComment'])
+    write_config(workdir, bucket_root, args.date)
+
+    runs = [run_child(CHILD, workdir, args.requests) for _ in range(args.runs)]
+    eager = [run_child(EAGER, workdir)['import_seconds'] for _ in range(args.runs)]
+    return {
+        'import_seconds': statistics.median(r['import_seconds'] for r in runs),
+        'first_request_seconds': statistics.median(r['requests'][0] for r in runs),
+        'warm_request_seconds': statistics.median(s for r in runs for s in r['requests'][1:]) if args.requests > 1 else None,
+        'heavy_imports_seconds': statistics.median(eager),
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5, help='procesos nuevos que se lanzan (se toma la mediana)')
+    parser.add_argument('--requests', type=int, default=3, help='peticiones por proceso')
+    parser.add_argument('--records', type=int, default=200, help='registros por fuente en el bucket local')
+    parser.add_argument('--date', default='2024/08/01')
+    parser.add_argument('--output', help='guarda los resultados en un json')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        results = run(args, workdir)
+
+    print(f"\n{'medida':<24} {'segundos':>9}")
+    for name, seconds in results.items():
+        if seconds is not None:
+            print(f'{name:<24} {seconds:>9.3f}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
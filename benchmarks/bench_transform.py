@@ -0,0 +1,71 @@
+"""
+Micro-benchmark de la limpieza de los registros antes de cargarlos en parquet: limpieza registro a
+registro (etl.sources.Source.clean_records) frente a limpieza por lotes en Arrow (etl.columnar.clean_table).
+En los dos casos se incluye la conversión a Arrow, que la carga en parquet hace igualmente.
+Comprueba además que las dos limpiezas dan el mismo resultado.
+
+Uso (desde la raíz del repo):
+    python -m benchmarks.bench_transform --records 50000
+"""
+import argparse
+import copy
+import time
+from etl.columnar import clean_table, records_to_arrow
+from etl.sources import get_source, load_sources
+from etl.utils import load_yaml_to_dict
+from benchmarks.payloads import sample_tweet, sample_yt_comment
+
+def python_engine(data, source):
+    return records_to_arrow(source.clean_records(data), source.schema)
+
+def arrow_engine(data, source):
+    return clean_table(records_to_arrow(data, source.schema), source.strip_brackets)
+
+ENGINES = {
+    'python': python_engine,
+    'arrow': arrow_engine,
+}
+
+def bench(engine, records, source, repeat):
+    """
+    Devuelve el mejor tiempo (en segundos) y la tabla resultante. Cada repetición trabaja sobre una
+    copia de los registros, ya que la limpieza registro a registro los modifica.
+    """
+    best, table = float('inf'), None
+    for _ in range(repeat):
+        data = copy.deepcopy(records)
+        start = time.perf_counter()
+        table = engine(data, source)
+        best = min(best, time.perf_counter() - start)
+    return best, table
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--records', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    load_sources(load_yaml_to_dict('config.yaml'))
+
+    # A la mitad de los tweets les faltan las columnas que rellena la limpieza
+    tweets = [sample_tweet(i) for i in range(args.records)]
+    for record in tweets[::2]:
+        record.pop('media', None)
+        record.pop('parentId', None)
+    records = {
+        'tweet': tweets,
+        'youtubecomment': [sample_yt_comment(i) for i in range(args.records)],
+    }
+
+    for dataset_id, data in records.items():
+        source = get_source(dataset_id)
+        print(f'{dataset_id} ({args.records} registros)')
+        baseline, reference = None, None
+        for name, engine in ENGINES.items():
+            elapsed, table = bench(engine, data, source, args.repeat)
+            baseline = baseline or elapsed
+            reference = reference or table
+            same = 'ok' if table.equals(reference) else 'DISTINTO'
+            print(f'  {name:<8} {elapsed / len(data) * 1e6:7.2f} µs/registro  x{baseline / elapsed:.2f}  {same}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""
+Generador de datos sintéticos de Tweet y YoutubeComment con la estructura del bucket
+(<Fuente>/YYYY/MM/DD/<id>.json).
+
+Uso (desde la raíz del repo):
+    python -m benchmarks.generate /tmp/bucket --records 10000 --days 7
+"""
+import argparse
+import random
+from datetime import datetime, timedelta
+from etl.fakes import LocalBucket
+from benchmarks.payloads import sample_tweet, sample_yt_comment, encode
+
+GENERATORS = {
+    'Tweet': sample_tweet,
+    'YoutubeComment': sample_yt_comment,
+}
+
+def generate_objects(source, records, start_date='2024/08/01', days=1, seed=0):
+    """
+    Genera (key, body) de objetos sintéticos repartidos entre varios días.
+
+    Parámetros:
+    - source: str fuente ('Tweet' o 'YoutubeComment')
+    - records: int número de registros
+    - start_date: str primer día, en formato YYYY/MM/DD
+    - days: int número de días entre los que se reparten los registros
+    - seed: int semilla, para que los datos sean reproducibles
+    """
+    rnd = random.Random(seed)
+    start = datetime.strptime(start_date, '%Y/%m/%d')
+    for i in range(records):
+        day = start + timedelta(days=rnd.randrange(days), seconds=rnd.randrange(86400))
+        record = GENERATORS[source](i, date=day.strftime('%Y-%m-%dT%H:%M:%S.000Z'))
+        yield f'{source}/{day:%Y/%m/%d}/{record["id"]}.json', encode(record)
+
+def generate_bucket(root, records, start_date='2024/08/01', days=1, sources=None):
+    """
+    Escribe en una carpeta local un bucket con datos sintéticos de cada fuente.
+
+    Parámetros:
+    - root: str carpeta local que hace de bucket
+    - records: int número de registros por fuente
+    - start_date: str primer día, en formato YYYY/MM/DD
+    - days: int número de días
+    - sources: list opcional, fuentes a generar (por defecto todas)
+    """
+    bucket = LocalBucket(root)
+    for source in sources or GENERATORS:
+        for key, body in generate_objects(source, records, start_date, days):
+            bucket.put_object(key, body)
+    return bucket
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('root')
+    parser.add_argument('--records', type=int, default=10000)
+    parser.add_argument('--start-date', default='2024/08/01')
+    parser.add_argument('--days', type=int, default=1)
+    args = parser.parse_args()
+    generate_bucket(args.root, args.records, args.start_date, args.days)
+
+if __name__ == '__main__':
+    main()
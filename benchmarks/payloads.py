@@ -0,0 +1,62 @@
+import json
+
+def sample_tweet(i, date='2024-08-08T10:15:00.000Z'):
+    """
+    Genera un tweet con la misma estructura que los del bucket.
+
+    Parámetros:
+    - i: int se usa para generar ids únicos
+    - date: str fecha del registro
+    """
+    return {
+        'id': f'tweet-{i}',
+        'sentiment': ['positive', 'negative', 'neutral'][i % 3],
+        'categories': [
+            {'id': f'cat-{i % 7}', 'name': f'[Categoría {i % 7}]'},
+            {'id': f'cat-{i % 11}', 'name': f'Categoría {i % 11}'},
+        ],
+        'feed': {'id': 'feed-1', 'name': 'Twitter'},
+        'date': date,
+        'msgId': f'msg-{i}',
+        'type': 'tweet',
+        'media': None if i % 2 else 'https://pbs.twimg.com/media/ejemplo.jpg',
+        'text': 'Texto de ejemplo de un tweet con algo de longitud para que el parseo sea realista #etl',
+        'user': {
+            'id': f'user-{i % 1000}',
+            'username': f'usuario{i % 1000}',
+            'name': f'Usuario {i % 1000}',
+            'followers': 1000 + i % 5000,
+            'friends': 100 + i % 300,
+            'gender': ['male', 'female', 'unknown'][i % 3],
+            'location': {'country': ['Spain', 'France', 'Portugal'][i % 3], 'region': 'Madrid', 'subregion': 'Madrid'},
+        },
+        'link': f'https://twitter.com/usuario/status/{i}',
+        'parentId': None,
+    }
+
+def sample_yt_comment(i, date='2024-08-08T10:15:00.000Z'):
+    """
+    Genera un comentario de YouTube con la misma estructura que los del bucket.
+
+    Parámetros:
+    - i: int se usa para generar ids únicos
+    - date: str fecha del registro
+    """
+    return {
+        'id': f'comment-{i}',
+        'sentiment': ['positive', 'negative', 'neutral'][i % 3],
+        'categories': [{'id': f'cat-{i % 7}', 'name': f'[Categoría {i % 7}]'}],
+        'feed': {'id': 'feed-2', 'name': 'YouTube'},
+        'date': date,
+        'msgId': f'msg-{i}',
+        'type': 'comment',
+        'text': 'Comentario de ejemplo de un vídeo de YouTube',
+        'user': {'id': f'user-{i % 1000}', 'username': f'usuario{i % 1000}', 'gender': 'unknown'},
+        'link': f'https://www.youtube.com/watch?v={i}',
+    }
+
+def encode(record):
+    """
+    Serializa un registro tal y como se guarda en el bucket (un json por objeto).
+    """
+    return json.dumps(record).encode('utf-8')
@@ -0,0 +1,524 @@
+from etl.load import dates_to_sql
+from etl.sources import get_source
+from etl.query import run_query
+from etl.utils import print_error, utc_day
+from collections import defaultdict
+from datetime import date, timedelta
+import logging
+import re
+import threading
+import time
+import weakref
+
+# Nombre de un campo en la expresión de una tabla agregada
+FIELD = re.compile(r'^[A-Za-z_]\w*$')
+
+def get_aggregates(project_id, dataset_id):
+    """
+    Devuelve las tablas agregadas por día de cada fuente (aggregates de la fuente en el config.yaml):
+    tabla de destino, columna de la dimensión y expresión que la calcula sobre la tabla raw (alias t,
+    y category para cada categoría).
+
+    Parámetros:
+    - project_id: str proyecto de BQ
+    - dataset_id: str dataset en BQ
+    """
+    aggregates = get_source(dataset_id).aggregates
+    return [{'table': f'{project_id}.{dataset_id}.{table}', 'dimension': dimension, 'select': select}
+            for table, dimension, select in aggregates]
+
+def _dates_filter(date_list):
+    """
+    Filtro de la tabla raw por los días indicados (vacío si no hay fechas).
+    """
+    return f'WHERE TIMESTAMP_TRUNC(t.date, DAY) IN ({dates_to_sql(date_list)})' if date_list else ''
+
+def _dates_in(date_list):
+    """
+    Lista de DATE para filtrar las tablas agregadas.
+    """
+    return ', '.join(f'DATE "{date.replace("/", "-")}"' for date in date_list)
+
+def _create_if_not_exists(aggregate):
+    return f"""
+    CREATE TABLE IF NOT EXISTS `{aggregate['table']}` (date DATE, {aggregate['dimension']} STRING, count INT64)
+    PARTITION BY date
+    CLUSTER BY {aggregate['dimension']};
+    """
+
+def partition_migration_query(aggregate):
+    """
+    Script que rehace como tabla particionada por date una tabla agregada que existe sin particionar
+    (antes se creaban con CREATE OR REPLACE ... CLUSTER BY date), conservando sus filas: se copia a una
+    tabla nueva particionada, se borra la antigua y se renombra la nueva.
+    """
+    return f"""
+    CREATE OR REPLACE TABLE `{aggregate['table']}_partitioned`
+    PARTITION BY date
+    CLUSTER BY {aggregate['dimension']}
+    AS SELECT date, {aggregate['dimension']}, count FROM `{aggregate['table']}`;
+    DROP TABLE `{aggregate['table']}`;
+    ALTER TABLE `{aggregate['table']}_partitioned` RENAME TO `{aggregate['table'].split('.')[-1]}`;
+    """
+
+# Tablas agregadas ya comprobadas por migrate_partitioning, por cliente de BQ
+_checked_tables = weakref.WeakKeyDictionary()
+_checked_lock = threading.Lock()
+
+def migrate_partitioning(bq_client, aggregates, metrics=None, budget=None):
+    """
+    Migración de una sola vez de las tablas agregadas que existen sin particionar por date. BQ no
+    deja reemplazar una tabla por otra con distinto particionado ("Cannot replace a table with a
+    different partitioning spec"), así que el CREATE OR REPLACE ... PARTITION BY date fallaría: antes
+    se rehacen con partition_migration_query. Cada tabla se comprueba una sola vez por cliente.
+
+    Parámetros:
+    - bq_client: google.cloud.bigquery.client.Client
+    - aggregates: list tablas agregadas (ver get_aggregates)
+    - metrics: etl.metrics.RunMetrics opcional, cada migración se apunta en la etapa 'aggregate_migration:<tabla>'
+    - budget: etl.query.QueryBudget opcional, presupuesto de bytes de la ejecución
+    """
+    from google.api_core.exceptions import NotFound
+
+    # El lock evita que dos fuentes o días en paralelo migren la misma tabla a la vez
+    with _checked_lock:
+        checked = _checked_tables.setdefault(bq_client, set())
+        for aggregate in aggregates:
+            if aggregate['table'] in checked:
+                continue
+            try:
+                partitioning = bq_client.get_table(aggregate['table']).time_partitioning
+            except NotFound:
+                checked.add(aggregate['table'])
+                continue
+            if partitioning is None or partitioning.field != 'date':
+                msg = f'La tabla {aggregate["table"]} no está particionada por date, se rehace particionada'
+                logging.warning(msg)
+                print_error(msg)
+                stage = f'aggregate_migration:{aggregate["table"].split(".")[-1]}'
+                start = time.perf_counter()
+                query_job = run_query(bq_client, partition_migration_query(aggregate), budget, metrics, stage)
+                query_job.result()
+                if metrics:
+                    metrics.add_job(stage, query_job, time.perf_counter() - start)
+            checked.add(aggregate['table'])
+
+def _refresh_select(full_table_id_raw, aggregate, date_list=None):
+    """
+    Lectura de la tabla raw que calcula una tabla agregada. Es lo que cuesta la query de
+    refresh_query, así que es también lo que se estima con el dry run.
+    """
+    unnest = ',\n    UNNEST(t.categories) AS category' if aggregate['select'].startswith('category.') else ''
+    return f"""
+    SELECT
+    DATE(t.date) AS date,
+    {aggregate['select']} AS {aggregate['dimension']},
+    COUNT(DISTINCT t.id) AS count
+    FROM
+    `{full_table_id_raw}` t{unnest}
+    {_dates_filter(date_list)}
+    GROUP BY
+    1,
+    2
+    """
+
+def refresh_query(full_table_id_raw, aggregate, date_list=None):
+    """
+    Construye la query que actualiza una tabla agregada por día (date, dimensión, count).
+    La tabla está particionada por date. Si se indican fechas, sólo se recalculan esas particiones
+    (DELETE + INSERT en una transacción) leyendo de la tabla raw únicamente esos días; si no, se
+    reconstruye la tabla completa.
+
+    Parámetros:
+    - full_table_id_raw: str tabla raw (proyecto.dataset.tabla)
+    - aggregate: dict tabla agregada, ver get_aggregates
+    - date_list: list opcional, fechas (YYYY-MM-DD) a recalcular
+    """
+    full_table_id, dimension = aggregate['table'], aggregate['dimension']
+    select = _refresh_select(full_table_id_raw, aggregate, date_list)
+    if not date_list:
+        return f"""
+    CREATE OR REPLACE TABLE `{full_table_id}`
+    PARTITION BY date
+    CLUSTER BY {dimension}
+    AS
+    {select}
+    """
+
+    return f"""
+    {_create_if_not_exists(aggregate)}
+    BEGIN TRANSACTION;
+    DELETE FROM `{full_table_id}` WHERE date IN ({_dates_in(date_list)});
+    INSERT INTO `{full_table_id}` (date, {dimension}, count)
+    {select};
+    COMMIT TRANSACTION;
+    """
+
+def _grouping_sets_select(full_table_id_raw, aggregates, date_list=None):
+    """
+    Lectura única de la tabla raw de grouping_sets_query, con todas las dimensiones a la vez.
+    """
+    dimensions = ',\n    '.join(f"{a['select']} AS {a['dimension']},\n    GROUPING({a['select']}) AS grouping_{a['dimension']}"
+                                for a in aggregates)
+    sets = ', '.join(f"(DATE(t.date), category IS NOT NULL, {a['select']})" if a['select'].startswith('category.')
+                     else f"(DATE(t.date), {a['select']})" for a in aggregates)
+    return f"""
+    SELECT
+    DATE(t.date) AS day,
+    category IS NOT NULL AS has_category,
+    {dimensions},
+    COUNT(DISTINCT t.id) AS count
+    FROM
+    `{full_table_id_raw}` t
+    LEFT JOIN UNNEST(t.categories) AS category
+    {_dates_filter(date_list)}
+    GROUP BY GROUPING SETS ({sets})"""
+
+def grouping_sets_query(full_table_id_raw, aggregates, date_list=None):
+    """
+    Construye un único script que calcula todas las tablas agregadas de una fuente con una sola
+    lectura de la tabla raw (GROUP BY GROUPING SETS) y reparte el resultado en cada tabla.
+
+    Las categorías se desanidan con LEFT JOIN para no perder los registros sin categorías en el
+    resto de dimensiones; en la dimensión de categorías se descartan esos registros, como en el
+    JOIN de refresh_query.
+
+    Parámetros:
+    - full_table_id_raw: str tabla raw (proyecto.dataset.tabla)
+    - aggregates: list de tablas agregadas, ver get_aggregates
+    - date_list: list opcional, fechas (YYYY-MM-DD) a recalcular
+    """
+    script = f"""
+    CREATE TEMP TABLE daily_counts AS{_grouping_sets_select(full_table_id_raw, aggregates, date_list)};
+    """
+
+    inserts = []
+    for a in aggregates:
+        condition = f"grouping_{a['dimension']} = 0"
+        if a['select'].startswith('category.'):
+            condition += ' AND has_category'
+        select = f"SELECT day AS date, {a['dimension']}, count FROM daily_counts WHERE {condition}"
+        if date_list:
+            script += _create_if_not_exists(a)
+            inserts.append(f"""
+    DELETE FROM `{a['table']}` WHERE date IN ({_dates_in(date_list)});
+    INSERT INTO `{a['table']}` (date, {a['dimension']}, count)
+    {select};""")
+        else:
+            inserts.append(f"""
+    CREATE OR REPLACE TABLE `{a['table']}`
+    PARTITION BY date
+    CLUSTER BY {a['dimension']}
+    AS {select};""")
+
+    if date_list:
+        return script + '\n    BEGIN TRANSACTION;' + ''.join(inserts) + '\n    COMMIT TRANSACTION;\n    '
+    return script + ''.join(inserts) + '\n    '
+
+def run_queries(bq_client, queries, metrics=None, budget=None):
+    """
+    Lanza a la vez varios jobs independientes y espera a que terminen todos.
+    Un error en uno de ellos (o que no quepa en el presupuesto de bytes) no impide que terminen los demás.
+
+    Parámetros:
+    - bq_client: google.cloud.bigquery.client.Client
+    - queries: dict {tuple con las tablas que actualiza: (query, lectura de la raw que se estima, variante acotada o None)}
+    - metrics: etl.metrics.RunMetrics opcional, cada job se apunta en la etapa 'aggregate:<tablas>'
+              con el tiempo desde que se lanzan las queries hasta que termina
+    - budget: etl.query.QueryBudget opcional, presupuesto de bytes de la ejecución (ver etl.query.run_query)
+    """
+    start = time.perf_counter()
+    jobs = {}
+    for tables, (query, estimate, fallback) in queries.items():
+        stage = f'aggregate:{",".join(table.split(".")[-1] for table in tables)}'
+        try:
+            jobs[tables] = run_query(bq_client, query, budget, metrics, stage, estimate, fallback)
+        except Exception as e:
+            logging.error(e)
+            print_error(e)
+
+    for tables, query_job in jobs.items():
+        try:
+            query_job.result()
+            if metrics:
+                metrics.add_job(f'aggregate:{",".join(table.split(".")[-1] for table in tables)}', query_job, time.perf_counter() - start)
+
+            for table in tables:
+                msg = f'Tabla {table} actualizada'
+                logging.info(msg)
+                print(msg)
+        except Exception as e:
+            logging.error(e)
+            print_error(e)
+
+def recent_days(n_days):
+    """
+    Devuelve los últimos n_days días (YYYY-MM-DD), hasta hoy incluido.
+    """
+    today = date.today()
+    return [(today - timedelta(days=i)).isoformat() for i in reversed(range(n_days))]
+
+def aggregated_tables(project_id, dataset_id, table_id_raw, bq_client, date_list=None, mode='grouping_sets', metrics=None,
+                      budget=None, fallback_days=7):
+    """
+    Lanza las queries para obtener resultados agregados por día. Antes se rehacen particionadas las
+    tablas agregadas que existan sin particionar (ver migrate_partitioning).
+    
+    Parámetros:
+    - project_id: str proyecto de BQ
+    - dataset_id: str dataset en BQ
+    - table_id_raw: str tabla raw en BQ
+    - bq_client: google.cloud.bigquery.client.Client
+    - date_list: list opcional, si se indica sólo se recalculan esos días (si no, las tablas completas)
+    - mode: str 'grouping_sets' -> un único script que lee la tabla raw una vez
+                'separate' -> una query por tabla, lanzadas a la vez
+    - metrics: etl.metrics.RunMetrics opcional
+    - budget: etl.query.QueryBudget opcional, presupuesto de bytes de la ejecución
+    - fallback_days: int si la reconstrucción completa no cabe en el presupuesto, se recalculan sólo
+      las particiones de los últimos fallback_days días
+    """
+    full_table_id_raw = f'{project_id}.{dataset_id}.{table_id_raw}'
+    aggregates = get_aggregates(project_id, dataset_id)
+    if len(aggregates) == 0:
+        return
+
+    # Cada query va con la lectura de la raw que se estima y, si reconstruye la tabla entera, con la
+    # variante que sólo lee las particiones de los últimos días
+    fallback_dates = recent_days(fallback_days) if not date_list and fallback_days > 0 else None
+    def variants(build_query, build_select, target):
+        fallback = (build_query(full_table_id_raw, target, fallback_dates),
+                    build_select(full_table_id_raw, target, fallback_dates)) if fallback_dates else None
+        return build_query(full_table_id_raw, target, date_list), build_select(full_table_id_raw, target, date_list), fallback
+
+    try:
+        migrate_partitioning(bq_client, aggregates, metrics, budget)
+    except Exception as e:
+        logging.error(e)
+        print_error(e)
+        return
+
+    if mode == 'grouping_sets':
+        tables = tuple(a['table'] for a in aggregates)
+        queries = {tables: variants(grouping_sets_query, _grouping_sets_select, aggregates)}
+    else:
+        queries = {(a['table'],): variants(refresh_query, _refresh_select, a) for a in aggregates}
+
+    run_queries(bq_client, queries, metrics, budget)
+
+def _dimension_values(select, strip_brackets):
+    """
+    Devuelve una función registro -> valores de la dimensión, el equivalente en python de la expresión
+    select sobre la tabla raw, o None si la expresión no es un campo del registro (t.campo.subcampo)
+    o de sus categorías (category.campo). Los campos de las categorías se devuelven sin repetidos, como
+    cuenta COUNT(DISTINCT t.id), y sin corchetes si la fuente los quita (strip_brackets).
+    """
+    if select.startswith('category.'):
+        field = select[len('category.'):]
+        if not FIELD.match(field):
+            return None
+        strip = ('categories', field) in strip_brackets
+        def category_values(record):
+            values = {category.get(field) for category in record.get('categories') or ()}
+            return {value.strip('[]') if strip and isinstance(value, str) else value for value in values}
+        return category_values
+
+    path = select[len('t.'):].split('.') if select.startswith('t.') else []
+    if not path or not all(FIELD.match(field) for field in path):
+        return None
+    def record_value(record):
+        value = record
+        for field in path:
+            value = value.get(field) if isinstance(value, dict) else None
+        return (value,)
+    return record_value
+
+def delta_merge_query(aggregate):
+    """
+    Construye el MERGE que suma a una tabla agregada los conteos de un lote, pasados como parámetro
+    (@deltas: ARRAY<STRUCT<date DATE, value STRING, count INT64>> y @dates: ARRAY<DATE>, que acota las
+    particiones que se leen). Las filas del día y dimensión que ya existen se incrementan y el resto se insertan.
+
+    Parámetros:
+    - aggregate: dict tabla agregada, ver get_aggregates
+    """
+    dimension = aggregate['dimension']
+    return f"""
+    {_create_if_not_exists(aggregate)}
+    MERGE `{aggregate['table']}` T
+    USING (SELECT d.date, d.value AS {dimension}, d.count FROM UNNEST(@deltas) AS d) S
+    ON T.date IN UNNEST(@dates) AND T.date = S.date AND T.{dimension} IS NOT DISTINCT FROM S.{dimension}
+    WHEN MATCHED THEN UPDATE SET count = T.count + S.count
+    WHEN NOT MATCHED THEN INSERT (date, {dimension}, count) VALUES (S.date, S.{dimension}, S.count);
+    """
+
+# Locks de las tablas agregadas que se están actualizando con un MERGE de conteos: dos MERGE sobre
+# la misma tabla a la vez chocan en BQ (uno de los dos falla por la transacción concurrente)
+_table_locks = defaultdict(threading.Lock)
+_table_locks_lock = threading.Lock()
+
+def _table_lock(table):
+    with _table_locks_lock:
+        return _table_locks[table]
+
+class AggregateDeltas:
+    """
+    Mantiene las tablas agregadas de una fuente sin leer la tabla raw: de los registros que se acaban
+    de cargar se cuentan en memoria los ids distintos por día y dimensión y se suman a cada tabla con
+    un MERGE pequeño y parametrizado (ver delta_merge_query).
+
+    Sólo es correcto si los registros son nuevos en BQ, es decir, con el deduplicado 'query' o
+    'index'; con 'merge' no se sabe qué registros ha insertado el MERGE. Un id que se cuenta dos veces
+    (p.ej. lo cargan a la vez dos unidades de la misma fuente) no se puede descontar: por eso las
+    unidades de una ejecución acumulan sus ids con add y se suman una sola vez al terminar con flush.
+
+    Parámetros:
+    - project_id: str proyecto de BQ
+    - dataset_id: str dataset en BQ
+    - col_to_check: str columna con el id
+    """
+    def __init__(self, project_id, dataset_id, col_to_check='id'):
+        self.aggregates = get_aggregates(project_id, dataset_id)
+        self.col_to_check = col_to_check
+        strip_brackets = get_source(dataset_id).strip_brackets
+        self._values = [_dimension_values(a['select'], strip_brackets) for a in self.aggregates]
+        self._pending = [defaultdict(set) for _ in self.aggregates]
+        self._lock = threading.Lock()
+
+    @property
+    def supported(self):
+        """
+        Indica si todas las tablas agregadas de la fuente se pueden calcular en python.
+        """
+        return len(self.aggregates) > 0 and all(values is not None for values in self._values)
+
+    def _ids(self, data, ids):
+        """
+        Añade a ids ({(día YYYY-MM-DD, valor): set de ids} por tabla) los de un lote.
+        """
+        for record in data:
+            day = utc_day(str(record['date']))
+            for table_ids, values in zip(ids, self._values):
+                for value in values(record):
+                    table_ids[(day, None if value is None else str(value))].add(record[self.col_to_check])
+        return ids
+
+    def count(self, data):
+        """
+        Devuelve los conteos de un lote: {tabla: {(día YYYY-MM-DD, valor): ids distintos}}.
+
+        Parámetros:
+        - data: list con los jsons cargados
+        """
+        ids = self._ids(data, [defaultdict(set) for _ in self.aggregates])
+        return {a['table']: {key: len(key_ids) for key, key_ids in table_ids.items()}
+                for a, table_ids in zip(self.aggregates, ids)}
+
+    def add(self, data):
+        """
+        Acumula los ids de un lote ya cargado, para sumarlos después con flush. Se puede llamar desde
+        varios hilos a la vez.
+
+        Parámetros:
+        - data: list con los jsons cargados
+        """
+        with self._lock:
+            self._ids(data, self._pending)
+
+    def pending_dates(self):
+        """
+        Devuelve los días (YYYY-MM-DD) con conteos acumulados pendientes de sumar.
+        """
+        with self._lock:
+            return {day for table_ids in self._pending for day, _ in table_ids}
+
+    def flush(self, bq_client, metrics=None, budget=None):
+        """
+        Suma a las tablas agregadas los ids acumulados con add y los descarta. Devuelve True si se han
+        actualizado todas; si no, hay que recalcular los días que devolvía pending_dates.
+
+        Parámetros:
+        - bq_client: google.cloud.bigquery.client.Client
+        - metrics: etl.metrics.RunMetrics opcional
+        - budget: etl.query.QueryBudget opcional, presupuesto de bytes de la ejecución
+        """
+        with self._lock:
+            pending, self._pending = self._pending, [defaultdict(set) for _ in self.aggregates]
+        counts = [{key: len(key_ids) for key, key_ids in table_ids.items()} for table_ids in pending]
+        if not any(counts):
+            return True
+        return self._merge(counts, bq_client, metrics, budget)
+
+    def apply(self, data, bq_client, metrics=None, budget=None):
+        """
+        Suma los conteos de un lote ya cargado a las tablas agregadas. Devuelve True si se han
+        actualizado todas; si no, hay que recalcular esos días.
+
+        Parámetros:
+        - data: list con los jsons cargados
+        - bq_client: google.cloud.bigquery.client.Client
+        - metrics: etl.metrics.RunMetrics opcional
+        - budget: etl.query.QueryBudget opcional, presupuesto de bytes de la ejecución
+        """
+        return self._merge(list(self.count(data).values()), bq_client, metrics, budget)
+
+    def _merge(self, counts_by_table, bq_client, metrics=None, budget=None):
+        """
+        Lanza a la vez un MERGE por tabla con sus conteos. Cada tabla se bloquea mientras dura su
+        MERGE, para que no coincida con otro sobre la misma tabla desde otro hilo. Cada MERGE se
+        apunta en la etapa 'aggregate_delta:<tabla>'.
+        """
+        from google.cloud import bigquery
+
+        try:
+            migrate_partitioning(bq_client, self.aggregates, metrics, budget)
+        except Exception as e:
+            logging.error(e)
+            print_error(e)
+            return False
+
+        # Los locks se toman siempre en el mismo orden para no bloquearse entre dos llamadas
+        tables = sorted(((aggregate['table'], aggregate, counts)
+                        for aggregate, counts in zip(self.aggregates, counts_by_table) if counts), key=lambda t: t[0])
+        locks = [_table_lock(table) for table, _, _ in tables]
+        for lock in locks:
+            lock.acquire()
+        try:
+            start = time.perf_counter()
+            jobs = {}
+            ok = True
+            for table, aggregate, counts in tables:
+                deltas = [bigquery.StructQueryParameter(None,
+                                                        bigquery.ScalarQueryParameter('date', 'DATE', day),
+                                                        bigquery.ScalarQueryParameter('value', 'STRING', value),
+                                                        bigquery.ScalarQueryParameter('count', 'INT64', count))
+                          for (day, value), count in counts.items()]
+                job_config = bigquery.QueryJobConfig(query_parameters=[
+                    bigquery.ArrayQueryParameter('deltas', 'STRUCT', deltas),
+                    bigquery.ArrayQueryParameter('dates', 'DATE', sorted({day for day, _ in counts})),
+                ])
+                stage = f'aggregate_delta:{table.split(".")[-1]}'
+                try:
+                    jobs[table] = (stage, len(counts),
+                                   run_query(bq_client, delta_merge_query(aggregate), budget, metrics, stage,
+                                             job_config=job_config))
+                except Exception as e:
+                    ok = False
+                    logging.error(e)
+                    print_error(e)
+
+            for table, (stage, n_rows, query_job) in jobs.items():
+                try:
+                    query_job.result()
+                    if metrics:
+                        metrics.add_job(stage, query_job, time.perf_counter() - start, n_rows)
+                    msg = f'Tabla {table} actualizada con {n_rows} conteos'
+                    logging.info(msg)
+                    print(msg)
+                except Exception as e:
+                    ok = False
+                    logging.error(e)
+                    print_error(e)
+            return ok
+        finally:
+            for lock in reversed(locks):
+                lock.release()
@@ -0,0 +1,250 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import copy
+import logging
+import os
+import re
+from etl.listing import list_prefixes
+from etl.utils import print_error, print_success
+
+DAY = re.compile(r'^\d{4}/\d{2}/\d{2}$')
+
+def list_days(bucket, folder):
+    """
+    Devuelve los días (YYYY/MM/DD) que tienen datos en una carpeta del bucket, recorriendo sólo
+    los niveles año/mes/día de la ruta con listados por delimitador (sin listar los objetos).
+
+    Parámetros:
+    - bucket: s3 bucket
+    - folder: str carpeta del bucket
+    """
+    prefixes = [f'{folder}/']
+    for _ in range(3):  # año, mes y día
+        prefixes = [sub for prefix in prefixes for sub in list_prefixes(bucket, prefix)]
+
+    days = []
+    for prefix in prefixes:
+        day = prefix[len(folder) + 1:].rstrip('/')
+        if DAY.match(day):
+            days.append(day)
+        else:
+            msg = f'Se ignora el prefijo {prefix}, no sigue el formato {folder}/YYYY/MM/DD/'
+            logging.warning(msg)
+            print_error(msg)
+    return days
+
+def plan_backfill(bucket, folders):
+    """
+    Divide una carga completa del bucket en fragmentos independientes, uno por fuente y día.
+
+    Parámetros:
+    - bucket: s3 bucket
+    - folders: list carpetas del bucket
+    """
+    shards = [{'folder': folder, 'date': day} for folder in folders for day in list_days(bucket, folder)]
+    msg = f'Carga completa dividida en {len(shards)} fragmentos (fuente y día)'
+    logging.info(msg)
+    print(msg)
+    return shards
+
+def shard_vars(yaml_vars, shard):
+    """
+    Devuelve una copia de las variables del config.yaml restringida a un fragmento: una sola
+    fuente y un solo día.
+
+    Parámetros:
+    - yaml_vars: dict variables del config.yaml (ya comprobadas)
+    - shard: dict {'folder': str, 'date': 'YYYY/MM/DD'}
+    """
+    folder, date = shard.get('folder'), shard.get('date')
+    if folder not in yaml_vars['bucket']['folders'] or not DAY.match(str(date)):
+        raise ValueError(f'Fragmento no válido: {shard}')
+
+    shard_yaml_vars = copy.deepcopy(yaml_vars)
+    shard_yaml_vars['bucket']['folders'] = [folder]
+    shard_yaml_vars['env-vars']['date_to_upload'] = date
+    return shard_yaml_vars
+
+# Clientes, estado e índice de ids de cada proceso del pool del backfill local (ver _init_shard_worker)
+_worker = {}
+
+def _connect_clients(yaml_vars):
+    """
+    Abre las conexiones a s3 y BQ de un proceso del backfill local.
+    """
+    from etl.utils import connect_s3, bq_connect
+
+    max_workers = yaml_vars['extract']['max_workers'] + yaml_vars['extract']['list_workers']
+    bucket = connect_s3(yaml_vars['bucket']['bucket_name'], max_pool_connections=max(max_workers, 10))
+    return bucket, bq_connect(yaml_vars['env-vars']['credentials'])
+
+def _init_shard_worker(yaml_vars, connect):
+    """
+    Prepara un proceso del pool una sola vez para todos sus fragmentos: los clientes de s3 y BQ no se
+    pueden compartir entre procesos, pero sí entre los fragmentos de un mismo proceso, y así el
+    almacén de estado (create_dataset/create_table en el backend 'bigquery') y el índice de ids no se
+    vuelven a crear en cada fragmento.
+    """
+    from etl.state import get_state_store
+    from etl.id_index import get_id_index
+    from etl.sources import load_sources
+
+    # El registro de fuentes no se hereda si el proceso no se crea con fork
+    load_sources(yaml_vars)
+    bucket, bq_client = connect(yaml_vars)
+    _worker.update(bucket=bucket, bq_client=bq_client, state=get_state_store(yaml_vars, bq_client),
+                   id_index=get_id_index(yaml_vars))
+
+def _run_shard_process(shard, yaml_vars):
+    """
+    Ejecuta un fragmento en un proceso del pool, con los clientes que abrió _init_shard_worker. El
+    punto de avance, el tiempo límite y el presupuesto de bytes son de cada fragmento.
+    """
+    from etl.pipeline import run_folders
+    from etl.checkpoint import get_checkpoint, get_deadline
+    from etl.query import get_query_budget
+
+    yaml_vars = shard_vars(yaml_vars, shard)
+    # Las tablas agregadas no se recalculan en cada fragmento: los de una misma fuente chocarían en
+    # BQ al actualizar a la vez las mismas tablas. Se recalculan al terminar todos (ver run_backfill)
+    run_folders(yaml_vars['bucket']['folders'], yaml_vars, _worker['bucket'], _worker['bq_client'], _worker['state'],
+                _worker['id_index'], get_checkpoint(yaml_vars), get_deadline(yaml_vars), get_query_budget(yaml_vars),
+                refresh=False)
+
+def run_shards_local(shards, yaml_vars, processes, connect=_connect_clients):
+    """
+    Reparte los fragmentos entre un pool de procesos locales. Cada proceso abre sus conexiones una
+    sola vez al arrancar; el estado y el índice de ids en SQLite se comparten entre todos ellos.
+
+    Parámetros:
+    - shards: list fragmentos de plan_backfill
+    - yaml_vars: dict variables del config.yaml
+    - processes: int número de procesos
+    - connect: función (a nivel de módulo, se pasa a los procesos) que recibe yaml_vars y devuelve
+      (bucket, bq_client)
+    """
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_shard_worker,
+                             initargs=(yaml_vars, connect)) as executor:
+        futures = {executor.submit(_run_shard_process, shard, yaml_vars): shard for shard in shards}
+        return _wait_shards(futures)
+
+def _id_token(url, credentials):
+    """
+    Obtiene un id token para invocar la Cloud Function. Con un fichero de credenciales de cuenta
+    de servicio se genera a partir de él; si no, se pide al servidor de metadatos (dentro de GCP).
+    """
+    import google.auth.transport.requests
+    from google.oauth2 import id_token, service_account
+
+    auth_request = google.auth.transport.requests.Request()
+    if credentials and os.path.exists(credentials):
+        token_credentials = service_account.IDTokenCredentials.from_service_account_file(credentials, target_audience=url)
+        token_credentials.refresh(auth_request)
+        return token_credentials.token
+    return id_token.fetch_id_token(auth_request, url)
+
+def _invoke_shard(session, url, credentials, shard, timeout):
+    """
+    Invoca la Cloud Function con un fragmento en el cuerpo de la petición. El token se pide en cada
+    invocación porque caduca en una hora y una carga larga puede durar más.
+    """
+    token = _id_token(url, credentials)
+    response = session.post(url, json={'shard': shard}, timeout=timeout,
+                            headers={'Authorization': f'Bearer {token}'})
+    response.raise_for_status()
+
+def run_shards_remote(shards, url, concurrency, credentials=None, timeout=1000):
+    """
+    Lanza cada fragmento como una invocación http de la Cloud Function, con un máximo de invocaciones
+    simultáneas (que debería coincidir con el max_instance_count de la función).
+
+    Parámetros:
+    - shards: list fragmentos de plan_backfill
+    - url: str url de la Cloud Function
+    - concurrency: int invocaciones simultáneas
+    - credentials: str opcional, fichero de credenciales de la cuenta de servicio
+    - timeout: int segundos máximos de espera por invocación
+    """
+    import requests
+
+    with requests.Session() as session, ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(_invoke_shard, session, url, credentials, shard, timeout): shard for shard in shards}
+        return _wait_shards(futures)
+
+def _wait_shards(futures):
+    """
+    Espera a que terminen los fragmentos y devuelve la lista de los que han fallado.
+    """
+    failed = []
+    for future in as_completed(futures):
+        shard = futures[future]
+        try:
+            future.result()
+        except Exception as e:
+            failed.append(shard)
+            msg = f'Error en el fragmento {shard["folder"]} {shard["date"]}: {e}'
+            logging.error(msg)
+            print_error(msg)
+
+    msg = f'{len(futures) - len(failed)} de {len(futures)} fragmentos terminados'
+    if failed:
+        logging.error(msg)
+        print_error(msg)
+    else:
+        logging.info(msg)
+        print_success(msg)
+    return failed
+
+def refresh_backfill_aggregates(yaml_vars, folders, bq_client=None):
+    """
+    Reconstruye desde la tabla raw las tablas agregadas de las fuentes de una carga completa, una
+    sola vez por fuente cuando han terminado todos sus fragmentos (que no las actualizan).
+
+    Parámetros:
+    - yaml_vars: dict variables del config.yaml
+    - folders: list carpetas del bucket
+    - bq_client: google.cloud.bigquery.client.Client opcional, si no se indica se crea uno
+    """
+    from etl.utils import bq_connect
+    from etl.pipeline import refresh_aggregates
+    from etl.metrics import RunMetrics
+    from etl.query import get_query_budget
+
+    bq_client = bq_client or bq_connect(yaml_vars['env-vars']['credentials'])
+    budget = get_query_budget(yaml_vars)
+    for folder in folders:
+        metrics = RunMetrics(f'{folder} agregados')
+        try:
+            refresh_aggregates(folder, yaml_vars, bq_client, None, metrics, budget)
+        except Exception as e:
+            msg = f'Error al recalcular las tablas agregadas de la fuente {folder}: {e}'
+            logging.error(msg)
+            print_error(msg)
+        metrics.log_summary()
+
+def run_backfill(yaml_vars, bucket, bq_client=None):
+    """
+    Carga completa del bucket repartida en fragmentos (fuente y día) según backfill.mode:
+    'local' -> pool de procesos, 'remote' -> invocaciones en paralelo de la Cloud Function.
+    Al terminar se reconstruyen las tablas agregadas de las fuentes con algún fragmento.
+    Devuelve la lista de fragmentos que han fallado, para poder relanzarlos (si se relanzan sueltos,
+    hay que recalcular después los agregados con refresh_backfill_aggregates).
+
+    Parámetros:
+    - yaml_vars: dict variables del config.yaml
+    - bucket: s3 bucket
+    - bq_client: google.cloud.bigquery.client.Client opcional, para las tablas agregadas
+    """
+    backfill_vars = yaml_vars['backfill']
+    shards = plan_backfill(bucket, yaml_vars['bucket']['folders'])
+    if len(shards) == 0:
+        return []
+
+    if backfill_vars['mode'] == 'remote':
+        failed = run_shards_remote(shards, backfill_vars['function_url'], backfill_vars['concurrency'],
+                                   yaml_vars['env-vars']['credentials'], backfill_vars['request_timeout'])
+    else:
+        failed = run_shards_local(shards, yaml_vars, backfill_vars['processes'])
+
+    folders = [folder for folder in yaml_vars['bucket']['folders'] if any(shard['folder'] == folder for shard in shards)]
+    refresh_backfill_aggregates(yaml_vars, folders, bq_client)
+    return failed
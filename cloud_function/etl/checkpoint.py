@@ -0,0 +1,276 @@
+from datetime import datetime, timezone
+import json
+import logging
+import os
+import threading
+import time
+from etl.utils import print_error
+
+class Checkpoint:
+    """
+    Guarda el punto de avance de cada prefijo (carpeta y día) que se está listando: la última key
+    cuyos registros ya están en BQ. Si una ejecución se corta (p.ej. por el timeout de la Cloud Function),
+    la siguiente reanuda el listado justo después de esa key en lugar de empezar de cero.
+
+    Igual que el estado, las keys se marcan como pendientes (stage) durante la extracción y el punto
+    de avance sólo se mueve (commit) cuando el lote se ha cargado. Cuando el prefijo se termina de
+    recorrer se borra (finish): las ejecuciones siguientes vuelven a listarlo entero, ya que dentro
+    de un día las keys nuevas no tienen por qué ser posteriores alfabéticamente.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cursors = {}
+        self._pending = {}
+        self._failed = set()
+
+    def get(self, prefix):
+        """
+        Devuelve la última key confirmada del prefijo, o None si no hay una ejecución a medias.
+
+        Parámetros:
+        - prefix: str prefijo que se va a listar
+        """
+        with self._lock:
+            if prefix in self._cursors:
+                return self._cursors[prefix]
+        try:
+            data = self._read(prefix)
+        except Exception as e:
+            msg = f'No se ha podido leer el punto de avance de {prefix}: {e}'
+            logging.error(msg)
+            print_error(msg)
+            data = None
+        key = data['key'] if data else None
+        with self._lock:
+            self._cursors.setdefault(prefix, key)
+        return key
+
+    def begin(self, prefix):
+        """
+        Empieza a recorrer un prefijo, olvidando los pendientes y errores de ejecuciones anteriores.
+
+        Parámetros:
+        - prefix: str prefijo que se va a listar
+        """
+        with self._lock:
+            self._pending.pop(prefix, None)
+            self._failed.discard(prefix)
+
+    def stage(self, prefix, key):
+        """
+        Marca una key como leída a falta de confirmar la carga de su lote.
+
+        Parámetros:
+        - prefix: str prefijo que se está listando
+        - key: str key del objeto
+        """
+        with self._lock:
+            if prefix not in self._failed:
+                self._pending[prefix] = max(key, self._pending.get(prefix, key))
+
+    def commit(self, prefix):
+        """
+        Mueve el punto de avance a la última key pendiente del prefijo.
+
+        Parámetros:
+        - prefix: str prefijo que se está listando
+        """
+        with self._lock:
+            key = self._pending.pop(prefix, None)
+            if key is None or prefix in self._failed:
+                return
+        data = {'prefix': prefix, 'key': key, 'updated_at': datetime.now(timezone.utc).isoformat()}
+        try:
+            self._write(prefix, data)
+        except Exception as e:
+            msg = f'No se ha podido guardar el punto de avance de {prefix}: {e}'
+            logging.error(msg)
+            print_error(msg)
+            return
+        with self._lock:
+            self._cursors[prefix] = key
+
+    def discard(self, prefix):
+        """
+        Descarta las keys pendientes del prefijo (su lote no ha llegado a BQ o no se han podido leer).
+        Hasta el siguiente begin el punto de avance no se mueve, para no saltarse esos objetos al reanudar.
+
+        Parámetros:
+        - prefix: str prefijo que se está listando
+        """
+        with self._lock:
+            self._pending.pop(prefix, None)
+            self._failed.add(prefix)
+
+    def finish(self, prefix):
+        """
+        Da por recorrido el prefijo y borra su punto de avance, salvo que algo haya fallado: en ese
+        caso se conserva para que la siguiente ejecución reanude desde el último lote cargado.
+
+        Parámetros:
+        - prefix: str prefijo que se ha listado
+        """
+        with self._lock:
+            self._pending.pop(prefix, None)
+            if prefix in self._failed or self._cursors.get(prefix) is None:
+                return
+        try:
+            self._delete(prefix)
+        except Exception as e:
+            msg = f'No se ha podido borrar el punto de avance de {prefix}: {e}'
+            logging.error(msg)
+            print_error(msg)
+            return
+        with self._lock:
+            self._cursors[prefix] = None
+
+    def _read(self, prefix):
+        raise NotImplementedError
+
+    def _write(self, prefix, data):
+        raise NotImplementedError
+
+    def _delete(self, prefix):
+        raise NotImplementedError
+
+
+class FileCheckpoint(Checkpoint):
+    """
+    Puntos de avance en una carpeta local, un json por prefijo. Cada fichero se reescribe entero
+    y de forma atómica, así que varios procesos (p.ej. los del backfill local) pueden compartir la carpeta.
+    """
+    def __init__(self, path):
+        super().__init__()
+        self._path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, prefix):
+        return os.path.join(self._path, prefix.strip('/').replace('/', '_') + '.json')
+
+    def _read(self, prefix):
+        try:
+            with open(self._file(prefix)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _write(self, prefix, data):
+        path = self._file(prefix)
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+
+    def _delete(self, prefix):
+        try:
+            os.remove(self._file(prefix))
+        except FileNotFoundError:
+            pass
+
+
+class ObjectCheckpoint(Checkpoint):
+    """
+    Puntos de avance como objetos de un bucket (<path>/<prefijo>checkpoint.json), para que se conserven
+    entre instancias de la Cloud Function. Con un bucket 'file://<carpeta>' (etl.fakes.LocalBucket)
+    sirve de sustituto local del almacén de objetos.
+    """
+    def __init__(self, bucket, path):
+        super().__init__()
+        self._bucket = bucket
+        self._client = bucket.meta.client
+        self._path = path.strip('/')
+
+    def _key(self, prefix):
+        return f'{self._path}/{prefix}checkpoint.json'
+
+    def _read(self, prefix):
+        try:
+            response = self._client.get_object(Bucket=self._bucket.name, Key=self._key(prefix))
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            if getattr(e, 'response', {}).get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+                return None
+            raise
+        return json.loads(response['Body'].read())
+
+    def _write(self, prefix, data):
+        self._client.put_object(Bucket=self._bucket.name, Key=self._key(prefix), Body=json.dumps(data).encode())
+
+    def _delete(self, prefix):
+        self._client.delete_object(Bucket=self._bucket.name, Key=self._key(prefix))
+
+
+class Deadline:
+    """
+    Límite de tiempo de una ejecución. La ETL lo consulta antes de empezar trabajo nuevo (una unidad,
+    un objeto, un lote de la cola) y, cuando se alcanza, deja de empezarlo y carga lo que ya ha extraído.
+    margin_seconds es el tiempo que se reserva para esa última carga y las tablas agregadas.
+
+    Parámetros:
+    - timeout_seconds: int tiempo máximo de la ejecución (0 -> sin límite)
+    - margin_seconds: int segundos antes del límite en los que se deja de empezar trabajo nuevo
+    """
+    def __init__(self, timeout_seconds, margin_seconds=0):
+        self.timeout_seconds = timeout_seconds
+        self._end = time.monotonic() + timeout_seconds - margin_seconds if timeout_seconds > 0 else None
+
+    def remaining(self):
+        """
+        Segundos que quedan hasta dejar de empezar trabajo nuevo (None si no hay límite).
+        """
+        if self._end is None:
+            return None
+        return max(self._end - time.monotonic(), 0.0)
+
+    def expired(self):
+        """
+        Indica si ya no se debe empezar trabajo nuevo.
+        """
+        return self._end is not None and time.monotonic() >= self._end
+
+def connect_checkpoint_bucket(bucket_name):
+    """
+    Se conecta al bucket donde se guardan los puntos de avance. A diferencia del bucket de datos,
+    que es público, aquí hay que escribir, así que se usan las credenciales de AWS del entorno.
+
+    Parámetros:
+    - bucket_name: str nombre del bucket o 'file://<carpeta>'
+    """
+    if bucket_name.startswith('file://'):
+        from etl.fakes import LocalBucket
+        return LocalBucket(bucket_name[len('file://'):])
+
+    import boto3
+    try:
+        return boto3.resource('s3').Bucket(bucket_name)
+    except Exception as e:
+        logging.critical(e)
+        raise ConnectionError(e)
+
+def get_checkpoint(yaml_vars, bucket=None):
+    """
+    Crea el almacén de puntos de avance configurado en el config.yaml, o None si está desactivado.
+
+    Parámetros:
+    - yaml_vars: dict variables del config.yaml
+    - bucket: s3 bucket opcional, conexión ya abierta al bucket de los puntos de avance (backend
+      'object'). Si no se indica se conecta con connect_checkpoint_bucket
+    """
+    checkpoint_vars = yaml_vars['checkpoint']
+    backend = checkpoint_vars['backend']
+    if backend == 'file':
+        return FileCheckpoint(checkpoint_vars['path'])
+    elif backend == 'object':
+        return ObjectCheckpoint(bucket or connect_checkpoint_bucket(checkpoint_vars['bucket']), checkpoint_vars['path'])
+    return None
+
+def get_deadline(yaml_vars):
+    """
+    Crea el límite de tiempo de la ejecución a partir de la sección run del config.yaml.
+    Se debe llamar al empezar la ejecución (o la petición, en la Cloud Function).
+
+    Parámetros:
+    - yaml_vars: dict variables del config.yaml
+    """
+    return Deadline(yaml_vars['run']['timeout_seconds'], yaml_vars['run']['deadline_margin'])
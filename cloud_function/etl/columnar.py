@@ -0,0 +1,123 @@
+import io
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+# Tipos de BQ y su equivalente en Arrow
+ARROW_TYPES = {
+    'STRING': pa.string(),
+    'INTEGER': pa.int64(),
+    'INT64': pa.int64(),
+    'FLOAT': pa.float64(),
+    'FLOAT64': pa.float64(),
+    'BOOLEAN': pa.bool_(),
+    'BOOL': pa.bool_(),
+    'TIMESTAMP': pa.timestamp('us', tz='UTC'),
+    'DATE': pa.date32(),
+}
+
+def _arrow_field(field, timestamps_as_string=False):
+    """
+    Convierte un campo del esquema de BQ en un campo de Arrow.
+
+    Parámetros:
+    - field: bigquery.SchemaField
+    - timestamps_as_string: bool si es True los TIMESTAMP se dejan como string (los json los traen así)
+    """
+    if field.field_type in ('RECORD', 'STRUCT'):
+        arrow_type = pa.struct([_arrow_field(f, timestamps_as_string) for f in field.fields])
+    elif field.field_type == 'TIMESTAMP' and timestamps_as_string:
+        arrow_type = pa.string()
+    else:
+        arrow_type = ARROW_TYPES.get(field.field_type, pa.string())
+
+    if field.mode == 'REPEATED':
+        arrow_type = pa.list_(arrow_type)
+    return pa.field(field.name, arrow_type, nullable=field.mode != 'REQUIRED')
+
+def schema_to_arrow(schema, timestamps_as_string=False):
+    """
+    Convierte un esquema de BQ (el de get_schema) en un esquema de Arrow.
+
+    Parámetros:
+    - schema: list de bigquery.SchemaField
+    - timestamps_as_string: bool si es True los TIMESTAMP se dejan como string
+    """
+    return pa.schema([_arrow_field(field, timestamps_as_string) for field in schema])
+
+# Zona horaria al final de una fecha ISO 8601: 'Z' o un desfase (+02, +0200, +02:00)
+_ZONE = r'(Z|[+-]\d{2}(:?\d{2})?)$'
+
+def _to_timestamp(column):
+    """
+    Parsea una columna de fechas en formato ISO 8601 a TIMESTAMP en UTC, con un único cast vectorizado.
+    Las fechas sin zona horaria se consideran UTC, igual que hace BQ: se les añade 'Z' antes del cast,
+    de forma que un mismo lote puede mezclar fechas con y sin zona.
+    """
+    has_zone = pc.match_substring_regex(column, _ZONE)
+    column = pc.if_else(has_zone, column, pc.binary_join_element_wise(column, 'Z', ''))
+    return pc.cast(column, pa.timestamp('us', tz='UTC'))
+
+def records_to_arrow(data, schema):
+    """
+    Construye una tabla de Arrow a partir de los registros limpios, con los tipos del esquema de BQ.
+    Sólo se convierten los TIMESTAMP del primer nivel (los esquemas actuales no tienen otros).
+
+    Parámetros:
+    - data: list con los jsons a subir
+    - schema: list de bigquery.SchemaField
+    """
+    table = pa.Table.from_pylist(data, schema=schema_to_arrow(schema, timestamps_as_string=True))
+    for i, field in enumerate(schema):
+        if field.field_type == 'TIMESTAMP' and field.mode != 'REPEATED':
+            table = table.set_column(i, table.schema.field(i).with_type(pa.timestamp('us', tz='UTC')),
+                                     _to_timestamp(table.column(i)))
+    return table
+
+def strip_brackets_column(column, field):
+    """
+    Quita los corchetes de un campo de texto dentro de una columna list<struct> (p.ej. categories[].name)
+    con utf8_trim, sin pasar por python registro a registro.
+
+    Parámetros:
+    - column: pyarrow.ChunkedArray columna de tipo list<struct>
+    - field: str campo del struct que se limpia
+    """
+    chunks = []
+    for chunk in column.chunks:
+        # values son los structs de todas las listas del trozo, y offsets dónde empieza cada lista
+        values = chunk.values
+        children = [pc.utf8_trim(values.field(i), '[]') if values.type.field(i).name == field else values.field(i)
+                    for i in range(values.type.num_fields)]
+        struct = pa.StructArray.from_arrays(children, fields=list(values.type), mask=values.is_null())
+        chunks.append(pa.ListArray.from_arrays(chunk.offsets, struct, type=chunk.type, mask=chunk.is_null()))
+    return pa.chunked_array(chunks, type=column.type)
+
+def clean_table(table, strip_brackets):
+    """
+    Limpieza de un lote ya convertido a Arrow, equivalente a etl.sources.Source.clean_record: las
+    columnas que faltan en los registros (defaults de la fuente) quedan a nulo al construir la tabla
+    con el esquema, y se quitan los corchetes de los campos indicados.
+
+    Parámetros:
+    - table: pyarrow.Table construida con records_to_arrow
+    - strip_brackets: iterable de (lista, campo) de la fuente, p.ej. [('categories', 'name')]
+    """
+    for list_field, field in strip_brackets:
+        if list_field in table.column_names:
+            i = table.schema.get_field_index(list_field)
+            table = table.set_column(i, table.schema.field(i), strip_brackets_column(table.column(i), field))
+    return table
+
+def to_parquet_buffer(table, compression='snappy'):
+    """
+    Serializa una tabla de Arrow a Parquet en memoria, lista para load_table_from_file.
+
+    Parámetros:
+    - table: pyarrow.Table
+    - compression: str compresión del parquet ('snappy', 'zstd', 'gzip' o 'none')
+    """
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer, compression=compression)
+    buffer.seek(0)
+    return buffer
@@ -0,0 +1,38 @@
+import json
+import logging
+
+def _orjson_loads():
+    import orjson
+    return orjson.loads
+
+def _msgspec_loads():
+    import msgspec
+    return msgspec.json.Decoder().decode
+
+def _stdlib_loads():
+    return json.loads
+
+# Backends disponibles, por orden de preferencia para el modo 'auto'
+DECODERS = {
+    'orjson': _orjson_loads,
+    'msgspec': _msgspec_loads,
+    'json': _stdlib_loads,
+}
+
+def get_decoder(backend='auto'):
+    """
+    Devuelve la función con la que se parsea el contenido (bytes) de cada objeto del bucket.
+    Las librerías orjson y msgspec son opcionales: si no están instaladas se usa el json estándar.
+
+    Parámetros:
+    - backend: str 'auto', 'orjson', 'msgspec' o 'json'. Con 'auto' se usa el más rápido disponible
+    """
+    backends = list(DECODERS) if backend == 'auto' else [backend, 'json']
+    for name in backends:
+        try:
+            loads = DECODERS[name]()
+        except ImportError:
+            if backend != 'auto':
+                logging.warning(f'La librería {name} no está instalada, se usa json')
+            continue
+        return name, loads
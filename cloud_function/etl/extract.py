@@ -1,14 +1,24 @@
-import json
-from etl.transform import tweet_cleaning, yt_comment_cleaning
-from etl.utils import print_error
+from etl.decoders import get_decoder
+from etl.sources import get_source
+from etl.utils import print_error, utc_day
 from datetime import datetime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import logging
-from etl.load import get_schema
+from etl.validate import get_validator
+from etl.listing import list_objects, list_objects_parallel
+from etl.formats import is_supported, is_stream, iter_body, iter_stream
+from etl.metrics import RunMetrics
+import time
 
 class SkipFolderException(Exception):
     """Excepción para indicar que se debe saltar una carpeta."""
     pass
 
+class ReadErrorException(Exception):
+    """Excepción para indicar que alguna de las keys indicadas no se ha podido descargar o leer."""
+    pass
+
 def get_folder_path(date_to_upload, folder):
     """
     Construye el path a la carpeta sobre la que se quiere iterar.
@@ -33,97 +43,357 @@ def get_folder_path(date_to_upload, folder):
         folder_path = f'{folder}/{date_to_upload}/'
     return folder_path
 
-def check_json_vs_schema(json_obj, schema):
+def get_object_body(client, bucket_name, key):
     """
-    Comprobación de que el json contiene los campos esperados.
-    
+    Descarga el contenido de un objeto de s3.
+
     Parámetros:
-    - json_obj: dict
-    - schema: bigquery.SchemaField
+    - client: cliente de s3 (es thread-safe, a diferencia del resource)
+    - bucket_name: str nombre del bucket
+    - key: str key del objeto
     """
-    # Se comprueba solo el primer nivel
-    fields_1 = set([field.name for field in schema])
-    json_keys_1 = set(json_obj.keys())
+    return client.get_object(Bucket=bucket_name, Key=key)['Body'].read()
 
-    extra_keys  = json_keys_1 - fields_1
-    missing_keys  = fields_1 - json_keys_1
+def _timed_get(client, bucket_name, key, metrics):
+    """
+    Descarga un objeto apuntando el tiempo y los bytes en la etapa 'get'.
+    Los objetos que se leen en streaming no se descargan aquí (devuelve None).
+    """
+    if is_stream(key):
+        return None
+    start = time.perf_counter()
+    body = get_object_body(client, bucket_name, key)
+    metrics.add('get', time.perf_counter() - start, 1, len(body))
+    return body
 
-    if len(extra_keys) > 0:
-        msg = f'El archivo {json_obj} tiene keys nuevas {extra_keys}'
-    elif len(missing_keys ) > 0:
-        msg = f'Al archivo {json_obj} le faltan las keys {missing_keys}'
-    else:
-        msg = True
-    return msg
+def open_object_stream(bucket, key, metrics=None):
+    """
+    Hace el GET de un objeto y devuelve su Body sin leerlo, para procesarlo en streaming.
 
+    Parámetros:
+    - bucket: s3 bucket
+    - key: str key del objeto
+    - metrics: etl.metrics.RunMetrics opcional
+    """
+    start = time.perf_counter()
+    response = bucket.meta.client.get_object(Bucket=bucket.name, Key=key)
+    if metrics:
+        metrics.add('get', time.perf_counter() - start, 1, response.get('ContentLength') or 0)
+    return response['Body']
 
-def extract(date_to_upload, folder, bucket):
+def fetch_objects(bucket, objs, max_workers=1, metrics=None):
     """
-    Extrae los datos del bucket de las diferentes fuentes.
+    Descarga los objetos de s3 con un número acotado de hilos. Devuelve tuplas (obj, body, error)
+    en el mismo orden en el que llegan los objetos, de forma que la salida es determinista.
+    Los objetos comprimidos o con un registro por línea no se descargan por adelantado (body es None):
+    se leen en streaming al procesarlos para no tenerlos enteros en memoria.
+
+    Parámetros:
+    - bucket: s3 bucket
+    - objs: iterable de objetos del bucket (dicts de list_objects_v2)
+    - max_workers: int número máximo de descargas simultáneas
+    - metrics: etl.metrics.RunMetrics opcional
+    """
+    client = bucket.meta.client
+    metrics = metrics or RunMetrics()
+
+    # Sin concurrencia se descarga uno a uno
+    if max_workers <= 1:
+        for obj in objs:
+            try:
+                yield obj, _timed_get(client, bucket.name, obj['Key'], metrics), None
+            except Exception as e:
+                yield obj, None, e
+        return
+
+    # Ventana acotada de descargas en curso para no cargar todo el listado en memoria
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for obj in objs:
+            pending.append((obj, executor.submit(_timed_get, client, bucket.name, obj['Key'], metrics)))
+            if len(pending) >= max_workers * 2:
+                yield _result(*pending.popleft())
+        while pending:
+            yield _result(*pending.popleft())
+
+def _result(obj, future):
+    """
+    Espera a una descarga y devuelve la tupla (obj, body, error).
+    """
+    try:
+        return obj, future.result(), None
+    except Exception as e:
+        return obj, None, e
+
+def extract(date_to_upload, folder, bucket, max_workers=1, state=None, batch_size=5000, max_batch_mb=64, json_backend='auto', metrics=None,
+            list_workers=1, transform_engine='python', checkpoint=None, deadline=None):
+    """
+    Extrae los datos del bucket de las diferentes fuentes. Es un generador que devuelve lotes
+    (all_data, id_list, date_list) de tamaño acotado, de forma que la memoria no depende del tamaño
+    del prefijo y la carga de un lote puede empezar mientras se sigue listando el bucket.
 
     Parámetros:
     - date_to_upload: str indica la fecha de los datos a cargar. Puede ser 'all', 'today' o una fecha en formato YYYY/MM/DD
     - folder: str carpeta del bucket sobre la que iterar
     - bucket: s3 bucket
+    - max_workers: int número de descargas simultáneas
+    - state: etl.state.StateStore opcional, si se indica sólo se descargan los objetos nuevos o modificados
+    - batch_size: int número máximo de registros por lote
+    - max_batch_mb: int tamaño máximo (MB descargados) de cada lote
+    - json_backend: str librería con la que se parsean los json (ver etl.decoders)
+    - metrics: etl.metrics.RunMetrics opcional, donde se apuntan las etapas listing, get, parse, clean y validate
+    - list_workers: int listados simultáneos; con más de 1 y 'all' el prefijo se divide por año/mes/día (ver etl.listing)
+    - transform_engine: str 'python' -> se limpia registro a registro; 'arrow' -> los registros se entregan
+      sin limpiar y la limpieza se hace por lotes en Arrow al cargarlos (ver etl.columnar.clean_table)
+    - checkpoint: etl.checkpoint.Checkpoint opcional, si se indica se reanuda el listado desde el punto
+      de avance de una ejecución anterior que no terminó y se apunta el de esta
+    - deadline: etl.checkpoint.Deadline opcional, al alcanzarse no se empiezan objetos nuevos y se
+      entrega lo ya extraído
     """
     # Se construye el path al folder sobre el que iterar
     folder_path = get_folder_path(date_to_upload, folder)
+    # Sin metrics se mide igualmente, pero no se informa de nada
+    metrics = metrics or RunMetrics(folder)
+
+    # Si hay estado guardado, se reanuda el listado y se descartan los objetos ya procesados
+    if state:
+        state.begin(folder, folder_path)
+    start_after = state.get_start_after(folder, folder_path) if state else None
+    # Si la ejecución anterior se cortó a mitad del prefijo, se sigue justo donde se quedó
+    if checkpoint:
+        checkpoint.begin(folder_path)
+        cursor = checkpoint.get(folder_path)
+        if cursor and (start_after is None or cursor > start_after):
+            msg = f'Se reanuda {folder_path} después de {cursor}'
+            logging.info(msg)
+            print(msg)
+            start_after = cursor
+    # Un día no tiene más niveles por los que dividir el listado: se lista directamente
+    if list_workers > 1 and date_to_upload == 'all':
+        listing = list_objects_parallel(bucket, folder_path, list_workers, start_after)
+    else:
+        listing = list_objects(bucket, folder_path, start_after)
+    objs = (obj for obj in metrics.timed_iter('listing', listing)
+            if is_supported(obj['Key']) and (state is None or state.is_new(folder, obj, folder_path)))
+
+    return _extract_objects(objs, folder, folder_path, bucket, max_workers, state,
+                            batch_size, max_batch_mb, json_backend, metrics, transform_engine, checkpoint, deadline)
+
+def extract_keys(keys, folder, bucket, max_workers=1, batch_size=5000, max_batch_mb=64, json_backend='auto', metrics=None,
+                 transform_engine='python'):
+    """
+    Igual que extract, pero sólo con las keys indicadas (p.ej. las de una notificación del bucket),
+    sin listar el bucket. Devuelve lotes (all_data, id_list, date_list).
+    Como no hay estado que las vuelva a encontrar, si alguna key no se puede descargar o leer, al
+    terminar se lanza ReadErrorException para que la notificación se reintente.
+
+    Parámetros:
+    - keys: list keys de los objetos de la carpeta
+    - folder: str carpeta del bucket a la que pertenecen
+    - bucket: s3 bucket
+    - max_workers: int número de descargas simultáneas
+    - batch_size: int número máximo de registros por lote
+    - max_batch_mb: int tamaño máximo (MB descargados) de cada lote
+    - json_backend: str librería con la que se parsean los json (ver etl.decoders)
+    - metrics: etl.metrics.RunMetrics opcional
+    - transform_engine: str 'python' o 'arrow' (ver extract)
+    """
+    metrics = metrics or RunMetrics(folder)
+    objs = ({'Key': key} for key in keys if is_supported(key))
+    return _extract_objects(objs, folder, f'{folder}/', bucket, max_workers, None,
+                            batch_size, max_batch_mb, json_backend, metrics, transform_engine, raise_read_errors=True)
+
+def _extract_objects(objs, folder, folder_path, bucket, max_workers, state, batch_size, max_batch_mb, json_backend, metrics,
+                     transform_engine='python', checkpoint=None, deadline=None, raise_read_errors=False):
+    """
+    Descarga, parsea, limpia y valida los objetos indicados, y los entrega en lotes.
+    Es la parte común de extract y extract_keys. Con raise_read_errors, después de entregar el
+    último lote se lanza ReadErrorException si algún objeto no se ha podido descargar o leer.
+
+    Un objeto puede tener varios registros (NDJSON, array json, comprimido) y repartirse entre
+    varios lotes; por eso se marca como procesado en el estado (y en el punto de avance) al
+    terminar de leerlo, con el lote de su último registro.
+    """
+    def stage(obj):
+        if state:
+            state.stage(folder, obj, folder_path)
+        if checkpoint:
+            checkpoint.stage(folder_path, obj['Key'])
+
     all_data, id_list, date_list = [], [], []
+    batch_bytes, total, read_errors = 0, 0, 0
+    _, loads = get_decoder(json_backend)
+    # Limpieza y validación de la fuente, ya compiladas. Con la limpieza por lotes los registros se
+    # validan sin las columnas que rellena la limpieza
+    source = get_source(folder.lower())
+    clean = source.clean if transform_engine == 'python' else None
+    validate = get_validator(source.dataset_id, () if clean else source.defaults)
 
-    # Itera sobre los json de una fuente determinada
-    for obj in bucket.objects.filter(Prefix=folder_path):
-        if obj.key.endswith('.json'):
-            try:
-                body = obj.get()['Body'].read()
-                json_data = json.loads(body)
-            except Exception as e:
-                logging.error(e)
-                print_error(e)
+    # Itera sobre los objetos de una fuente determinada
+    for obj, body, error in fetch_objects(bucket, objs, max_workers, metrics):
+        # Cerca del límite de tiempo no se empiezan objetos nuevos: se entrega lo extraído y la
+        # siguiente ejecución sigue desde el punto de avance
+        if deadline and deadline.expired():
+            msg = f'Límite de tiempo alcanzado, se deja de extraer {folder_path} antes de {obj["Key"]}'
+            logging.warning(msg)
+            print_error(msg)
+            break
 
-            # Comprobación de que el id existe y no está vacío
-            if ('id' in json_data.keys()) & (len(json_data['id']) > 0):
-                id_list.append(json_data['id'])
-            else:
-                msg = f'No existe "id" en el registro {obj}'
-                logging.error(msg)
-                print_error(msg)
-                continue
+        if error is not None:
+            read_errors += 1
+            logging.error(f'{obj["Key"]}: {error}')
+            print_error(f'{obj["Key"]}: {error}')
+            # El punto de avance no puede pasar de un objeto que no se ha leído
+            if checkpoint:
+                checkpoint.discard(folder_path)
+            continue
 
-            # Limpieza según la fuente
-            try:
-                if 'tweet' in folder_path.lower():
-                    json_data = tweet_cleaning(json_data)
-                elif 'youtubecomment' in folder_path.lower():
-                    json_data = yt_comment_cleaning(json_data)
-                    
-            except Exception as e:
-                logging.error(e)
-                print_error(e)
-
-            # Comprobación de que tenemos los mismos campos del schema de BQ
-            schema = get_schema(folder.lower())
-            check_keys = check_json_vs_schema(json_data, schema)
-            if check_keys:
-                pass
+        staged = False
+        try:
+            if body is None:
+                records = iter_stream(open_object_stream(bucket, obj['Key'], metrics), obj['Key'], loads)
             else:
-                logging.error(check_keys)
-                print_error(check_keys)
-                continue
+                records = iter_body(body, loads)
+
+            for is_last, (size, json_data) in _with_last(_timed_records(records, metrics)):
+                batch_bytes += size
+                json_data = _process_record(json_data, obj, validate, metrics, clean)
+                if json_data is not None:
+                    id_list.append(json_data['id'])
+
+                    # Más adelante nos hará falta una lista de fechas, de los días en UTC en los que BQ reparte los registros
+                    date = utc_day(json_data['date'])
+                    if date not in date_list:
+                        date_list.append(date)
+
+                    all_data.append(json_data)
+
+                if is_last:
+                    stage(obj)
+                    staged = True
+
+                # Lote completo, se entrega para cargarlo antes de seguir descargando
+                if len(all_data) >= batch_size or batch_bytes >= max_batch_mb * 1024 * 1024:
+                    total += len(all_data)
+                    _log_batch(all_data)
+                    yield all_data, id_list, date_list
+                    all_data, id_list, date_list = [], [], []
+                    batch_bytes = 0
+        except ValueError as e:
+            # Contenido no válido: no va a cambiar, así que el objeto se da por procesado
+            logging.error(f'{obj["Key"]}: {e}')
+            print_error(f'{obj["Key"]}: {e}')
+        except Exception as e:
+            # Error de lectura: el objeto no se marca como procesado para reintentarlo
+            read_errors += 1
+            logging.error(f'{obj["Key"]}: {e}')
+            print_error(f'{obj["Key"]}: {e}')
+            if checkpoint:
+                checkpoint.discard(folder_path)
+            continue
+
+        if not staged:
+            stage(obj)
 
-            # Más adelante nos hará falta una lista de fechas
-            date = json_data['date'].split('T')[0]
-            if date not in date_list:
-                date_list.append(date)
+    if len(all_data) > 0:
+        total += len(all_data)
+        _log_batch(all_data)
+        yield all_data, id_list, date_list
 
-            all_data.append(json_data)
+    if raise_read_errors and read_errors:
+        raise ReadErrorException(f'{read_errors} objetos de {folder_path} no se han podido leer')
 
-    if len(all_data) == 0:
+    if total == 0:
         msg = f'No hay archivos en la ruta {folder_path}\n'
         logging.info(msg)
         raise SkipFolderException(f'{msg}')
-    else:
-        msg = f'{len(all_data)} archivos extraídos'
-        logging.info(msg)
-        print(msg)
 
-    return all_data, id_list, date_list
+def _process_record(json_data, obj, validate, metrics, clean=None):
+    """
+    Limpia (con la función clean de la fuente, si se indica) y valida un registro, y comprueba que
+    tiene id y fecha. Devuelve el registro o None si no es válido.
+    Los campos sólo se usan después de validarlos: un id o una fecha de otro tipo es un registro no
+    válido, no un error de lectura que haga reintentar el objeto entero.
+    """
+    # Comprobación de que el registro es un objeto con id
+    if not (isinstance(json_data, dict) and 'id' in json_data):
+        msg = f'No existe "id" en el registro {obj["Key"]}'
+        logging.error(msg)
+        print_error(msg)
+        return None
+
+    # Limpieza según la fuente
+    if clean:
+        start = time.perf_counter()
+        try:
+            json_data = clean(json_data)
+        except Exception as e:
+            logging.error(e)
+            print_error(e)
+        metrics.add('clean', time.perf_counter() - start, 1)
+
+    # Comprobación de que el registro encaja con el schema de BQ (campos, anidados y tipos)
+    start = time.perf_counter()
+    check_keys = validate(json_data)
+    metrics.add('validate', time.perf_counter() - start, 1)
+    if check_keys is not True:
+        logging.error(check_keys)
+        print_error(check_keys)
+        return None
+
+    # Ya validados, el id y la fecha son cadenas o nulos. El deduplicado y el reparto por días los necesitan
+    if not json_data['id']:
+        msg = f'No existe "id" en el registro {obj["Key"]}'
+        logging.error(msg)
+        print_error(msg)
+        return None
+    if not json_data.get('date'):
+        msg = f'El registro {json_data["id"]} de {obj["Key"]} no tiene fecha'
+        logging.error(msg)
+        print_error(msg)
+        return None
+    return json_data
+
+def _timed_records(records, metrics):
+    """
+    Recorre los registros de un objeto apuntando en la etapa 'parse' el tiempo de obtener cada uno.
+    En los objetos en streaming incluye también la lectura y descompresión.
+    """
+    while True:
+        start = time.perf_counter()
+        try:
+            size, record = next(records)
+        except StopIteration:
+            return
+        metrics.add('parse', time.perf_counter() - start, 1, size)
+        yield size, record
+
+def _with_last(iterable):
+    """
+    Devuelve (es_el_último, elemento) de cada elemento de un iterable. Si el iterable falla, antes
+    de propagar el error se devuelve (como no último) el elemento que ya se había leído, para no perderlo.
+    """
+    iterator = iter(iterable)
+    try:
+        previous = next(iterator)
+    except StopIteration:
+        return
+    while True:
+        try:
+            item = next(iterator)
+        except StopIteration:
+            yield True, previous
+            return
+        except Exception:
+            yield False, previous
+            raise
+        yield False, previous
+        previous = item
+
+def _log_batch(all_data):
+    """
+    Informa del número de registros extraídos en un lote.
+    """
+    msg = f'{len(all_data)} archivos extraídos'
+    logging.info(msg)
+    print(msg)
@@ -0,0 +1,438 @@
+"""
+Clientes locales que imitan a S3, SQS y BigQuery para probar la ETL y medir su rendimiento sin
+acceso al bucket ni a un proyecto de GCP.
+"""
+from datetime import datetime, timezone
+from types import SimpleNamespace
+import hashlib
+import io
+import json
+import os
+import re
+import threading
+import time
+import uuid
+import pyarrow.parquet as pq
+from google.api_core.exceptions import BadRequest, NotFound
+from etl.utils import utc_day
+
+def _table_id(table):
+    """
+    Devuelve el id completo 'proyecto.dataset.tabla' de una tabla, referencia o string.
+    """
+    table = getattr(table, 'reference', table)
+    if hasattr(table, 'table_id'):
+        return f'{table.project}.{table.dataset_id}.{table.table_id}'
+    return str(table).replace('`', '')
+
+def _row_day(row):
+    """
+    Devuelve el día en UTC (YYYY-MM-DD) de la columna date de un registro, como lo reparte BQ.
+    """
+    return utc_day(str(row.get('date')))
+
+
+class LocalS3Client:
+    """
+    Imita al cliente de s3 sobre una carpeta local: cada key es la ruta de un fichero dentro de root.
+    Implementa sólo lo que usa la ETL: get_object, put_object y delete_object (puntos de avance,
+    ver etl.checkpoint) y el paginador de list_objects_v2.
+
+    Parámetros:
+    - root: str carpeta local que hace de bucket
+    - latency: float segundos de espera por petición, para simular la latencia de red
+    """
+    def __init__(self, root, latency=0.0):
+        self.root = root
+        self.latency = latency
+
+    def _path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def get_object(self, Bucket, Key):
+        time.sleep(self.latency)
+        with open(self._path(Key), 'rb') as f:
+            body = f.read()
+        return {'Body': io.BytesIO(body), 'ContentLength': len(body), 'ETag': self._summary(Key)['ETag']}
+
+    def put_object(self, Bucket, Key, Body):
+        time.sleep(self.latency)
+        path = self._path(Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Se escribe en un temporal y se renombra, como s3 el objeto aparece entero o no aparece
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(Body)
+        os.replace(tmp, path)
+        return {'ETag': self._summary(Key)['ETag']}
+
+    def delete_object(self, Bucket, Key):
+        time.sleep(self.latency)
+        try:
+            os.remove(self._path(Key))
+        except FileNotFoundError:
+            pass
+        return {}
+
+    def _list(self, prefix):
+        """
+        Devuelve las keys del prefijo ordenadas alfabéticamente, como hace s3.
+        """
+        base = prefix.rsplit('/', 1)[0] if '/' in prefix else ''
+        keys = []
+        for dirpath, _, filenames in os.walk(self._path(base) if base else self.root):
+            rel = os.path.relpath(dirpath, self.root).replace(os.sep, '/')
+            for name in filenames:
+                key = name if rel == '.' else f'{rel}/{name}'
+                if key.startswith(prefix):
+                    keys.append(key)
+        return sorted(keys)
+
+    def _summary(self, key):
+        stat = os.stat(self._path(key))
+        return {
+            'Key': key,
+            'ETag': f'"{hashlib.md5(f"{stat.st_size}-{stat.st_mtime_ns}".encode()).hexdigest()}"',
+            'LastModified': datetime.fromtimestamp(stat.st_mtime, timezone.utc),
+            'Size': stat.st_size,
+        }
+
+    def _list_with_prefixes(self, Prefix='', StartAfter='', Delimiter=None):
+        """
+        Devuelve los objetos y los prefijos comunes (si hay Delimiter) de un listado.
+        """
+        keys = [key for key in self._list(Prefix) if key > (StartAfter or '')]
+        contents, prefixes = [], []
+        for key in keys:
+            if Delimiter and Delimiter in key[len(Prefix):]:
+                common = Prefix + key[len(Prefix):].split(Delimiter, 1)[0] + Delimiter
+                if not prefixes or prefixes[-1] != common:
+                    prefixes.append(common)
+                continue
+            contents.append(self._summary(key))
+        return contents, prefixes
+
+    def get_paginator(self, operation_name):
+        return _LocalPaginator(self)
+
+
+class _LocalPaginator:
+    """
+    Paginador de list_objects_v2 sobre LocalS3Client, con páginas de 1000 keys. Cada página
+    espera la latencia del cliente, como una petición a s3.
+    """
+    def __init__(self, client):
+        self.client = client
+
+    def paginate(self, Bucket, Prefix='', StartAfter='', Delimiter=None, PaginationConfig=None):
+        page_size = (PaginationConfig or {}).get('PageSize', 1000)
+        contents, prefixes = self.client._list_with_prefixes(Prefix, StartAfter, Delimiter)
+        if not contents and not prefixes:
+            time.sleep(self.client.latency)
+            yield {'KeyCount': 0}
+            return
+        for i in range(0, max(len(contents), 1), page_size):
+            time.sleep(self.client.latency)
+            page = {'Contents': contents[i:i + page_size], 'KeyCount': len(contents[i:i + page_size])}
+            if i == 0 and prefixes:
+                page['CommonPrefixes'] = [{'Prefix': prefix} for prefix in prefixes]
+            yield page
+
+
+class LocalBucket:
+    """
+    Bucket de s3 sobre una carpeta local, con la misma interfaz que usa la ETL (name y meta.client).
+    Si se le pasa una cola, cada objeto nuevo envía a la cola su notificación de s3, como haría un
+    bucket con las notificaciones configuradas hacia SQS.
+
+    Parámetros:
+    - root: str carpeta local que hace de bucket
+    - latency: float segundos de espera por petición
+    - queue: LocalQueue opcional donde se envían las notificaciones
+    """
+    def __init__(self, root, latency=0.0, queue=None):
+        self.name = os.path.basename(os.path.normpath(root))
+        self.meta = SimpleNamespace(client=LocalS3Client(root, latency))
+        self.queue = queue
+
+    def put_object(self, key, body):
+        """
+        Guarda un objeto en el bucket.
+        """
+        path = self.meta.client._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(body)
+        if self.queue is not None:
+            self.queue.send_message(QueueUrl=self.queue.url, MessageBody=json.dumps(self.notification(key)))
+
+    def notification(self, key):
+        """
+        Devuelve la notificación de s3 (ObjectCreated:Put) de un objeto del bucket.
+        """
+        summary = self.meta.client._summary(key)
+        return {'Records': [{
+            'eventSource': 'aws:s3',
+            'eventName': 'ObjectCreated:Put',
+            'eventTime': summary['LastModified'].isoformat(),
+            's3': {
+                'bucket': {'name': self.name},
+                'object': {'key': key, 'size': summary['Size'], 'eTag': summary['ETag'].strip('"')},
+            },
+        }]}
+
+
+class LocalQueue:
+    """
+    Cola en memoria con la interfaz del cliente de SQS de boto3 que usa la ETL (send_message,
+    receive_message y delete_message). Como en SQS, los mensajes recibidos quedan ocultos durante
+    visibility_timeout segundos y vuelven a la cola si no se borran.
+
+    Parámetros:
+    - url: str url de la cola
+    - visibility_timeout: float segundos que un mensaje recibido queda oculto
+    """
+    def __init__(self, url='local://queue', visibility_timeout=30):
+        self.url = url
+        self.visibility_timeout = visibility_timeout
+        self._messages = {}
+        self._lock = threading.Lock()
+
+    def send_message(self, QueueUrl, MessageBody):
+        message_id = uuid.uuid4().hex
+        with self._lock:
+            self._messages[message_id] = {'Body': MessageBody, 'visible_at': 0.0}
+        return {'MessageId': message_id}
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, WaitTimeSeconds=0):
+        now = time.monotonic()
+        messages = []
+        with self._lock:
+            for message_id, message in self._messages.items():
+                if len(messages) >= MaxNumberOfMessages:
+                    break
+                if message['visible_at'] <= now:
+                    message['visible_at'] = now + self.visibility_timeout
+                    messages.append({'MessageId': message_id, 'ReceiptHandle': message_id, 'Body': message['Body']})
+        return {'Messages': messages} if messages else {}
+
+    def delete_message(self, QueueUrl, ReceiptHandle):
+        with self._lock:
+            self._messages.pop(ReceiptHandle, None)
+
+    def __len__(self):
+        return len(self._messages)
+
+
+class FakeJob:
+    """
+    Job de BQ ya terminado, con las estadísticas que se consultan en la ETL.
+    """
+    def __init__(self, job_type, rows=None, num_dml_affected_rows=None, total_bytes_processed=0, error=None):
+        self.job_id = f'fake_{job_type}_{uuid.uuid4().hex[:8]}'
+        self.job_type = job_type
+        self.state = 'DONE'
+        self.num_dml_affected_rows = num_dml_affected_rows
+        self.total_bytes_processed = total_bytes_processed
+        self.slot_millis = 0
+        self.errors = [{'message': str(error)}] if error else None
+        self._rows = rows or []
+        self._error = error
+
+    def result(self):
+        if self._error:
+            raise self._error
+        return self._rows
+
+
+class FakeBigQueryClient:
+    """
+    Cliente que imita a google.cloud.bigquery.Client guardando las tablas en memoria.
+    Registra todas las cargas y queries que recibe (atributos loads y queries) para poder inspeccionarlas.
+
+    Las queries se resuelven con manejadores (regex -> función) registrados con on_query. Por defecto
+    se entienden la consulta de ids de check_unique y la de etl.id_index.IdIndex.rebuild, el MERGE de
+    merge_raw_data y el de los conteos de las tablas agregadas (etl.aggregate.delta_merge_query); el
+    resto de queries se registran y devuelven un resultado vacío. Antes, las sentencias CREATE, DROP y
+    RENAME de tablas se aplican sobre las tablas en memoria (ver _run_ddl).
+
+    Los dry runs (job_config.dry_run) no se ejecutan: se registran en dry_runs y devuelven en
+    total_bytes_processed lo que calcule estimate(query). Por defecto es el tamaño en json de las filas
+    de las tablas que aparecen en la query, sólo de los días que aparecen en ella si hay alguno.
+    """
+    def __init__(self, project='fake-project'):
+        self.project = project
+        self.tables = {}
+        self.partitioning = {}
+        self.datasets = set()
+        self.loads = []
+        self.queries = []
+        self.dry_runs = []
+        self.estimate = self._estimate_bytes
+        self._handlers = []
+        self._reject = lambda row: False
+        self._lock = threading.Lock()
+        self.on_query(r'^\s*SELECT\s+(\w+)\s+FROM\s+`([^`]+)`\s+WHERE\s+TIMESTAMP_TRUNC\(date, DAY\) IN', self._select_ids)
+        self.on_query(r'^\s*SELECT\s+(\w+), FORMAT_TIMESTAMP\(\'%F\', date\) AS day\s+FROM\s+`([^`]+)`\s+WHERE\s+TIMESTAMP_TRUNC',
+                      self._select_ids_by_day)
+        self.on_query(r'^\s*MERGE\s+`([^`]+)`\s+T\s+USING\s+\(\s*SELECT \* FROM `([^`]+)`', self._merge_insert)
+        self.on_query(r'MERGE\s+`([^`]+)`\s+T\s+USING\s+\(SELECT d\.date, d\.value AS (\w+), d\.count FROM UNNEST\(@deltas\)',
+                      self._merge_deltas)
+
+    def on_query(self, pattern, handler):
+        """
+        Registra un manejador para las queries que casen con la regex. El manejador recibe
+        (match, query, job_config) y devuelve las filas del resultado o un FakeJob.
+        """
+        self._handlers.insert(0, (re.compile(pattern, re.S | re.I), handler))
+
+    def get_table(self, table):
+        table_id = _table_id(table)
+        if table_id not in self.tables:
+            raise NotFound(f'Table {table_id} not found')
+        field = self.partitioning.get(table_id)
+        return SimpleNamespace(table_id=table_id.split('.')[-1],
+                               time_partitioning=SimpleNamespace(field=field) if field else None)
+
+    def create_table(self, table, exists_ok=False):
+        table_id = _table_id(table)
+        with self._lock:
+            if table_id in self.tables and not exists_ok:
+                raise ValueError(f'Already Exists: Table {table_id}')
+            self.tables.setdefault(table_id, [])
+        return table
+
+    def delete_table(self, table, not_found_ok=False):
+        table_id = _table_id(table)
+        with self._lock:
+            if table_id not in self.tables and not not_found_ok:
+                raise NotFound(f'Table {table_id} not found')
+            self.tables.pop(table_id, None)
+
+    def create_dataset(self, dataset, exists_ok=False):
+        self.datasets.add(str(dataset))
+        return dataset
+
+    def reject_rows(self, predicate):
+        """
+        Hace fallar las cargas que contengan algún registro para el que predicate(registro) sea True,
+        como hace BQ con un registro que no encaja con el esquema. La tabla no se modifica.
+        """
+        self._reject = predicate
+
+    def _load(self, rows, destination, job_config):
+        table_id = _table_id(destination)
+        rejected = [row for row in rows if self._reject(row)]
+        if rejected:
+            with self._lock:
+                self.loads.append((table_id, len(rows), job_config))
+            return FakeJob('load', error=BadRequest(f'Error while reading data: registro {rejected[0].get("id")} no válido'))
+        with self._lock:
+            self.loads.append((table_id, len(rows), job_config))
+            if job_config is not None and job_config.write_disposition == 'WRITE_TRUNCATE':
+                self.tables[table_id] = []
+            self.tables.setdefault(table_id, []).extend(rows)
+        return FakeJob('load')
+
+    def load_table_from_json(self, json_rows, destination, job_config=None):
+        return self._load(list(json_rows), destination, job_config)
+
+    def load_table_from_file(self, file_obj, destination, job_config=None):
+        return self._load(pq.read_table(file_obj).to_pylist(), destination, job_config)
+
+    def query(self, query, job_config=None):
+        if getattr(job_config, 'dry_run', False):
+            with self._lock:
+                self.dry_runs.append(query)
+            return FakeJob('query', total_bytes_processed=self.estimate(query))
+        with self._lock:
+            self.queries.append((query, job_config))
+            try:
+                self._run_ddl(query)
+            except BadRequest as e:
+                return FakeJob('query', error=e)
+        for pattern, handler in self._handlers:
+            match = pattern.search(query)
+            if match:
+                result = handler(match, query, job_config)
+                return result if isinstance(result, FakeJob) else FakeJob('query', rows=result)
+        return FakeJob('query')
+
+    def _run_ddl(self, query):
+        """
+        Aplica las sentencias CREATE TABLE, DROP TABLE y ALTER TABLE ... RENAME TO de una query o
+        script sobre las tablas en memoria, con su particionado (atributo partitioning). Como BQ,
+        falla al reemplazar una tabla por otra con distinto particionado.
+        """
+        for statement in query.split(';'):
+            create = re.search(r'CREATE\s+(OR\s+REPLACE\s+)?TABLE\s+(IF\s+NOT\s+EXISTS\s+)?`([^`]+)`', statement)
+            drop = re.search(r'DROP\s+TABLE\s+`([^`]+)`', statement)
+            rename = re.search(r'ALTER\s+TABLE\s+`([^`]+)`\s+RENAME\s+TO\s+`([^`]+)`', statement)
+            if create:
+                replace, table_id = create.group(1), create.group(3)
+                partition = re.search(r'PARTITION\s+BY\s+(\w+)', statement)
+                field = partition.group(1) if partition else None
+                if table_id in self.tables:
+                    if replace and self.partitioning.get(table_id) != field:
+                        raise BadRequest(f'Cannot replace a table with a different partitioning spec: {table_id}')
+                    if not replace:
+                        continue
+                # Sólo se copian las filas de una copia directa de otra tabla (CREATE ... AS SELECT ... FROM)
+                copy = re.search(r'\bAS\s+SELECT\s+[^`]*FROM\s+`([^`]+)`\s*$', statement)
+                self.tables[table_id] = [dict(row) for row in self.tables.get(copy.group(1), [])] if copy else []
+                self.partitioning[table_id] = field
+            elif drop:
+                self.tables.pop(drop.group(1), None)
+                self.partitioning.pop(drop.group(1), None)
+            elif rename:
+                table_id = rename.group(1)
+                new_id = f'{table_id.rsplit(".", 1)[0]}.{rename.group(2)}'
+                self.tables[new_id] = self.tables.pop(table_id, [])
+                self.partitioning[new_id] = self.partitioning.pop(table_id, None)
+
+    def _estimate_bytes(self, query):
+        days = set(re.findall(r'\d{4}-\d{2}-\d{2}', query))
+        with self._lock:
+            rows = [row for table_id in set(re.findall(r'`([^`]+)`', query)) for row in self.tables.get(table_id, [])]
+        return sum(len(json.dumps(row, default=str)) for row in rows if not days or _row_day(row) in days)
+
+    def _select_ids(self, match, query, job_config):
+        column, table_id = match.group(1), match.group(2)
+        days = set(re.findall(r'\d{4}-\d{2}-\d{2}', query[match.end():]))
+        rows = self.tables.get(table_id, [])
+        return [(row[column],) for row in rows if _row_day(row) in days]
+
+    def _select_ids_by_day(self, match, query, job_config):
+        column, table_id = match.group(1), match.group(2)
+        days = set(re.findall(r'\d{4}-\d{2}-\d{2}', query[match.end():]))
+        rows = self.tables.get(table_id, [])
+        return [(row[column], _row_day(row)) for row in rows if _row_day(row) in days]
+
+    def _merge_insert(self, match, query, job_config):
+        table_id, staging_id = match.group(1), match.group(2)
+        with self._lock:
+            target = self.tables.setdefault(table_id, [])
+            existing = {row['id'] for row in target}
+            inserted = 0
+            for row in self.tables.get(staging_id, []):
+                if row['id'] not in existing:
+                    existing.add(row['id'])
+                    target.append(row)
+                    inserted += 1
+        return FakeJob('query', num_dml_affected_rows=inserted)
+
+    def _merge_deltas(self, match, query, job_config):
+        table_id, dimension = match.group(1), match.group(2)
+        params = {param.name: param for param in job_config.query_parameters}
+        with self._lock:
+            target = self.tables.setdefault(table_id, [])
+            rows = {(str(row['date']), row[dimension]): row for row in target}
+            for delta in params['deltas'].values:
+                values = delta.struct_values
+                row = rows.get((str(values['date']), values['value']))
+                if row is None:
+                    row = {'date': str(values['date']), dimension: values['value'], 'count': 0}
+                    rows[(row['date'], row[dimension])] = row
+                    target.append(row)
+                row['count'] += values['count']
+        return FakeJob('query', num_dml_affected_rows=len(params['deltas'].values))
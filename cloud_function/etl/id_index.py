@@ -0,0 +1,264 @@
+import hashlib
+import logging
+import math
+import threading
+import time
+from etl.load import dates_to_sql
+from etl.query import run_query
+from etl.utils import print_error, sqlite_connect, utc_day
+
+class BloomFilter:
+    """
+    Filtro de Bloom sencillo. Si dice que un id no está, seguro que no está; si dice que está,
+    hay que confirmarlo en el índice.
+
+    Parámetros:
+    - capacity: int número de elementos esperados
+    - error_rate: float tasa de falsos positivos esperada con esa capacidad
+    """
+    def __init__(self, capacity=100000, error_rate=0.01):
+        # Tamaño óptimo: m = -n·ln(p)/ln(2)^2 bits y k = m/n·ln(2) hashes
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, value):
+        digest = hashlib.blake2b(value.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, value):
+        for pos in self._positions(value):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, value):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(value))
+
+
+class IdIndex:
+    """
+    Índice local (SQLite) de los ids que ya existen en BQ, por fuente y día. Permite deduplicar sin
+    lanzar una query a BQ en cada lote: los días que faltan en el índice, o cuya copia es más
+    antigua que max_age_hours, se reconstruyen desde BQ; el resto se resuelve en local.
+    Por delante de SQLite hay un filtro de Bloom en memoria por fuente y día. Los días se cuentan
+    en UTC, como los reparte BQ (ver etl.utils.utc_day).
+
+    El índice sólo ve los ids que carga su propio proceso: sólo es válido con un único escritor por
+    fichero. Los días que se construyeron en un proceso anterior (el fichero ya existía al abrirlo,
+    p.ej. en /tmp de una instancia de la Cloud Function que se reutiliza) se reconstruyen la primera
+    vez que se usan, porque otros procesos o instancias pueden haber cargado ids desde entonces. Aun
+    así, con varias instancias o procesos cargando a la vez los mismos días, lo que cargue uno no lo
+    ve el índice de otro hasta max_age_hours: en ese caso hay que deduplicar con 'query' o 'merge'.
+
+    Parámetros:
+    - path: str fichero SQLite
+    - max_age_hours: float horas tras las que un día del índice se considera desactualizado
+    - bloom: bool si se usa el filtro de Bloom
+    """
+    def __init__(self, path, max_age_hours=24, bloom=True):
+        self._conn = sqlite_connect(path)
+        self._lock = threading.Lock()
+        self._max_age = max_age_hours * 3600
+        self._use_bloom = bloom
+        self._blooms = {}
+        # Lo construido antes de abrir el índice es de otro proceso y se reconstruye (ver la clase)
+        self._opened_at = time.time()
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS ids (
+                source TEXT, day TEXT, id TEXT,
+                PRIMARY KEY (source, day, id)) WITHOUT ROWID
+        """)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS days (
+                source TEXT, day TEXT, built_at REAL,
+                PRIMARY KEY (source, day))
+        """)
+        self._conn.commit()
+
+    def stale_days(self, source, date_list, since=None):
+        """
+        Devuelve los días que no están en el índice, están desactualizados o se construyeron en
+        otro proceso.
+
+        Parámetros:
+        - source: str fuente (dataset de BQ)
+        - date_list: list fechas en formato YYYY-MM-DD
+        - since: float opcional (time.time()), también se dan por desactualizados los días construidos antes
+        """
+        limit = max(time.time() - self._max_age, self._opened_at, since or 0)
+        with self._lock:
+            built = dict(self._conn.execute(
+                f'SELECT day, built_at FROM days WHERE source = ? AND day IN ({",".join("?" * len(date_list))})',
+                [source, *date_list]
+            ).fetchall())
+        return [day for day in date_list if built.get(day, 0) < limit]
+
+    def rebuild(self, source, date_list, bq_client, table_full_id, col_to_check='id', metrics=None, budget=None):
+        """
+        Reconstruye desde BQ los días indicados con una sola query, que pasa por el presupuesto de
+        bytes de la ejecución: si no cabe se rechaza (BudgetExceededException), el índice no se toca
+        y el lote se reintenta en la siguiente ejecución.
+
+        Parámetros:
+        - source: str fuente (dataset de BQ)
+        - date_list: list fechas en formato YYYY-MM-DD
+        - bq_client: google.cloud.bigquery.client.Client
+        - table_full_id: str tabla raw en BQ (proyecto.dataset.tabla)
+        - col_to_check: str columna con el id
+        - metrics: etl.metrics.RunMetrics opcional, se apunta la query en la etapa 'dedup_query'
+        - budget: etl.query.QueryBudget opcional, presupuesto de bytes de la ejecución
+        """
+        query = f"""
+        SELECT {col_to_check}, FORMAT_TIMESTAMP('%F', date) AS day
+        FROM `{table_full_id}`
+        WHERE TIMESTAMP_TRUNC(date, DAY) IN ({dates_to_sql(date_list)})
+        """
+        try:
+            start = time.perf_counter()
+            query_job = run_query(bq_client, query, budget, metrics, 'dedup_query')
+            rows = [(source, row[1], row[0]) for row in query_job.result()]
+        except Exception as e:
+            logging.critical(e)
+            raise(e)
+        if metrics:
+            metrics.add_job('dedup_query', query_job, time.perf_counter() - start, len(rows))
+
+        now = time.time()
+        with self._lock:
+            placeholders = ','.join('?' * len(date_list))
+            self._conn.execute(f'DELETE FROM ids WHERE source = ? AND day IN ({placeholders})', [source, *date_list])
+            self._conn.executemany('INSERT OR IGNORE INTO ids VALUES (?, ?, ?)', rows)
+            self._conn.executemany('INSERT OR REPLACE INTO days VALUES (?, ?, ?)', [(source, day, now) for day in date_list])
+            self._conn.commit()
+            for day in date_list:
+                self._blooms.pop((source, day), None)
+        msg = f'Índice de ids de {source} reconstruido para {len(date_list)} días ({len(rows)} ids)'
+        logging.info(msg)
+        print(msg)
+
+    def _bloom(self, source, day):
+        """
+        Devuelve el filtro de Bloom de un día, construyéndolo desde SQLite la primera vez.
+        """
+        key = (source, day)
+        if key not in self._blooms:
+            ids = [row[0] for row in self._conn.execute('SELECT id FROM ids WHERE source = ? AND day = ?', key)]
+            bloom = BloomFilter(capacity=max(len(ids) * 2, 100000))
+            for record_id in ids:
+                bloom.add(record_id)
+            self._blooms[key] = bloom
+        return self._blooms[key]
+
+    def filter_new(self, source, all_data, col_to_check='id'):
+        """
+        Devuelve los registros cuyo id no está en el índice (ni repetido dentro del propio lote).
+
+        Parámetros:
+        - source: str fuente (dataset de BQ)
+        - all_data: list con los jsons a subir
+        - col_to_check: str columna con el id
+        """
+        candidates = {}
+        with self._lock:
+            for record in all_data:
+                day = utc_day(record['date'])
+                # Si el filtro de Bloom no lo tiene, seguro que es nuevo
+                if self._use_bloom and record[col_to_check] not in self._bloom(source, day):
+                    continue
+                candidates.setdefault(day, []).append(record[col_to_check])
+
+            existing = set()
+            for day, ids in candidates.items():
+                for i in range(0, len(ids), 500):
+                    chunk = ids[i:i + 500]
+                    rows = self._conn.execute(
+                        f'SELECT day, id FROM ids WHERE source = ? AND day = ? AND id IN ({",".join("?" * len(chunk))})',
+                        [source, day, *chunk]
+                    )
+                    existing.update(rows.fetchall())
+
+        data_to_upload, seen = [], set()
+        for record in all_data:
+            key = (utc_day(record['date']), record[col_to_check])
+            if key not in existing and key not in seen:
+                seen.add(key)
+                data_to_upload.append(record)
+        return data_to_upload
+
+    def add(self, source, all_data, col_to_check='id'):
+        """
+        Añade al índice los registros que se acaban de subir a BQ.
+
+        Parámetros:
+        - source: str fuente (dataset de BQ)
+        - all_data: list con los jsons subidos
+        - col_to_check: str columna con el id
+        """
+        rows = [(source, utc_day(record['date']), record[col_to_check]) for record in all_data]
+        try:
+            with self._lock:
+                self._conn.executemany('INSERT OR IGNORE INTO ids VALUES (?, ?, ?)', rows)
+                self._conn.commit()
+                for _, day, record_id in rows:
+                    if (source, day) in self._blooms:
+                        self._blooms[(source, day)].add(record_id)
+        except Exception as e:
+            # Si no se puede actualizar, se fuerza la reconstrucción de esos días en la siguiente ejecución
+            msg = f'No se ha podido actualizar el índice de ids de {source}: {e}'
+            logging.error(msg)
+            print_error(msg)
+            self.invalidate(source, {day for _, day, _ in rows})
+
+    def invalidate(self, source, date_list):
+        """
+        Marca los días indicados como desactualizados.
+        """
+        with self._lock:
+            self._conn.executemany('DELETE FROM days WHERE source = ? AND day = ?', [(source, day) for day in date_list])
+            self._conn.commit()
+            for day in date_list:
+                self._blooms.pop((source, day), None)
+
+    def check_unique(self, all_data, bq_client, col_to_check, date_list, project_id, dataset_id, table_id, metrics=None,
+                     budget=None, since=None):
+        """
+        Equivalente a etl.load.check_unique usando el índice local. Sólo consulta a BQ los días
+        que faltan o están desactualizados en el índice.
+
+        Parámetros:
+        - all_data: list con los jsons a subir
+        - bq_client: google.cloud.bigquery.client.Client
+        - col_to_check: str columna a comprobar su unicidad
+        - date_list: list fechas de los datos que se están subiendo
+        - project_id: str proyecto de BQ
+        - dataset_id: str dataset en BQ
+        - table_id: str tabla en BQ
+        - metrics: etl.metrics.RunMetrics opcional, el filtrado en local se apunta en la etapa 'dedup_index'
+        - budget: etl.query.QueryBudget opcional, presupuesto de bytes de la ejecución (ver rebuild)
+        - since: float opcional, se reconstruyen también los días construidos antes (ver stale_days). Con
+          aggregation_mode 'delta' un id que el índice no conoce se suma a las tablas agregadas aunque ya
+          esté en BQ y se cuenta dos veces: cada ejecución vuelve a leer de BQ sus días (ver etl.pipeline.run_folder)
+        """
+        stale = self.stale_days(dataset_id, date_list, since)
+        if len(stale) > 0:
+            self.rebuild(dataset_id, stale, bq_client, f'{project_id}.{dataset_id}.{table_id}', col_to_check, metrics,
+                         budget)
+        start = time.perf_counter()
+        data_to_upload = self.filter_new(dataset_id, all_data, col_to_check)
+        if metrics:
+            metrics.add('dedup_index', time.perf_counter() - start, len(all_data))
+        return data_to_upload
+
+
+def get_id_index(yaml_vars):
+    """
+    Crea el índice local de ids si alguna fuente lo usa para deduplicar, o devuelve None.
+
+    Parámetros:
+    - yaml_vars: dict variables del config.yaml
+    """
+    if 'index' not in yaml_vars['bigquery']['dedup_mode'].values():
+        return None
+    index_vars = yaml_vars['id_index']
+    return IdIndex(index_vars['path'], index_vars['max_age_hours'], index_vars['bloom'])
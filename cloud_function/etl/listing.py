@@ -0,0 +1,141 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+
+def _list_pages(bucket, prefix, start_after=None):
+    """
+    Devuelve un iterador de las páginas de list_objects_v2 de un prefijo. Cada next() es una petición.
+    """
+    paginator = bucket.meta.client.get_paginator('list_objects_v2')
+    kwargs = {'Bucket': bucket.name, 'Prefix': prefix}
+    if start_after:
+        kwargs['StartAfter'] = start_after
+    return iter(paginator.paginate(**kwargs))
+
+def list_objects(bucket, prefix, start_after=None):
+    """
+    Lista los objetos de un prefijo del bucket, página a página.
+    Devuelve los diccionarios de list_objects_v2 (Key, ETag, LastModified, Size...).
+
+    Parámetros:
+    - bucket: s3 bucket
+    - prefix: str prefijo a listar
+    - start_after: str opcional, se listan sólo las keys posteriores a esta
+    """
+    for page in _list_pages(bucket, prefix, start_after):
+        for obj in page.get('Contents', []):
+            yield obj
+
+def list_prefixes(bucket, prefix, delimiter='/'):
+    """
+    Lista los "subdirectorios" inmediatos de un prefijo (CommonPrefixes de list_objects_v2),
+    sin recorrer los objetos que contienen.
+
+    Parámetros:
+    - bucket: s3 bucket
+    - prefix: str prefijo a listar, terminado en el delimitador
+    - delimiter: str separador de niveles de las keys
+    """
+    paginator = bucket.meta.client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket.name, Prefix=prefix, Delimiter=delimiter):
+        for common_prefix in page.get('CommonPrefixes', []):
+            yield common_prefix['Prefix']
+
+def _list_level(bucket, prefix, delimiter='/', start_after=None):
+    """
+    Lista un nivel de un prefijo: devuelve (objetos que cuelgan directamente de él, subprefijos).
+    Si no tiene subprefijos, los objetos son ya el listado completo del prefijo.
+    """
+    paginator = bucket.meta.client.get_paginator('list_objects_v2')
+    kwargs = {'Bucket': bucket.name, 'Prefix': prefix, 'Delimiter': delimiter}
+    if start_after:
+        kwargs['StartAfter'] = start_after
+    objs, prefixes = [], []
+    for page in paginator.paginate(**kwargs):
+        objs.extend(page.get('Contents', []))
+        prefixes.extend(common_prefix['Prefix'] for common_prefix in page.get('CommonPrefixes', []))
+    return objs, prefixes
+
+def _skip_prefix(prefix, start_after):
+    """
+    Indica si todas las keys de un prefijo son anteriores a start_after y no hace falta listarlo.
+    """
+    return start_after is not None and start_after > prefix and not start_after.startswith(prefix)
+
+def _start_after_in(prefix, start_after):
+    """
+    Devuelve start_after si cae dentro del prefijo (hay que listarlo a partir de ella), o None.
+    """
+    return start_after if start_after and start_after.startswith(prefix) else None
+
+def split_prefix(bucket, prefix, executor, depth=3, start_after=None):
+    """
+    Divide un prefijo en subprefijos disjuntos bajando hasta depth niveles (año/mes/día) con
+    listados por delimitador. Los niveles se descubren en paralelo: todos los prefijos de un mismo
+    nivel se listan a la vez. Devuelve (objetos ya listados, subprefijos ordenados que quedan por listar).
+    Los objetos ya listados son los sueltos de los niveles intermedios y los de los prefijos que no
+    tienen más niveles, que no se vuelven a listar. Si el prefijo no tiene subniveles devuelve
+    (sus objetos, []).
+
+    Parámetros:
+    - bucket: s3 bucket
+    - prefix: str prefijo a dividir, terminado en '/'
+    - executor: concurrent.futures.ThreadPoolExecutor con el que se lanzan los listados
+    - depth: int niveles que se bajan como máximo
+    - start_after: str opcional, se descartan los objetos y subprefijos cuyas keys son todas anteriores
+    """
+    listed, prefixes = [], [prefix]
+    for _ in range(depth):
+        if not prefixes:
+            break
+        levels = list(executor.map(lambda p: _list_level(bucket, p, start_after=_start_after_in(p, start_after)), prefixes))
+        next_prefixes = []
+        for objs, sub in levels:
+            listed.extend(obj for obj in objs if start_after is None or obj['Key'] > start_after)
+            next_prefixes.extend(p for p in sub if not _skip_prefix(p, start_after))
+        prefixes = sorted(next_prefixes)
+    return sorted(listed, key=lambda obj: obj['Key']), prefixes
+
+def list_objects_parallel(bucket, prefix, max_workers, start_after=None, depth=3):
+    """
+    Igual que list_objects, pero dividiendo el prefijo en subprefijos (ver split_prefix) que se
+    listan a la vez, de forma que el listado no está limitado a una página de 1000 keys por
+    petición. Las keys se devuelven en orden alfabético, como en un único listado: los subprefijos
+    son disjuntos y sus páginas se devuelven en orden. Cada subprefijo se lista página a página:
+    como mucho hay 2 * max_workers páginas pedidas o esperando a ser consumidas, nunca un
+    subprefijo entero en memoria.
+
+    Parámetros:
+    - bucket: s3 bucket
+    - prefix: str prefijo a listar
+    - max_workers: int listados simultáneos
+    - start_after: str opcional, se listan sólo las keys posteriores a esta
+    - depth: int niveles de la ruta por los que se divide (año/mes/día)
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        listed, prefixes = split_prefix(bucket, prefix, executor, depth, start_after)
+        remaining = iter(prefixes)
+
+        def submit_next_prefix(pending):
+            sub_prefix = next(remaining, None)
+            if sub_prefix is not None:
+                pages = _list_pages(bucket, sub_prefix, _start_after_in(sub_prefix, start_after))
+                pending.append((pages, executor.submit(next, pages, None)))
+
+        def ordered():
+            # Cola de (páginas de un subprefijo, petición en curso de su siguiente página), en orden
+            pending = deque()
+            for _ in range(2 * max_workers):
+                submit_next_prefix(pending)
+            while pending:
+                pages, future = pending.popleft()
+                page = future.result()
+                if page is None:
+                    # Subprefijo terminado: se empieza a listar el siguiente
+                    submit_next_prefix(pending)
+                    continue
+                # La siguiente página del subprefijo se pide antes de entregar esta
+                pending.appendleft((pages, executor.submit(next, pages, None)))
+                yield from page.get('Contents', [])
+
+        yield from heapq.merge(listed, ordered(), key=lambda obj: obj['Key'])
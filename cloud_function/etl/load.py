@@ -1,126 +1,47 @@
 from google.cloud import bigquery
+from datetime import datetime, timedelta, timezone
+import json
 import logging
+import re
+import threading
+import time
+import uuid
+from etl.query import run_query
+from etl.sources import get_source
 from etl.utils import print_error, print_success
 
+# Varias fuentes pueden apartar registros a la vez al mismo fichero de cuarentena
+_quarantine_lock = threading.Lock()
+
 def get_schema(dataset_id):
     """
-    Elige el esquema de la tabla de BQ según la fuente de datos que se vaya a cargar.
-    
+    Devuelve el esquema de la tabla de BQ de una fuente de datos, leído de su fichero json
+    (ver la sección sources del config.yaml y etl.sources).
+
     Parámetros:
     - dataset_id: str dataset de BQ
     """
-    if dataset_id=='tweet':
-        schema = [
-            bigquery.SchemaField("id", "STRING"),
-            bigquery.SchemaField("sentiment", "STRING"),
-            bigquery.SchemaField("categories", "RECORD", mode="REPEATED", fields=[
-                bigquery.SchemaField("id", "STRING"),
-                bigquery.SchemaField("name", "STRING"),
-            ]),
-            bigquery.SchemaField("feed", "RECORD", fields=[
-                bigquery.SchemaField("id", "STRING"),
-                bigquery.SchemaField("name", "STRING"),
-            ]),
-            bigquery.SchemaField("date", "TIMESTAMP"),
-            bigquery.SchemaField("msgId", "STRING"),
-            bigquery.SchemaField("type", "STRING"),
-            bigquery.SchemaField("media", "STRING"),
-            bigquery.SchemaField("text", "STRING"),
-            bigquery.SchemaField("user", "RECORD", fields=[
-                bigquery.SchemaField("id", "STRING"),
-                bigquery.SchemaField("username", "STRING"),
-                bigquery.SchemaField("name", "STRING"),
-                bigquery.SchemaField("followers", "INTEGER"),
-                bigquery.SchemaField("friends", "INTEGER"),
-                bigquery.SchemaField("gender", "STRING"),
-                bigquery.SchemaField("location", "RECORD", fields=[
-                    bigquery.SchemaField("country", "STRING"),
-                    bigquery.SchemaField("region", "STRING"),
-                    bigquery.SchemaField("subregion", "STRING"),
-                ]),
-            ]),
-            bigquery.SchemaField("link", "STRING"),
-            bigquery.SchemaField("parentId", "STRING")
-        ]
-        return schema
-    
-    elif dataset_id=='youtubecomment':
-
-        schema = [
-            bigquery.SchemaField("id", "STRING", mode="REQUIRED"),
-            bigquery.SchemaField("sentiment", "STRING", mode="NULLABLE"),
-            bigquery.SchemaField(
-                "categories", "RECORD", mode="REPEATED",
-                fields=[
-                    bigquery.SchemaField("id", "STRING", mode="NULLABLE"),
-                    bigquery.SchemaField("name", "STRING", mode="NULLABLE"),
-                ],
-            ),
-            bigquery.SchemaField(
-                "feed", "RECORD", mode="NULLABLE",
-                fields=[
-                    bigquery.SchemaField("id", "STRING", mode="NULLABLE"),
-                    bigquery.SchemaField("name", "STRING", mode="NULLABLE"),
-                ],
-            ),
-            bigquery.SchemaField("date", "TIMESTAMP", mode="NULLABLE"),
-            bigquery.SchemaField("msgId", "STRING", mode="NULLABLE"),
-            bigquery.SchemaField("type", "STRING", mode="NULLABLE"),
-            bigquery.SchemaField("text", "STRING", mode="NULLABLE"),
-            bigquery.SchemaField(
-                "user", "RECORD", mode="NULLABLE",
-                fields=[
-                    bigquery.SchemaField("id", "STRING", mode="NULLABLE"),
-                    bigquery.SchemaField("username", "STRING", mode="NULLABLE"),
-                    bigquery.SchemaField("gender", "STRING", mode="NULLABLE"),
-                ],
-            ),
-            bigquery.SchemaField("link", "STRING", mode="NULLABLE"),
-        ]
-        return schema
-
-    else:
-        msg = f'No se ha definido ningún esquema para {dataset_id}'
-        logging.critical(msg)
-        raise(msg)
-
-def get_table_id(dataset_id, yaml_vars):
+    return get_source(dataset_id).schema
+
+def get_table_id(dataset_id):
     """
-    Según la fuente de datos que estemos cargando, elige la tabla de destino.
+    Según la fuente de datos que estemos cargando, elige la tabla de destino (raw_table de la fuente
+    en el config.yaml).
 
     Parámetros:
     - dataset_id: str dataset de BQ
-    - yaml_vars: dict variables del config.yaml
     """
-    if dataset_id=='tweet':
-        table_id = yaml_vars['bigquery']['raw_tweet_table']
-    elif dataset_id=='youtubecomment':
-        table_id = yaml_vars['bigquery']['raw_yt_comment_table']
-    else:
-        msg = f'No se ha definido ningún table_id para {dataset_id}. Revisar load.py'
-        logging.critical(msg)
-        raise(msg)
-    return table_id
-
-def upload_raw_data(data, project_id, dataset_id, table_id, bq_client):
+    return get_source(dataset_id).table_id
+
+def create_raw_table(table_ref, schema, bq_client):
     """
-    Sube los datos a BQ. Se crea la tabla antes si no existe.
+    Crea la tabla raw en BQ si no existe, particionada por día y clusterizada por sentiment.
 
     Parámetros:
-    - data: list con los jsons a subir
-    - project_id: str proyecto de BQ
-    - dataset_id: str dataset en BQ
-    - table_id: str tabla en BQ
+    - table_ref: bigquery.TableReference tabla a crear
+    - schema: list de bigquery.SchemaField
     - bq_client: google.cloud.bigquery.client.Client
     """
-    # Seleccionamos el esquema de BQ
-    schema = get_schema(dataset_id)
-
-    # Construir la referencia completa de la tabla
-    table_full_id = f"{project_id}.{dataset_id}.{table_id}"
-    table_ref = bigquery.TableReference.from_string(table_full_id)
-    write_disposition = 'WRITE_APPEND'
-
     # Comprobar si la tabla existe
     try:
         bq_client.get_table(table_ref)
@@ -145,24 +66,264 @@ def upload_raw_data(data, project_id, dataset_id, table_id, bq_client):
             bq_client.create_table(table)
 
         except Exception as e:
-            msg = f'No se ha podido crear la tabla {table_full_id}: {e}'
+            msg = f'No se ha podido crear la tabla {table_ref}: {e}'
             logging.error(msg)
             print_error(msg)
 
-    # Subir el DataFrame a BigQuery con el esquema definido
+def start_load_job(data, table_ref, schema, bq_client, write_disposition='WRITE_APPEND', load_format='json', compression='snappy',
+                   transform_engine='python'):
+    """
+    Lanza el job de carga de una lista de registros en una tabla de BQ y devuelve el job.
+    Con load_format='parquet' los registros se convierten a Arrow y se suben como Parquet comprimido,
+    que ocupa menos que el NDJSON y BQ carga los campos anidados de forma nativa. Si la conversión
+    falla se sube como json.
+
+    Parámetros:
+    - data: list con los jsons a subir
+    - table_ref: bigquery.TableReference tabla de destino
+    - schema: list de bigquery.SchemaField
+    - bq_client: google.cloud.bigquery.client.Client
+    - write_disposition: str 'WRITE_APPEND' o 'WRITE_TRUNCATE'
+    - load_format: str 'json' o 'parquet'
+    - compression: str compresión del parquet
+    - transform_engine: str 'arrow' si los registros llegan sin limpiar (ver etl.extract.extract)
+    """
+    if load_format == 'parquet':
+        try:
+            # pyarrow sólo se importa si se carga en parquet
+            from etl.columnar import clean_table, records_to_arrow, to_parquet_buffer
+            table = records_to_arrow(data, schema)
+            if transform_engine == 'arrow':
+                table = clean_table(table, get_source(table_ref.dataset_id).strip_brackets)
+            buffer = to_parquet_buffer(table, compression)
+        except Exception as e:
+            msg = f'No se han podido convertir los registros a parquet, se suben como json: {e}'
+            logging.warning(msg)
+            print_error(msg)
+        else:
+            parquet_options = bigquery.ParquetOptions()
+            parquet_options.enable_list_inference = True    # Las listas se cargan como campos REPEATED
+            job_config = bigquery.LoadJobConfig(source_format=bigquery.SourceFormat.PARQUET,
+                                                parquet_options=parquet_options,
+                                                write_disposition=write_disposition)
+            return bq_client.load_table_from_file(buffer, table_ref, job_config=job_config)
+
+    # En json los registros sin limpiar se limpian uno a uno
+    if transform_engine == 'arrow':
+        data = get_source(table_ref.dataset_id).clean_records(data)
+    job_config = bigquery.LoadJobConfig(schema=schema,
+                                        autodetect=False,
+                                        write_disposition=write_disposition)
+    return bq_client.load_table_from_json(data, table_ref, job_config=job_config)
+
+def quarantine_rows(bad_rows, table_ref, quarantine_path):
+    """
+    Añade de una vez al fichero de cuarentena (NDJSON, una línea por registro) los registros que
+    BQ ha rechazado, con el error y la tabla de destino, para revisarlos y recargarlos a mano.
+    Cada id se escribe además en el log.
+
+    Parámetros:
+    - bad_rows: list de (registro, error)
+    - table_ref: bigquery.TableReference tabla de destino
+    - quarantine_path: str fichero de cuarentena
+    """
+    quarantined_at = datetime.now(timezone.utc).isoformat()
+    lines = [json.dumps({'table': str(table_ref), 'quarantined_at': quarantined_at, 'error': error, 'row': row},
+                        ensure_ascii=False, default=str)
+             for row, error in bad_rows]
+    with _quarantine_lock, open(quarantine_path, 'a', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n')
+
+    for row, error in bad_rows:
+        logging.error(f'Registro {row.get("id")} apartado a {quarantine_path}: {error}')
+    msg = f'{len(bad_rows)} registros rechazados por BQ apartados a {quarantine_path}'
+    logging.warning(msg)
+    print_error(msg)
+
+# Errores de carga que se deben a registros concretos (un json o parquet mal formado, un valor que
+# no encaja con el tipo del esquema o un campo que no existe). El resto (esquema de la tabla, cuotas,
+# errores 5xx) afectan al lote entero y no se arreglan partiéndolo
+_ROW_ERROR = re.compile(r'pars|in row|Error while reading data|Could not convert|Invalid (?:timestamp|date|datetime|value)|'
+                        r'No such field|Missing required field|out of range', re.I)
+_TABLE_ERROR = re.compile(r'Provided Schema does not match|Cannot add fields|Cannot change|Not found: (?:Table|Dataset)', re.I)
+
+def is_row_error(e):
+    """
+    Indica si el error de una carga se debe a registros concretos del lote, de forma que tiene
+    sentido buscarlos por bisección: un BadRequest con un mensaje de registro mal formado.
+
+    Parámetros:
+    - e: Exception error de la carga (el de job.result())
+    """
+    from google.api_core.exceptions import BadRequest
+    if not isinstance(e, BadRequest):
+        return False
+    messages = [str(e)] + [error.get('message', '') for error in getattr(e, 'errors', None) or []]
+    return not any(_TABLE_ERROR.search(m) for m in messages) and any(_ROW_ERROR.search(m) for m in messages)
+
+def isolate_bad_rows(data, table_ref, schema, bq_client, load_format='json', compression='snappy', transform_engine='python',
+                     max_jobs=64, metrics=None):
+    """
+    Busca por bisección los registros de un lote que hacen fallar la carga: se cargan mitades del
+    lote en una tabla de prueba temporal y se siguen partiendo sólo las que fallan, hasta llegar a
+    los registros sueltos. Con k registros erróneos hacen falta del orden de k*log2(n) cargas.
+    Devuelve (registros buenos, [(registro malo, error)]), o None si hacen falta más de max_jobs cargas.
+    Si una carga de prueba falla con un error que no es de registros (ver is_row_error: esquema,
+    cuotas, 5xx) se deja de partir y se lanza ese error, ya que fallarían igual las dos mitades.
+
+    Parámetros:
+    - data: list con los jsons del lote que ha fallado
+    - table_ref: bigquery.TableReference tabla de destino (la de prueba se crea a su lado)
+    - schema: list de bigquery.SchemaField
+    - bq_client: google.cloud.bigquery.client.Client
+    - load_format: str 'json' o 'parquet'
+    - compression: str compresión del parquet
+    - transform_engine: str 'python' o 'arrow' (ver start_load_job)
+    - max_jobs: int número máximo de cargas de prueba
+    - metrics: etl.metrics.RunMetrics opcional, se apuntan las cargas de prueba en la etapa 'load_probe'
+    """
+    probe_ref = bigquery.TableReference.from_string(f'{table_ref}_probe_{uuid.uuid4().hex[:12]}')
+    probe = bigquery.Table(probe_ref, schema=schema)
+    probe.expires = datetime.now(timezone.utc) + timedelta(hours=1)
+    bq_client.create_table(probe)
+
+    good, bad, jobs = [], [], 0
+    # El lote entero ya ha fallado: se empieza por sus dos mitades
+    pending = [data[len(data) // 2:], data[:len(data) // 2]]
+    try:
+        while pending:
+            rows = pending.pop()
+            if not rows:
+                continue
+            if jobs >= max_jobs:
+                return None
+            jobs += 1
+            start = time.perf_counter()
+            try:
+                start_load_job(rows, probe_ref, schema, bq_client, 'WRITE_TRUNCATE', load_format, compression, transform_engine).result()
+                good.extend(rows)
+            except Exception as e:
+                if not is_row_error(e):
+                    raise
+                if len(rows) == 1:
+                    bad.append((rows[0], str(e)))
+                else:
+                    pending.extend([rows[len(rows) // 2:], rows[:len(rows) // 2]])
+            if metrics:
+                metrics.add('load_probe', time.perf_counter() - start, len(rows))
+    finally:
+        bq_client.delete_table(probe_ref, not_found_ok=True)
+    return good, bad
+
+def load_rows(data, table_ref, schema, bq_client, write_disposition='WRITE_APPEND', load_format='json', compression='snappy',
+              transform_engine='python', metrics=None, quarantine_path=None, max_bisect_jobs=64):
+    """
+    Carga un lote en una tabla de BQ con un único job y espera a que termine. Si la carga falla por
+    registros concretos (ver is_row_error) y se indica quarantine_path, se aíslan los registros
+    erróneos (ver isolate_bad_rows), se apartan al fichero de cuarentena y el resto se carga de nuevo
+    con un único job.
+    Devuelve la lista de registros cargados; si no se ha podido cargar lanza la excepción de la carga.
+
+    Parámetros:
+    - data: list con los jsons a subir
+    - table_ref: bigquery.TableReference tabla de destino
+    - schema: list de bigquery.SchemaField
+    - bq_client: google.cloud.bigquery.client.Client
+    - write_disposition: str 'WRITE_APPEND' o 'WRITE_TRUNCATE'
+    - load_format: str 'json' o 'parquet'
+    - compression: str compresión del parquet
+    - transform_engine: str 'python' o 'arrow' (ver start_load_job)
+    - metrics: etl.metrics.RunMetrics opcional, se apunta el job en la etapa 'load_job'
+    - quarantine_path: str opcional, fichero de cuarentena; sin él un error hace fallar todo el lote
+    - max_bisect_jobs: int número máximo de cargas de prueba para aislar los registros erróneos
+    """
     try:
-        job_config = bigquery.LoadJobConfig(schema=schema,
-                                            autodetect=False,
-                                            write_disposition=write_disposition) #Añadimos las nuevas filas
-        job = bq_client.load_table_from_json(data, table_ref, job_config=job_config)
+        start = time.perf_counter()
+        job = start_load_job(data, table_ref, schema, bq_client, write_disposition, load_format, compression, transform_engine)
+        job.result()
+    except Exception as e:
+        # Sólo se buscan los registros erróneos si el error es de registros: los del lote entero
+        # (esquema, cuotas, 5xx) se lanzan y el lote se reintenta en la siguiente ejecución
+        if not quarantine_path or not is_row_error(e):
+            raise
+        msg = f'Error al cargar {len(data)} registros en {table_ref}, se buscan los registros erróneos: {e}'
+        logging.warning(msg)
+        print_error(msg)
+        isolated = isolate_bad_rows(data, table_ref, schema, bq_client, load_format, compression, transform_engine,
+                                    max_bisect_jobs, metrics)
+        if isolated is None:
+            logging.error(f'No se han podido aislar los registros erróneos en {max_bisect_jobs} cargas')
+            raise
+        data, bad_rows = isolated
+        if bad_rows:
+            quarantine_rows(bad_rows, table_ref, quarantine_path)
+        if not data:
+            return data
+        start = time.perf_counter()
+        job = start_load_job(data, table_ref, schema, bq_client, write_disposition, load_format, compression, transform_engine)
         job.result()
+
+    if metrics:
+        metrics.add_job('load_job', job, time.perf_counter() - start, len(data))
+    return data
+
+def upload_raw_data(data, project_id, dataset_id, table_id, bq_client, load_format='json', compression='snappy', metrics=None,
+                    transform_engine='python', quarantine_path=None, max_bisect_jobs=64):
+    """
+    Sube los datos a BQ. Se crea la tabla antes si no existe.
+    Con quarantine_path los registros que BQ rechaza se apartan a cuarentena y se carga el resto
+    (ver load_rows); data se actualiza para quedarse sólo con los registros cargados.
+
+    Parámetros:
+    - data: list con los jsons a subir
+    - project_id: str proyecto de BQ
+    - dataset_id: str dataset en BQ
+    - table_id: str tabla en BQ
+    - bq_client: google.cloud.bigquery.client.Client
+    - load_format: str 'json' (NDJSON) o 'parquet'
+    - compression: str compresión del parquet
+    - metrics: etl.metrics.RunMetrics opcional, se apunta el job en la etapa 'load_job'
+    - transform_engine: str 'python' o 'arrow' (ver start_load_job)
+    - quarantine_path: str opcional, fichero de cuarentena de los registros rechazados
+    - max_bisect_jobs: int número máximo de cargas de prueba para aislar los registros rechazados
+
+    Devuelve True si la carga ha terminado correctamente.
+    """
+    # Seleccionamos el esquema de BQ
+    schema = get_schema(dataset_id)
+
+    # Construir la referencia completa de la tabla
+    table_full_id = f"{project_id}.{dataset_id}.{table_id}"
+    table_ref = bigquery.TableReference.from_string(table_full_id)
+    write_disposition = 'WRITE_APPEND'
+
+    # Crear la tabla si no existe
+    create_raw_table(table_ref, schema, bq_client)
+
+    # Subir los datos a BigQuery con el esquema definido
+    try:
+        data[:] = load_rows(data, table_ref, schema, bq_client, write_disposition, load_format, compression,
+                            transform_engine, metrics, quarantine_path, max_bisect_jobs) #Añadimos las nuevas filas
         print_success(f'{len(data)} registros subidos a {table_ref}')
+        return True
     except Exception as e:
         msg = f"Error al cargar datos en BigQuery: {e}"
         logging.error(msg)
         print_error(msg)
+        return False
+
+def dates_to_sql(date_list):
+    """
+    Convierte una lista de fechas en la lista de TIMESTAMP que se usa en los filtros por día de las queries.
+
+    Parámetros:
+    - date_list: list fechas en formato YYYY-MM-DD (o YYYY/MM/DD)
+    """
+    date_list_str = [date.replace('/', '-') for date in date_list]
+    date_list_str = ['TIMESTAMP("' + i + '")' for i in date_list_str]
+    return ', '.join(date_list_str)
 
-def check_unique(all_data, check_list, bq_client, col_to_check, date_list, project_id, dataset_id, table_id):
+def check_unique(all_data, check_list, bq_client, col_to_check, date_list, project_id, dataset_id, table_id, metrics=None, budget=None):
     """
     Para evitar duplicidades, chequea si los valores de una lista ya existen en BBDD.
     
@@ -175,12 +336,14 @@ def check_unique(all_data, check_list, bq_client, col_to_check, date_list, proje
     - project_id: str proyecto de BQ
     - dataset_id: str dataset en BQ
     - table_id: str tabla en BQ
+    - metrics: etl.metrics.RunMetrics opcional, se apunta la query en la etapa 'dedup_query'
+    - budget: etl.query.QueryBudget opcional, presupuesto de bytes de la ejecución. La query ya lee sólo
+      las particiones del lote, así que si no cabe se rechaza (BudgetExceededException) y el lote se
+      reintenta en la siguiente ejecución
     """
     # Arreglamos el formato de la fecha para la query
-    date_list_str = [date.replace('/', '-') for date in date_list]
-    date_list_str = ['TIMESTAMP("' + i + '")' for i in date_list_str]
-    date_list_str = ', '.join(date_list_str)
-        
+    date_list_str = dates_to_sql(date_list)
+
     # Lanzamos la query para obtener los ids que ya existen en BQ
     query = f"""
     SELECT {col_to_check}
@@ -188,176 +351,86 @@ def check_unique(all_data, check_list, bq_client, col_to_check, date_list, proje
     WHERE TIMESTAMP_TRUNC(date, DAY) IN ({date_list_str})
     """
     try:
-        query_job = bq_client.query(query)
+        start = time.perf_counter()
+        query_job = run_query(bq_client, query, budget, metrics, 'dedup_query')
         results = query_job.result()
+        id_set = {row[0] for row in results}
     except Exception as e:
         logging.critical(e)
         raise(e)
-    
-    id_set = {row[0] for row in results}
+    if metrics:
+        metrics.add_job('dedup_query', query_job, time.perf_counter() - start, len(check_list))
 
     # Nos quedamos con los registros cuyos ids no están en BQ
     upload_set = set(check_list) - id_set
     data_to_upload = [i for i in all_data if i[col_to_check] in upload_set]
     return data_to_upload
 
-def daily_cat_table(project_id, dataset_id, table_id_raw, bq_client):
+def merge_raw_data(data, project_id, dataset_id, table_id, bq_client, col_to_check, date_list, load_format='json', compression='snappy', metrics=None,
+                   transform_engine='python', quarantine_path=None, max_bisect_jobs=64, budget=None):
     """
-    Crea una tabla en BQ con el número de categorías por día.
+    Deduplicado en el lado de BQ: sube el lote a una tabla temporal de staging y lanza un único
+    MERGE ... WHEN NOT MATCHED THEN INSERT sobre la tabla raw. Así no hace falta descargar los ids
+    que ya existen en BQ. La tabla de staging se borra al terminar (y caduca sola en una hora).
 
     Parámetros:
+    - data: list con los jsons a subir
     - project_id: str proyecto de BQ
     - dataset_id: str dataset en BQ
-    - table_id_raw: str tabla raw en BQ
+    - table_id: str tabla en BQ
     - bq_client: google.cloud.bigquery.client.Client
-    """
-    # Se obtiene el table_id según la fuente de datos a cargar
-    if dataset_id=='tweet':
-        full_table_id  = f'{project_id}.{dataset_id}.daily_cat_tweet'
-        full_table_id_raw = f'{project_id}.{dataset_id}.{table_id_raw}'
-    elif dataset_id=='youtubecomment':
-        full_table_id  = f'{project_id}.{dataset_id}.daily_cat_youtubecomment'
-        full_table_id_raw = f'{project_id}.{dataset_id}.{table_id_raw}'
-
-    # Agregación: num categorías por día
-    query = f"""
-    CREATE OR REPLACE TABLE `{full_table_id}` 
-    CLUSTER BY date
-    AS
-    SELECT
-    DATE(date) AS date,
-    category.name AS category_name,
-    COUNT(DISTINCT t.id) AS count
-    FROM
-    `{full_table_id_raw}` t,
-    UNNEST(t.categories) AS category
-    GROUP BY
-    date,
-    category_name
-    """
-    try:
-        query_job = bq_client.query(query)
-        query_job.result()
-
-        msg = f'Tabla {full_table_id} actualizada'
-        logging.info(msg)
-        print(msg)
-    except Exception as e:
-        logging.error(e)
-        print_error(e)
+    - col_to_check: str columna a comprobar su unicidad
+    - date_list: list fechas de los datos que se están subiendo
+    - load_format: str 'json' o 'parquet'
+    - compression: str compresión del parquet
+    - metrics: etl.metrics.RunMetrics opcional, se apuntan la carga ('load_job') y el MERGE ('merge_query')
+    - transform_engine: str 'python' o 'arrow' (ver start_load_job)
+    - quarantine_path: str opcional, los registros que BQ rechaza al cargar la tabla de staging se
+      apartan a este fichero y se sigue con el resto (ver load_rows)
+    - max_bisect_jobs: int número máximo de cargas de prueba para aislar los registros rechazados
+    - budget: etl.query.QueryBudget opcional, presupuesto de bytes de la ejecución; si el MERGE no cabe, el lote
+      no se carga y se reintenta en la siguiente ejecución
 
-def daily_country_table(project_id, dataset_id, table_id_raw, bq_client):
+    Devuelve True si el MERGE ha terminado correctamente.
     """
-    Crea una tabla en BQ con el número de países por día.
+    schema = get_schema(dataset_id)
+    table_ref = bigquery.TableReference.from_string(f"{project_id}.{dataset_id}.{table_id}")
+    staging_ref = bigquery.TableReference.from_string(f"{project_id}.{dataset_id}.{table_id}_staging_{uuid.uuid4().hex[:12]}")
+    create_raw_table(table_ref, schema, bq_client)
 
-    Parámetros:
-    - project_id: str proyecto de BQ
-    - dataset_id: str dataset en BQ
-    - table_id_raw: str tabla raw en BQ
-    - bq_client: google.cloud.bigquery.client.Client
-    """
-    # Se obtiene el table_id según la fuente de datos a cargar
-    if dataset_id=='tweet':
-        full_table_id  = f'{project_id}.{dataset_id}.daily_country_tweet'
-        full_table_id_raw = f'{project_id}.{dataset_id}.{table_id_raw}'
-    elif dataset_id=='youtubecomment':
-        return
-
-    # Agregación: num categorías por día
-    query = f"""
-    CREATE OR REPLACE TABLE `{full_table_id}`
-    CLUSTER BY date
-    AS
-    SELECT
-    DATE(date) AS date,
-    user.location.country AS country,
-    COUNT(DISTINCT id) AS count
-    FROM
-    `{full_table_id_raw}`
-    GROUP BY
-    date,
-    country
-    """
     try:
-        query_job = bq_client.query(query)
-        query_job.result()
-
-        msg = f'Tabla {full_table_id} actualizada'
-        logging.info(msg)
-        print(msg)
-    except Exception as e:
-        logging.error(e)
-        print_error(e)
-
-def daily_sentiment_table(project_id, dataset_id, table_id_raw, bq_client):
-    """
-    Crea una tabla en BQ con el número de sentimientos por día.
+        # Tabla de staging con el lote
+        staging = bigquery.Table(staging_ref, schema=schema)
+        staging.expires = datetime.now(timezone.utc) + timedelta(hours=1)
+        bq_client.create_table(staging)
+        data = load_rows(data, staging_ref, schema, bq_client, 'WRITE_TRUNCATE', load_format, compression,
+                         transform_engine, metrics, quarantine_path, max_bisect_jobs)
 
-    Parámetros:
-    - project_id: str proyecto de BQ
-    - dataset_id: str dataset en BQ
-    - table_id_raw: str tabla raw en BQ
-    - bq_client: google.cloud.bigquery.client.Client
-    """
-    # Se obtiene el table_id según la fuente de datos a cargar
-    if dataset_id=='tweet':
-        full_table_id  = f'{project_id}.{dataset_id}.daily_sentiment_tweet'
-        full_table_id_raw = f'{project_id}.{dataset_id}.{table_id_raw}'
-    elif dataset_id=='youtubecomment':
-        full_table_id  = f'{project_id}.{dataset_id}.daily_sentimentyoutubecomment'
-        full_table_id_raw = f'{project_id}.{dataset_id}.{table_id_raw}'
-
-    # Agregación: num categorías por día
-    query = f"""
-    CREATE OR REPLACE TABLE `{full_table_id}`
-    CLUSTER BY date
-    AS
-    SELECT
-    DATE(date) AS date,
-    sentiment,
-    COUNT(DISTINCT id) AS count
-    FROM
-    `{full_table_id_raw}`
-    GROUP BY
-    date,
-    sentiment
-    """
-    try:
-        query_job = bq_client.query(query)
+        # Se insertan sólo los registros cuyo id no existe en los días afectados de la tabla raw
+        query = f"""
+        MERGE `{table_ref}` T
+        USING (
+            SELECT * FROM `{staging_ref}`
+            WHERE TRUE
+            QUALIFY ROW_NUMBER() OVER (PARTITION BY {col_to_check}) = 1
+        ) S
+        ON T.{col_to_check} = S.{col_to_check} AND TIMESTAMP_TRUNC(T.date, DAY) IN ({dates_to_sql(date_list)})
+        WHEN NOT MATCHED THEN INSERT ROW
+        """
+        start = time.perf_counter()
+        query_job = run_query(bq_client, query, budget, metrics, 'merge_query')
         query_job.result()
+        if metrics:
+            metrics.add_job('merge_query', query_job, time.perf_counter() - start, len(data))
 
-        msg = f'Tabla {full_table_id} actualizada'
+        msg = f'{query_job.num_dml_affected_rows} registros nuevos de {len(data)} subidos a {table_ref}'
+        print_success(msg)
         logging.info(msg)
-        print(msg)
-    except Exception as e:
-        logging.error(e)
-        print_error(e)
-
-def aggregated_tables(project_id, dataset_id, table_id_raw, bq_client):
-    """
-    Lanza varias queries para obtener resultados agregados por día.
-    
-    Parámetros:
-    - project_id: str proyecto de BQ
-    - dataset_id: str dataset en BQ
-    - table_id_raw: str tabla raw en BQ
-    - bq_client: google.cloud.bigquery.client.Client
-    """
-    # Tabla de recuento de categorías por día
-    try:
-        daily_cat_table(project_id, dataset_id, table_id_raw, bq_client)
-    except Exception as e:
-        logging.error(e)
-        print_error(e)
-    # Tabla de recuento de países por día
-    try:
-        daily_country_table(project_id, dataset_id, table_id_raw, bq_client)
+        return True
     except Exception as e:
-        logging.error(e)
-        print_error(e)
-    # Tabla de recuento de sentimiento por día
-    try:
-        daily_sentiment_table(project_id, dataset_id, table_id_raw, bq_client)
-    except Exception as e:
-        logging.error(e)
-        print_error(e)
+        msg = f"Error al cargar datos en BigQuery mediante MERGE: {e}"
+        logging.error(msg)
+        print_error(msg)
+        return False
+    finally:
+        bq_client.delete_table(staging_ref, not_found_ok=True)
@@ -0,0 +1,114 @@
+import json
+import logging
+import threading
+import time
+
+class RunMetrics:
+    """
+    Acumula, por etapa de la ETL, el tiempo, el número de elementos, los bytes y las estadísticas de
+    los jobs de BQ (bytes estimados con el dry run, bytes procesados y slot-ms). Es thread-safe: la comparten los hilos de descarga
+    y las fuentes que se procesan en paralelo.
+
+    El tiempo de cada etapa es la suma del tiempo de todas sus llamadas, así que en las etapas que
+    se ejecutan en varios hilos (p.ej. 'get') puede ser mayor que el tiempo real de la ejecución.
+
+    Parámetros:
+    - scope: str nombre de lo que se mide ('run' o la carpeta del bucket)
+    """
+    def __init__(self, scope='run'):
+        self.scope = scope
+        self.stages = {}
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+
+    def add(self, stage, seconds=0.0, items=0, nbytes=0, calls=1, bytes_processed=0, slot_ms=0, bytes_estimated=0):
+        """
+        Suma una o varias llamadas a una etapa.
+
+        Parámetros:
+        - stage: str nombre de la etapa
+        - seconds: float tiempo empleado
+        - items: int elementos procesados (objetos, registros, ids...)
+        - nbytes: int bytes leídos o enviados
+        - calls: int número de llamadas
+        - bytes_processed: int bytes procesados por BQ
+        - slot_ms: int milisegundos de slot consumidos en BQ
+        - bytes_estimated: int bytes que BQ estima que va a procesar (dry run)
+        """
+        with self._lock:
+            stats = self.stages.setdefault(stage, {'calls': 0, 'seconds': 0.0, 'items': 0, 'bytes': 0,
+                                                   'bytes_processed': 0, 'slot_ms': 0, 'bytes_estimated': 0})
+            stats['calls'] += calls
+            stats['seconds'] += seconds
+            stats['items'] += items
+            stats['bytes'] += nbytes
+            stats['bytes_processed'] += bytes_processed
+            stats['slot_ms'] += slot_ms
+            stats['bytes_estimated'] += bytes_estimated
+
+    def add_job(self, stage, job, seconds, items=0):
+        """
+        Suma un job de BQ ya terminado, con sus estadísticas.
+
+        Parámetros:
+        - stage: str nombre de la etapa
+        - job: job de BQ (QueryJob o LoadJob)
+        - seconds: float tiempo hasta que ha terminado
+        - items: int elementos que ha procesado
+        """
+        # Los jobs de carga no tienen total_bytes_processed, pero sí el tamaño de lo subido
+        self.add(stage, seconds, items,
+                 nbytes=getattr(job, 'input_file_bytes', None) or 0,
+                 bytes_processed=getattr(job, 'total_bytes_processed', None) or 0,
+                 slot_ms=getattr(job, 'slot_millis', None) or 0)
+
+    def timed_iter(self, stage, iterable):
+        """
+        Recorre un iterable midiendo sólo el tiempo que se tarda en obtener cada elemento
+        (p.ej. la espera por cada página del listado), sin contar lo que haga quien lo consume.
+        """
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(stage, time.perf_counter() - start)
+                return
+            self.add(stage, time.perf_counter() - start, items=1)
+            yield item
+
+    def merge(self, other):
+        """
+        Suma las etapas de otro RunMetrics (p.ej. las de una carpeta al total de la ejecución).
+        """
+        for stage, stats in list(other.stages.items()):
+            self.add(stage, stats['seconds'], stats['items'], stats['bytes'], stats['calls'],
+                     stats['bytes_processed'], stats['slot_ms'], stats['bytes_estimated'])
+
+    def summary(self):
+        """
+        Devuelve el resumen como diccionario, con el rendimiento (elementos/s y MB/s) de cada etapa.
+        """
+        with self._lock:
+            stages = {stage: dict(stats) for stage, stats in self.stages.items()}
+        for stats in stages.values():
+            seconds = stats['seconds']
+            stats['seconds'] = round(seconds, 4)
+            stats['items_per_second'] = round(stats['items'] / seconds, 1) if seconds > 0 and stats['items'] else None
+            stats['mb_per_second'] = round(stats['bytes'] / seconds / 2 ** 20, 2) if seconds > 0 and stats['bytes'] else None
+        return {
+            'metrics': 'etl',
+            'scope': self.scope,
+            'wall_seconds': round(time.perf_counter() - self._start, 4),
+            'stages': stages,
+        }
+
+    def log_summary(self):
+        """
+        Escribe el resumen en una sola línea json. Por la salida estándar, Cloud Logging la guarda
+        como jsonPayload y se puede filtrar y representar por campo.
+        """
+        line = json.dumps(self.summary(), ensure_ascii=False)
+        logging.info(line)
+        print(line)
@@ -0,0 +1,365 @@
+from etl.load import upload_raw_data, check_unique, merge_raw_data, get_table_id
+from etl.aggregate import aggregated_tables, AggregateDeltas
+from etl.extract import extract, extract_keys, get_folder_path, SkipFolderException, ReadErrorException
+from concurrent.futures import ThreadPoolExecutor
+from etl.utils import print_error, expand_date_to_upload
+from etl.metrics import RunMetrics
+import logging
+import time
+
+def run_folder(folder, yaml_vars, bucket, bq_client, state=None, id_index=None, metrics=None, date_to_upload=None, keys=None,
+               checkpoint=None, deadline=None, budget=None, aggregate_dates=None, deltas=None):
+    """
+    Ejecuta la ETL de una carpeta del bucket lote a lote: extracción, deduplicado y carga.
+    El deduplicado se hace según el modo configurado para la fuente en bigquery.dedup_mode.
+    Al terminar se actualizan las particiones de las tablas agregadas de los días con registros nuevos
+    (con aggregation_mode 'delta', sumando los conteos de los registros cargados en todos los lotes).
+    Devuelve True si todos los lotes han llegado a BQ y, con keys, si se han podido leer todas.
+
+    Parámetros:
+    - folder: str carpeta del bucket
+    - yaml_vars: dict variables del config.yaml
+    - bucket: s3 bucket
+    - bq_client: google.cloud.bigquery.client.Client
+    - state: etl.state.StateStore opcional
+    - id_index: etl.id_index.IdIndex, necesario si la fuente deduplica con el modo 'index'
+    - metrics: etl.metrics.RunMetrics opcional, donde se apunta el tiempo de cada etapa
+    - date_to_upload: str opcional, unidad a procesar ('all', 'today' o un día); por defecto la del config.yaml
+    - keys: list opcional, si se indica sólo se procesan esas keys de la carpeta, sin listar el bucket
+    - checkpoint: etl.checkpoint.Checkpoint opcional, punto de avance del prefijo, que se mueve con cada lote cargado
+    - deadline: etl.checkpoint.Deadline opcional, límite de tiempo de la ejecución
+    - budget: etl.query.QueryBudget opcional, presupuesto de bytes escaneados de la ejecución
+    - aggregate_dates: set opcional, si se indica los días de las tablas agregadas que hay que recalcular
+      se añaden aquí en lugar de recalcularlos, para hacerlo una sola vez por fuente (ver run_folders)
+    - deltas: etl.aggregate.AggregateDeltas opcional, junto con aggregate_dates: los conteos de los
+      registros cargados se acumulan ahí y los suma quien lo ha creado, una sola vez por fuente
+    """
+    project_id = yaml_vars['env-vars']['project_id']
+    date_to_upload = date_to_upload or yaml_vars['env-vars']['date_to_upload']
+    extract_vars = yaml_vars['extract']
+    load_format = yaml_vars['bigquery']['load_format']
+    compression = yaml_vars['bigquery']['parquet_compression']
+    transform_engine = extract_vars['transform_engine']
+    # Con load_mode 'bisect' los registros que BQ rechaza se apartan a cuarentena y se carga el resto
+    quarantine_path = yaml_vars['bigquery']['quarantine_path'] if yaml_vars['bigquery']['load_mode'] == 'bisect' else None
+    max_bisect_jobs = yaml_vars['bigquery']['max_bisect_jobs']
+    dedup_mode = yaml_vars['bigquery']['dedup_mode'][folder]
+
+    col_to_check = 'id'
+    dataset_id = folder.lower()
+    table_id_raw = get_table_id(dataset_id)
+
+    # Con 'delta' las tablas agregadas se actualizan con los conteos de los lotes cargados, sin leer la
+    # raw. Si la unidad recalcula sus propios agregados, también los suma ella al terminar
+    if aggregate_dates is None:
+        deltas = _folder_deltas(folder, yaml_vars)
+    # Los conteos sólo son correctos si los ids de verdad son nuevos en BQ: el índice de ids vuelve a
+    # leer de BQ los días de la unidad aunque su copia no haya caducado (ver IdIndex.check_unique)
+    since = time.time() if deltas else None
+
+    # Cerca del límite de tiempo no se empieza la unidad; la siguiente ejecución la procesará
+    if deadline and deadline.expired():
+        msg = f'Límite de tiempo alcanzado, la fuente {folder} ({date_to_upload}) queda para la siguiente ejecución'
+        logging.warning(msg)
+        print_error(msg)
+        return False
+
+    print(f'Extrayendo datos de la fuente {folder}')
+    if keys is not None:
+        # Las keys de una notificación no siguen el orden del listado, no hay punto de avance
+        checkpoint = None
+        batches = extract_keys(keys, folder, bucket,
+                               max_workers=extract_vars['max_workers'],
+                               batch_size=extract_vars['batch_size'],
+                               max_batch_mb=extract_vars['max_batch_mb'],
+                               json_backend=extract_vars['json_backend'],
+                               metrics=metrics,
+                               transform_engine=transform_engine)
+    else:
+        batches = extract(date_to_upload, folder, bucket,
+                          max_workers=extract_vars['max_workers'],
+                          state=state,
+                          batch_size=extract_vars['batch_size'],
+                          max_batch_mb=extract_vars['max_batch_mb'],
+                          json_backend=extract_vars['json_backend'],
+                          metrics=metrics,
+                          list_workers=extract_vars['list_workers'],
+                          transform_engine=transform_engine,
+                          checkpoint=checkpoint,
+                          deadline=deadline)
+        folder_path = get_folder_path(date_to_upload, folder)
+    uploaded_any = False
+    uploaded_all = True
+    touched_dates = set()
+    try:
+        for all_data, check_list, date_list in batches:
+            if dedup_mode == 'merge':
+                # Deduplicado en BQ mediante staging + MERGE
+                uploaded = merge_raw_data(all_data, project_id, dataset_id, table_id_raw, bq_client, col_to_check, date_list, load_format, compression, metrics, transform_engine,
+                                          quarantine_path, max_bisect_jobs, budget)
+                uploaded_any = uploaded_any or uploaded
+            else:
+                # Subimos los datos a BQ. Subimos sólo los registros nuevos, si los hay, para garantizar la idempotencia del sistema
+                if dedup_mode == 'index':
+                    data_to_upload = id_index.check_unique(all_data, bq_client, col_to_check, date_list, project_id, dataset_id, table_id_raw, metrics, budget,
+                                                           since)
+                else:
+                    data_to_upload = check_unique(all_data, check_list, bq_client, col_to_check, date_list, project_id, dataset_id, table_id_raw, metrics, budget)
+                if len(data_to_upload)==0:
+                    msg = 'Todos los registros a cargar ya existen en BQ'
+                    print(msg)
+                    logging.info(msg)
+                    uploaded = True
+                else:
+                    uploaded = upload_raw_data(data_to_upload, project_id, dataset_id, table_id_raw, bq_client, load_format, compression, metrics, transform_engine,
+                                           quarantine_path, max_bisect_jobs)
+                    uploaded_any = uploaded_any or uploaded
+                    if uploaded and id_index:
+                        id_index.add(dataset_id, data_to_upload, col_to_check)
+                    # data_to_upload son ya sólo los registros que han llegado a BQ (sin los de cuarentena)
+                    if uploaded and deltas:
+                        deltas.add(data_to_upload)
+
+            uploaded_all = uploaded_all and uploaded
+            if uploaded:
+                touched_dates.update(date_list)
+
+            # Sólo se da el lote por procesado si ha llegado a BQ
+            if state and uploaded:
+                state.commit(folder, folder_path)
+            elif state:
+                state.discard(folder, folder_path)
+            if checkpoint and uploaded:
+                checkpoint.commit(folder_path)
+            elif checkpoint:
+                checkpoint.discard(folder_path)
+    except SkipFolderException as e:
+        print(e)
+        if state:
+            state.commit(folder, folder_path)
+        if checkpoint:
+            checkpoint.commit(folder_path)
+            _finish_checkpoint(checkpoint, folder_path, deadline)
+        return True
+    except ReadErrorException as e:
+        # Alguna key de una notificación no se ha podido leer: se da por fallida para que se reintente
+        logging.error(e)
+        print_error(e)
+        uploaded_all = False
+    finally:
+        # Se recalculan sólo los días afectados por los datos de esta ejecución (con 'delta', sólo si
+        # no se han podido sumar los conteos). También si un lote ha fallado a mitad (p.ej. una query
+        # que no cabe en el presupuesto): los lotes anteriores ya están en BQ y una ejecución
+        # posterior sin datos nuevos de esos días no los volvería a recalcular
+        recompute_dates = touched_dates if uploaded_any and deltas is None else set()
+        if aggregate_dates is not None:
+            aggregate_dates.update(recompute_dates)
+        else:
+            if deltas:
+                recompute_dates = _flush_deltas(deltas, bq_client, metrics, budget)
+            if recompute_dates:
+                refresh_aggregates(folder, yaml_vars, bq_client, recompute_dates, metrics, budget)
+
+    if checkpoint:
+        _finish_checkpoint(checkpoint, folder_path, deadline)
+    return uploaded_all
+
+def _folder_deltas(folder, yaml_vars):
+    """
+    Devuelve el etl.aggregate.AggregateDeltas de una fuente si sus tablas agregadas se actualizan con
+    los conteos de los lotes (aggregation_mode 'delta'), o None si se recalculan desde la raw. Con el
+    deduplicado 'merge' no se sabe qué registros son nuevos, y se recalculan como siempre.
+
+    Parámetros:
+    - folder: str carpeta del bucket
+    - yaml_vars: dict variables del config.yaml
+    """
+    if yaml_vars['bigquery']['aggregation_mode'] != 'delta' or yaml_vars['bigquery']['dedup_mode'][folder] == 'merge':
+        return None
+    deltas = AggregateDeltas(yaml_vars['env-vars']['project_id'], folder.lower())
+    if not deltas.supported:
+        msg = f'Las tablas agregadas de {folder} no se pueden calcular por lotes, se recalculan desde la raw'
+        logging.warning(msg)
+        print_error(msg)
+        return None
+    return deltas
+
+def _flush_deltas(deltas, bq_client, metrics=None, budget=None):
+    """
+    Suma a las tablas agregadas los conteos acumulados de una fuente. Devuelve los días que hay que
+    recalcular desde la raw porque no se han podido sumar.
+
+    Parámetros:
+    - deltas: etl.aggregate.AggregateDeltas
+    - bq_client: google.cloud.bigquery.client.Client
+    - metrics: etl.metrics.RunMetrics opcional
+    - budget: etl.query.QueryBudget opcional, presupuesto de bytes de la ejecución
+    """
+    pending = deltas.pending_dates()
+    return set() if deltas.flush(bq_client, metrics, budget) else pending
+
+def refresh_aggregates(folder, yaml_vars, bq_client, date_list=None, metrics=None, budget=None):
+    """
+    Recalcula desde la tabla raw las tablas agregadas de una fuente, sólo los días indicados o
+    enteras si no se indica ninguno. Con aggregation_mode 'delta' se recalculan con 'grouping_sets'.
+
+    Parámetros:
+    - folder: str carpeta del bucket
+    - yaml_vars: dict variables del config.yaml
+    - bq_client: google.cloud.bigquery.client.Client
+    - date_list: iterable opcional, días (YYYY-MM-DD) a recalcular
+    - metrics: etl.metrics.RunMetrics opcional
+    - budget: etl.query.QueryBudget opcional, presupuesto de bytes escaneados de la ejecución
+    """
+    dataset_id = folder.lower()
+    aggregation_mode = yaml_vars['bigquery']['aggregation_mode']
+    if aggregation_mode == 'delta':
+        aggregation_mode = 'grouping_sets'
+    aggregated_tables(yaml_vars['env-vars']['project_id'], dataset_id, get_table_id(dataset_id), bq_client,
+                      sorted(date_list) if date_list else None, aggregation_mode, metrics, budget,
+                      yaml_vars['bigquery']['budget_fallback_days'])
+
+def _finish_checkpoint(checkpoint, folder_path, deadline):
+    """
+    Borra el punto de avance de un prefijo recorrido entero. Si la extracción se ha cortado por el
+    límite de tiempo se conserva, para que la siguiente ejecución siga desde el último lote cargado.
+    """
+    if deadline and deadline.expired():
+        msg = f'{folder_path} queda a medias, la siguiente ejecución lo reanudará desde el último lote cargado'
+        logging.warning(msg)
+        print_error(msg)
+    else:
+        checkpoint.finish(folder_path)
+
+def run_folders(folders, yaml_vars, bucket, bq_client, state=None, id_index=None, checkpoint=None, deadline=None, budget=None,
+                refresh=True):
+    """
+    Ejecuta la ETL de varias carpetas en paralelo, compartiendo el bucket y el cliente de BQ.
+    Si date_to_upload abarca varios días (rango, lista o last_N_days), cada fuente y día es una unidad
+    independiente; se procesan hasta run.parallel_sources x run.parallel_days unidades a la vez.
+    Un error en una unidad no interrumpe al resto.
+    Con varios días, las tablas agregadas de cada fuente se recalculan (o se les suman los conteos, con
+    aggregation_mode 'delta') una sola vez cuando terminan todos sus días: las transacciones de varias
+    unidades sobre las mismas tablas a la vez chocan en BQ.
+    Se escribe en el log un resumen json de métricas por unidad y otro de toda la ejecución, que se devuelve.
+
+    Parámetros:
+    - folders: list carpetas del bucket
+    - yaml_vars: dict variables del config.yaml
+    - bucket: s3 bucket
+    - bq_client: google.cloud.bigquery.client.Client
+    - state: etl.state.StateStore opcional
+    - id_index: etl.id_index.IdIndex opcional
+    - checkpoint: etl.checkpoint.Checkpoint opcional
+    - deadline: etl.checkpoint.Deadline opcional, cerca del límite no se empiezan unidades ni objetos
+      nuevos y se carga lo ya extraído
+    - budget: etl.query.QueryBudget opcional, presupuesto de bytes escaneados que comparten todas las unidades
+    - refresh: bool si es False no se recalculan las tablas agregadas (los fragmentos del backfill, que
+      las recalcula al terminar todos, ver etl.backfill.run_backfill)
+    """
+    days = expand_date_to_upload(yaml_vars['env-vars']['date_to_upload'])
+    units = [(folder, day) for day in days for folder in folders]
+    max_workers = yaml_vars['run']['parallel_sources'] * min(yaml_vars['run']['parallel_days'], len(days))
+
+    run_metrics = RunMetrics('run')
+    if state:
+        state.use_budget(budget, run_metrics)
+    unit_metrics = {(folder, day): RunMetrics(folder if len(days) == 1 else f'{folder} {day}') for folder, day in units}
+    # Con un solo día cada unidad recalcula sus agregados; con varios se juntan los días de cada fuente
+    deferred = len(days) > 1 or not refresh
+    aggregate_dates = {folder: {day: set() for day in days} for folder in folders} if deferred else None
+    # Los conteos de todos los días de una fuente se acumulan juntos y se suman al terminar
+    deltas = {folder: _folder_deltas(folder, yaml_vars) for folder in folders} if deferred and refresh else {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {(folder, day): executor.submit(run_folder, folder, yaml_vars, bucket, bq_client, state, id_index,
+                                                  unit_metrics[(folder, day)], day, None, checkpoint, deadline, budget,
+                                                  aggregate_dates[folder][day] if deferred else None,
+                                                  deltas.get(folder))
+                   for folder, day in units}
+
+    for (folder, day), future in futures.items():
+        try:
+            future.result()
+        except Exception as e:
+            msg = f'Error en la ETL de la fuente {folder} ({day}): {e}'
+            logging.error(msg)
+            print_error(msg)
+        # Las métricas se escriben también si la unidad ha fallado, para ver hasta dónde llegó
+        unit_metrics[(folder, day)].log_summary()
+        run_metrics.merge(unit_metrics[(folder, day)])
+
+    if deferred and refresh:
+        _refresh_folders(aggregate_dates, deltas, yaml_vars, bq_client, run_metrics, budget)
+
+    run_metrics.log_summary()
+    return run_metrics
+
+def _refresh_folders(aggregate_dates, deltas, yaml_vars, bq_client, run_metrics, budget=None):
+    """
+    Actualiza a la vez las tablas agregadas de varias fuentes (cada una tiene las suyas): suma los
+    conteos que han acumulado todas sus unidades y recalcula los días que han dejado pendientes, o
+    cuyos conteos no se han podido sumar. Las métricas de cada fuente se escriben aparte.
+    """
+    def refresh_folder(folder, dates, metrics):
+        if deltas.get(folder):
+            dates = dates | _flush_deltas(deltas[folder], bq_client, metrics, budget)
+        if dates:
+            refresh_aggregates(folder, yaml_vars, bq_client, dates, metrics, budget)
+
+    dates_by_folder = {folder: set().union(*dates.values()) for folder, dates in aggregate_dates.items()}
+    dates_by_folder = {folder: dates for folder, dates in dates_by_folder.items()
+                       if dates or (deltas.get(folder) and deltas[folder].pending_dates())}
+    folder_metrics = {folder: RunMetrics(f'{folder} agregados') for folder in dates_by_folder}
+    with ThreadPoolExecutor(max_workers=yaml_vars['run']['parallel_sources']) as executor:
+        futures = {folder: executor.submit(refresh_folder, folder, dates, folder_metrics[folder])
+                   for folder, dates in dates_by_folder.items()}
+
+    for folder, future in futures.items():
+        try:
+            future.result()
+        except Exception as e:
+            msg = f'Error al recalcular las tablas agregadas de la fuente {folder}: {e}'
+            logging.error(msg)
+            print_error(msg)
+        folder_metrics[folder].log_summary()
+        run_metrics.merge(folder_metrics[folder])
+
+def run_keys(keys_by_folder, yaml_vars, bucket, bq_client, id_index=None, budget=None):
+    """
+    Ejecuta la ETL sólo sobre las keys indicadas (p.ej. las de las notificaciones del bucket), sin
+    listar el bucket. Las fuentes se procesan en paralelo como en run_folders.
+    Los objetos no se apuntan en el estado: la marca de agua supone que las keys se procesan en
+    orden y las notificaciones no lo garantizan. La idempotencia la da el deduplicado en BQ.
+
+    Parámetros:
+    - keys_by_folder: dict {carpeta: list de keys}
+    - yaml_vars: dict variables del config.yaml
+    - bucket: s3 bucket
+    - bq_client: google.cloud.bigquery.client.Client
+    - id_index: etl.id_index.IdIndex opcional
+    - budget: etl.query.QueryBudget opcional, presupuesto de bytes escaneados
+
+    Devuelve la lista de carpetas con algún error.
+    """
+    run_metrics = RunMetrics('run')
+    folder_metrics = {folder: RunMetrics(folder) for folder in keys_by_folder}
+    with ThreadPoolExecutor(max_workers=yaml_vars['run']['parallel_sources']) as executor:
+        futures = {folder: executor.submit(run_folder, folder, yaml_vars, bucket, bq_client, None, id_index,
+                                           folder_metrics[folder], None, keys, None, None, budget)
+                   for folder, keys in keys_by_folder.items()}
+
+    failed = []
+    for folder, future in futures.items():
+        try:
+            if not future.result():
+                failed.append(folder)
+        except Exception as e:
+            failed.append(folder)
+            msg = f'Error en la ETL de la fuente {folder}: {e}'
+            logging.error(msg)
+            print_error(msg)
+        folder_metrics[folder].log_summary()
+        run_metrics.merge(folder_metrics[folder])
+
+    run_metrics.log_summary()
+    return failed
@@ -0,0 +1,122 @@
+import json
+import logging
+import threading
+from etl.transform import compile_cleaning
+
+# Fuentes configuradas en la sección sources del config.yaml, por dataset de BQ (carpeta en minúsculas)
+_SOURCES = {}
+_lock = threading.Lock()
+
+class Source:
+    """
+    Una fuente de datos (carpeta del bucket) con todo lo que la ETL necesita de ella: esquema, tabla
+    raw, limpieza y tablas agregadas. Se construye una sola vez al cargar el config.yaml, de forma
+    que al procesar cada registro no hace falta decidir de qué fuente es.
+
+    Parámetros:
+    - folder: str carpeta del bucket
+    - config: dict entrada de la fuente en la sección sources del config.yaml
+    """
+    def __init__(self, folder, config):
+        self.folder = folder
+        self.dataset_id = folder.lower()
+        self.table_id = config['raw_table']
+        self.schema_path = config['schema']
+        self.defaults = tuple(config.get('defaults') or ())
+        self.strip_brackets = tuple(tuple(path.split('.', 1)) for path in config.get('strip_brackets') or ())
+        self.aggregates = [(a['table'], a['dimension'], a['select']) for a in config.get('aggregates') or ()]
+        self.clean = compile_cleaning(self.defaults, self.strip_brackets)
+
+        with open(self.schema_path) as f:
+            self._schema_json = json.load(f)
+        self._schema = None
+
+    @property
+    def schema(self):
+        """
+        Esquema de BQ (lista de bigquery.SchemaField). google-cloud-bigquery se importa la primera
+        vez que se pide, no al cargar el config.yaml.
+        """
+        if self._schema is None:
+            from google.cloud import bigquery
+            self._schema = [bigquery.SchemaField.from_api_repr(field) for field in self._schema_json]
+        return self._schema
+
+    def clean_record(self, json_data):
+        """
+        Limpieza de un registro (la función compilada en clean, ver etl.transform.compile_cleaning).
+        Es la implementación de referencia: el motor 'arrow' (etl.columnar.clean_table) tiene que dar
+        el mismo resultado, y así se comprueba en los tests.
+
+        Parámetros:
+        - json_data: dict registro tal y como se lee del bucket
+        """
+        return self.clean(json_data)
+
+    def clean_records(self, data):
+        """
+        Limpieza registro a registro de un lote, con clean_record.
+
+        Parámetros:
+        - data: list con los jsons del lote
+        """
+        return [self.clean(json_data) for json_data in data]
+
+def _check_source(folder, config):
+    """
+    Comprueba la entrada de una fuente en la sección sources. Devuelve un mensaje de error o None.
+    """
+    if not isinstance(config, dict):
+        return f'La fuente {folder} debe tener schema y raw_table'
+    for var in ('schema', 'raw_table'):
+        if not config.get(var):
+            return f'Falta la variable "{var}" de la fuente {folder}'
+    for path in config.get('strip_brackets') or ():
+        if '.' not in path:
+            return f'"{path}" de strip_brackets de la fuente {folder} debe ser lista.campo'
+    for aggregate in config.get('aggregates') or ():
+        if not isinstance(aggregate, dict) or not {'table', 'dimension', 'select'} <= set(aggregate):
+            return f'Cada tabla agregada de la fuente {folder} debe tener table, dimension y select'
+    return None
+
+def load_sources(yaml_vars):
+    """
+    Carga las fuentes de la sección sources del config.yaml (esquema desde su fichero json, con
+    el mismo formato que usa terraform) y las deja registradas para get_source.
+    Devuelve la lista de carpetas configuradas.
+
+    Parámetros:
+    - yaml_vars: dict variables del config.yaml
+    """
+    sources = {}
+    for folder, config in (yaml_vars.get('sources') or {}).items():
+        error = _check_source(folder, config)
+        if error is None:
+            try:
+                source = Source(folder, config)
+            except (OSError, ValueError) as e:
+                error = f'No se ha podido leer el esquema de la fuente {folder}: {e}'
+        if error:
+            msg = f'{error}. Revisa el config.yaml'
+            logging.critical(msg)
+            raise ValueError(msg)
+        sources[source.dataset_id] = source
+
+    with _lock:
+        _SOURCES.clear()
+        _SOURCES.update(sources)
+    return [source.folder for source in sources.values()]
+
+def get_source(dataset_id):
+    """
+    Devuelve la fuente registrada para un dataset de BQ.
+
+    Parámetros:
+    - dataset_id: str dataset de BQ (carpeta en minúsculas)
+    """
+    try:
+        return _SOURCES[dataset_id]
+    except KeyError:
+        msg = f'No se ha definido la fuente {dataset_id}. Revisa la sección sources del config.yaml'
+        logging.critical(msg)
+        raise ValueError(msg) from None
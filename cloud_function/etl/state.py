@@ -0,0 +1,328 @@
+from google.cloud import bigquery
+import logging
+import threading
+import time
+from etl.query import run_query
+from etl.utils import print_error, sqlite_connect
+
+class StateStore:
+    """
+    Guarda qué objetos del bucket se han procesado ya (key y ETag) y la marca de agua de cada prefijo
+    listado (última key y mayor LastModified), para que cada ejecución sólo descargue lo nuevo o modificado.
+
+    La marca de agua es del prefijo que se ha listado (la carpeta entera con 'all' o un día), no de
+    la carpeta: una ejecución de un solo día no puede hacer que un listado de toda la carpeta empiece
+    después de ese día y se salte los anteriores.
+
+    Los objetos se marcan primero como pendientes (stage) durante la extracción y sólo se consolidan
+    (commit) cuando los datos se han cargado en BQ. Los pendientes se separan por carpeta y prefijo,
+    para poder procesar varios días de una carpeta a la vez.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._known = {}
+        self._pending = {}
+        self._failed = set()
+        self._budget = None
+        self._metrics = None
+
+    def use_budget(self, budget=None, metrics=None):
+        """
+        Indica el presupuesto de bytes y las métricas de la ejecución, con los que se lanzan las
+        queries del estado (sólo las hay con el backend 'bigquery'). Se llama al empezar la ejecución.
+
+        Parámetros:
+        - budget: etl.query.QueryBudget opcional, presupuesto de bytes de la ejecución
+        - metrics: etl.metrics.RunMetrics opcional, las queries se apuntan en la etapa 'state_query'
+        """
+        self._budget = budget
+        self._metrics = metrics
+
+    def get_start_after(self, folder, prefix):
+        """
+        Devuelve la key a partir de la cual se puede reanudar el listado del prefijo, o None.
+        Se reanuda desde el inicio del directorio (día) de la última key procesada de ese mismo
+        prefijo, ya que dentro de un día las keys nuevas no tienen por qué ser posteriores alfabéticamente.
+
+        Parámetros:
+        - folder: str carpeta del bucket
+        - prefix: str prefijo que se va a listar
+        """
+        last_key, _ = self._get_watermark(folder, prefix)
+        if last_key is None:
+            return None
+        resume_from = last_key.rsplit('/', 1)[0] + '/'
+        if resume_from.startswith(prefix) and resume_from > prefix:
+            return resume_from
+        return None
+
+    def is_new(self, folder, obj, prefix):
+        """
+        Indica si un objeto no se ha procesado todavía o ha cambiado desde entonces.
+        Sólo se cargan las keys procesadas del prefijo que se está listando, desde donde se reanuda.
+
+        Parámetros:
+        - folder: str carpeta del bucket
+        - obj: dict objeto de list_objects_v2
+        - prefix: str prefijo que se está listando
+        """
+        with self._lock:
+            known = self._known.get((folder, prefix))
+        if known is None:
+            start = self.get_start_after(folder, prefix) or prefix
+            loaded = self._load_known(folder, prefix, start)
+            with self._lock:
+                known = self._known.setdefault((folder, prefix), loaded)
+        return known.get(obj['Key']) != obj.get('ETag')
+
+    def begin(self, folder, prefix):
+        """
+        Empieza a procesar un prefijo de una carpeta, olvidando los pendientes y errores
+        de ejecuciones anteriores de ese prefijo.
+
+        Parámetros:
+        - folder: str carpeta del bucket
+        - prefix: str prefijo que se va a listar
+        """
+        with self._lock:
+            self._pending.pop((folder, prefix), None)
+            self._failed.discard((folder, prefix))
+
+    def stage(self, folder, obj, prefix):
+        """
+        Marca un objeto como procesado a falta de confirmar la carga.
+
+        Parámetros:
+        - folder: str carpeta del bucket
+        - obj: dict objeto de list_objects_v2
+        - prefix: str prefijo que se está listando
+        """
+        with self._lock:
+            self._pending.setdefault((folder, prefix), []).append(obj)
+
+    def commit(self, folder, prefix):
+        """
+        Consolida los objetos pendientes de un prefijo y actualiza su marca de agua.
+
+        Parámetros:
+        - folder: str carpeta del bucket
+        - prefix: str prefijo que se está listando
+        """
+        with self._lock:
+            objs = self._pending.pop((folder, prefix), [])
+            # Tras un lote fallido no se consolida nada más del prefijo: un objeto con varios
+            # registros puede tener parte de ellos en ese lote
+            if (folder, prefix) in self._failed:
+                return
+        if len(objs) == 0:
+            return
+        try:
+            self._save(folder, prefix, objs)
+        except Exception as e:
+            msg = f'No se ha podido guardar el estado de {prefix}: {e}'
+            logging.error(msg)
+            print_error(msg)
+            return
+
+        with self._lock:
+            known = self._known.setdefault((folder, prefix), {})
+            for obj in objs:
+                known[obj['Key']] = obj.get('ETag')
+
+    def discard(self, folder, prefix):
+        """
+        Descarta los objetos pendientes de un prefijo (su carga ha fallado y se reintentarán).
+        Hasta el siguiente begin no se vuelve a consolidar nada de ese prefijo.
+
+        Parámetros:
+        - folder: str carpeta del bucket
+        - prefix: str prefijo que se está listando
+        """
+        with self._lock:
+            self._pending.pop((folder, prefix), None)
+            self._failed.add((folder, prefix))
+
+    def _get_watermark(self, folder, prefix):
+        raise NotImplementedError
+
+    def _load_known(self, folder, prefix, start):
+        raise NotImplementedError
+
+    def _save(self, folder, prefix, objs):
+        raise NotImplementedError
+
+
+def _prefix_end(prefix):
+    """
+    Devuelve la primera cadena posterior a todas las keys que empiezan por prefix, para filtrar
+    las keys de un prefijo con un rango (key >= prefix AND key < _prefix_end(prefix)).
+    """
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class SQLiteStateStore(StateStore):
+    """
+    Estado en un fichero SQLite local, pensado para las ejecuciones desde local. Lo pueden compartir
+    los procesos del backfill local (ver etl.utils.sqlite_connect).
+    """
+    def __init__(self, path):
+        super().__init__()
+        self._conn = sqlite_connect(path)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS processed_keys (
+                folder TEXT, key TEXT, etag TEXT, last_modified TEXT,
+                PRIMARY KEY (folder, key))
+        """)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS prefix_watermarks (
+                folder TEXT, prefix TEXT, last_key TEXT, last_modified TEXT,
+                PRIMARY KEY (folder, prefix))
+        """)
+        self._conn.commit()
+
+    def _get_watermark(self, folder, prefix):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT last_key, last_modified FROM prefix_watermarks WHERE folder = ? AND prefix = ?', (folder, prefix)
+            ).fetchone()
+        return row if row else (None, None)
+
+    def _load_known(self, folder, prefix, start):
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT key, etag FROM processed_keys WHERE folder = ? AND key >= ? AND key < ?',
+                (folder, start, _prefix_end(prefix))
+            ).fetchall()
+        return dict(rows)
+
+    def _save(self, folder, prefix, objs):
+        rows = [(folder, obj['Key'], obj.get('ETag'), str(obj.get('LastModified'))) for obj in objs]
+        last_key = max(obj['Key'] for obj in objs)
+        last_modified = str(max(obj.get('LastModified') for obj in objs))
+        with self._lock:
+            # La clave primaria (folder, key) hace que reprocesar un objeto lo actualice, sin repetirlo
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO processed_keys VALUES (?, ?, ?, ?)', rows
+            )
+            self._conn.execute("""
+                INSERT INTO prefix_watermarks VALUES (?, ?, ?, ?)
+                ON CONFLICT(folder, prefix) DO UPDATE SET
+                last_key = MAX(last_key, excluded.last_key),
+                last_modified = MAX(last_modified, excluded.last_modified)
+            """, (folder, prefix, last_key, last_modified))
+            self._conn.commit()
+
+
+class BigQueryStateStore(StateStore):
+    """
+    Estado en tablas de BQ, pensado para la Cloud Function (su disco no persiste entre instancias).
+    Sólo se cargan las keys procesadas del prefijo que se lista desde el último día de su marca de
+    agua, no todo el histórico de la carpeta. Las keys se guardan con un MERGE (una fila por key)
+    y las marcas de agua en su propia tabla, una fila por carpeta y prefijo.
+    """
+    def __init__(self, bq_client, project_id, dataset_id, table_id='processed_keys', watermarks_table_id='prefix_watermarks'):
+        super().__init__()
+        self._bq_client = bq_client
+        self._table_full_id = f'{project_id}.{dataset_id}.{table_id}'
+        self._watermarks_full_id = f'{project_id}.{dataset_id}.{watermarks_table_id}'
+        self._watermarks = {}
+        # Los MERGE de un mismo proceso se lanzan de uno en uno: dos DML a la vez sobre la misma tabla pueden chocar
+        self._save_lock = threading.Lock()
+
+        bq_client.create_dataset(f'{project_id}.{dataset_id}', exists_ok=True)
+        table = bigquery.Table(self._table_full_id, schema=[
+            bigquery.SchemaField('folder', 'STRING'),
+            bigquery.SchemaField('key', 'STRING'),
+            bigquery.SchemaField('etag', 'STRING'),
+            bigquery.SchemaField('last_modified', 'TIMESTAMP'),
+            bigquery.SchemaField('processed_at', 'TIMESTAMP'),
+        ])
+        table.clustering_fields = ['folder', 'key']
+        bq_client.create_table(table, exists_ok=True)
+
+        watermarks = bigquery.Table(self._watermarks_full_id, schema=[
+            bigquery.SchemaField('folder', 'STRING'),
+            bigquery.SchemaField('prefix', 'STRING'),
+            bigquery.SchemaField('last_key', 'STRING'),
+            bigquery.SchemaField('last_modified', 'TIMESTAMP'),
+        ])
+        watermarks.clustering_fields = ['folder', 'prefix']
+        bq_client.create_table(watermarks, exists_ok=True)
+
+    def _query(self, query, folder, params=()):
+        query_params = [bigquery.ScalarQueryParameter('folder', 'STRING', folder)] + list(params)
+        job_config = bigquery.QueryJobConfig(query_parameters=query_params)
+        start = time.perf_counter()
+        query_job = run_query(self._bq_client, query, self._budget, self._metrics, 'state_query', job_config=job_config)
+        rows = query_job.result()
+        if self._metrics:
+            self._metrics.add_job('state_query', query_job, time.perf_counter() - start)
+        return rows
+
+    def _get_watermark(self, folder, prefix):
+        if (folder, prefix) not in self._watermarks:
+            query = f"""
+            SELECT last_key, CAST(last_modified AS STRING)
+            FROM `{self._watermarks_full_id}`
+            WHERE folder = @folder AND prefix = @prefix
+            """
+            rows = list(self._query(query, folder, [bigquery.ScalarQueryParameter('prefix', 'STRING', prefix)]))
+            self._watermarks[(folder, prefix)] = (rows[0][0], rows[0][1]) if rows else (None, None)
+        return self._watermarks[(folder, prefix)]
+
+    def _load_known(self, folder, prefix, start):
+        # Las filas repetidas que dejaban las versiones que añadían en lugar de hacer MERGE se descartan con el QUALIFY
+        query = f"""
+        SELECT key, etag
+        FROM `{self._table_full_id}`
+        WHERE folder = @folder AND key >= @start AND STARTS_WITH(key, @prefix)
+        QUALIFY ROW_NUMBER() OVER (PARTITION BY key ORDER BY processed_at DESC) = 1
+        """
+        rows = self._query(query, folder, [bigquery.ScalarQueryParameter('start', 'STRING', start),
+                                           bigquery.ScalarQueryParameter('prefix', 'STRING', prefix)])
+        return {row[0]: row[1] for row in rows}
+
+    def _save(self, folder, prefix, objs):
+        keys = [bigquery.StructQueryParameter(None,
+                                              bigquery.ScalarQueryParameter('key', 'STRING', obj['Key']),
+                                              bigquery.ScalarQueryParameter('etag', 'STRING', obj.get('ETag')),
+                                              bigquery.ScalarQueryParameter('last_modified', 'TIMESTAMP', obj.get('LastModified')))
+                for obj in objs]
+        query = f"""
+        MERGE `{self._table_full_id}` T
+        USING (SELECT k.key, k.etag, k.last_modified FROM UNNEST(@keys) AS k) S
+        ON T.folder = @folder AND T.key = S.key
+        WHEN MATCHED THEN UPDATE SET etag = S.etag, last_modified = S.last_modified, processed_at = CURRENT_TIMESTAMP()
+        WHEN NOT MATCHED THEN INSERT (folder, key, etag, last_modified, processed_at)
+        VALUES (@folder, S.key, S.etag, S.last_modified, CURRENT_TIMESTAMP());
+
+        MERGE `{self._watermarks_full_id}` T
+        USING (SELECT MAX(k.key) AS last_key, MAX(k.last_modified) AS last_modified FROM UNNEST(@keys) AS k) S
+        ON T.folder = @folder AND T.prefix = @prefix
+        WHEN MATCHED THEN UPDATE SET last_key = GREATEST(T.last_key, S.last_key),
+        last_modified = GREATEST(T.last_modified, S.last_modified)
+        WHEN NOT MATCHED THEN INSERT (folder, prefix, last_key, last_modified)
+        VALUES (@folder, @prefix, S.last_key, S.last_modified);
+        """
+        with self._save_lock:
+            self._query(query, folder, [bigquery.ScalarQueryParameter('prefix', 'STRING', prefix),
+                                        bigquery.ArrayQueryParameter('keys', 'STRUCT', keys)])
+        self._watermarks.pop((folder, prefix), None)
+
+
+def get_state_store(yaml_vars, bq_client=None):
+    """
+    Crea el almacén de estado configurado en el config.yaml, o None si está desactivado.
+
+    Parámetros:
+    - yaml_vars: dict variables del config.yaml
+    - bq_client: google.cloud.bigquery.client.Client, necesario para el backend 'bigquery'
+    """
+    state_vars = yaml_vars['state']
+    backend = state_vars['backend']
+    if backend == 'sqlite':
+        return SQLiteStateStore(state_vars['path'])
+    elif backend == 'bigquery':
+        project_id = yaml_vars['env-vars']['project_id']
+        return BigQueryStateStore(bq_client, project_id, state_vars['dataset'])
+    return None
@@ -1,26 +1,24 @@
-def tweet_cleaning(json_data):
+def compile_cleaning(defaults, strip_brackets):
     """
-    Realiza una determinada limpieza sobre un campo del diccionario de tweet.
+    Construye la función de limpieza registro a registro de una fuente (ver etl.sources): añade a
+    nulo las columnas que a veces faltan y quita los corchetes de los campos indicados de las listas
+    de records.
 
     Parámetros:
-    - json_data: json
+    - defaults: iterable columnas que pueden faltar
+    - strip_brackets: iterable de (lista, campo), p.ej. [('categories', 'name')]
     """
-    # Añadimos las columnas que a veces faltan
-    json_data.setdefault('media', None)
-    json_data.setdefault('parentId', None)
-    # Se quitan esos corchetes que a veces hay en categories
-    for k in json_data['categories']:
-        k['name'] = k['name'].strip('[]')
-    return json_data
+    defaults = tuple(defaults)
+    strip_brackets = tuple(strip_brackets)
 
-def yt_comment_cleaning(json_data):
-    """
-    Realiza una determinada limpieza sobre un campo del diccionario de tweet.
+    def clean(json_data):
+        # Añadimos las columnas que a veces faltan
+        for column in defaults:
+            json_data.setdefault(column, None)
+        # Se quitan esos corchetes que a veces hay en categories
+        for list_field, field in strip_brackets:
+            for k in json_data[list_field]:
+                k[field] = k[field].strip('[]')
+        return json_data
 
-    Parámetros:
-    - json_data: json
-    """
-    # Se quitan esos corchetes que a veces hay en categories
-    for k in json_data['categories']:
-        k['name'] = k['name'].strip('[]')
-    return json_data
\ No newline at end of file
+    return clean
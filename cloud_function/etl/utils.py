@@ -1,11 +1,14 @@
-import boto3
-from botocore.handlers import disable_signing
 import yaml
 import os
-from datetime import datetime
+from datetime import datetime, timedelta
 import logging
 import re
-from google.cloud import bigquery
+import sqlite3
+from etl.sources import load_sources
+
+# boto3, google-cloud-bigquery y requests se importan dentro de las funciones que los usan:
+# tardan en importarse y así no se cargan en las ejecuciones que no los necesitan (p.ej. al
+# comprobar el config.yaml o al repartir una carga completa entre invocaciones)
 
 def load_yaml_to_dict(filepath):
     """
@@ -18,12 +21,24 @@ def load_yaml_to_dict(filepath):
         data = yaml.safe_load(file)
     return data
 
-def connect_s3(bucket_name):
+def connect_s3(bucket_name, max_pool_connections=10):
     """
-    Se conecta a un bucket de s3.
+    Se conecta a un bucket de s3. Si el nombre empieza por 'file://' se usa una carpeta local
+    como bucket (ver etl.fakes.LocalBucket), útil para pruebas y benchmarks.
+
+    Parámetros:
+    - bucket_name: str nombre del bucket o 'file://<carpeta>'
+    - max_pool_connections: int conexiones máximas del pool http, debe ser >= que los hilos de descarga
     """
+    if bucket_name.startswith('file://'):
+        from etl.fakes import LocalBucket
+        return LocalBucket(bucket_name[len('file://'):])
+
+    import boto3
+    from botocore.config import Config
+    from botocore.handlers import disable_signing
     try:
-        s3 = boto3.resource('s3')
+        s3 = boto3.resource('s3', config=Config(max_pool_connections=max_pool_connections))
         s3.meta.client.meta.events.register('choose-signer.s3.*', disable_signing)
         bucket = s3.Bucket(bucket_name)
     except Exception as e:
@@ -32,22 +47,67 @@ def connect_s3(bucket_name):
 
     return bucket
 
-def bq_connect(credentials):
+def connect_sqs(queue_url):
+    """
+    Crea el cliente de SQS para leer las notificaciones del bucket. La región se toma de la url
+    de la cola (https://sqs.<región>.amazonaws.com/<cuenta>/<cola>) y las credenciales de AWS de
+    las variables de entorno o de ~/.aws, como en cualquier cliente de boto3.
+
+    Parámetros:
+    - queue_url: str url de la cola
+    """
+    import boto3
+    try:
+        region = queue_url.split('//', 1)[1].split('.')[1]
+        return boto3.client('sqs', region_name=region)
+    except Exception as e:
+        logging.critical(e)
+        raise ConnectionError(e)
+
+def bq_connect(credentials, pool_size=None):
     """
     Crea el cliente de BQ.
 
     Parámetros:
     - credentials: str path al json con las credenciales de la cuenta de servicio
+    - pool_size: int opcional, conexiones http que se mantienen abiertas. Si el cliente se comparte
+      entre varios hilos debe ser al menos el número de hilos
     """
+    import requests
+    from google.cloud import bigquery
     try:
         os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = credentials
-        bq_client = bigquery.Client()
+        if pool_size:
+            # El pool se configura en una sesión autenticada propia que se pasa al constructor (_http),
+            # la forma que da google-cloud-core de usar una sesión distinta de la que crea el cliente
+            import google.auth
+            from google.auth.transport.requests import AuthorizedSession
+            scoped_credentials, project = google.auth.default(scopes=bigquery.Client.SCOPE)
+            session = AuthorizedSession(scoped_credentials)
+            adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount('https://', adapter)
+            bq_client = bigquery.Client(project=project, credentials=scoped_credentials, _http=session)
+        else:
+            bq_client = bigquery.Client()
     except Exception as e:
         logging.critical(e)
         print_error(e)
 
     return bq_client
 
+def get_pool_sizes(yaml_vars):
+    """
+    Devuelve (conexiones del pool de s3, conexiones del pool de BQ) para los hilos que pueden usar
+    a la vez los clientes compartidos: hasta run.parallel_sources x run.parallel_days unidades (fuente
+    y día), cada una con sus descargas y listados de s3 y un par de peticiones a BQ (carga y query).
+
+    Parámetros:
+    - yaml_vars: dict variables del config.yaml
+    """
+    units = yaml_vars['run']['parallel_sources'] * yaml_vars['run']['parallel_days']
+    s3_workers = yaml_vars['extract']['max_workers'] + yaml_vars['extract']['list_workers']
+    return max(s3_workers * units, 10), max(units * 2, 10)
+
 def get_date_to_upload(date_to_upload):
     """
     Obtiene el día, mesla fecha que queremos cargar.
@@ -64,6 +124,83 @@ def get_date_to_upload(date_to_upload):
 
     return date_to_upload
 
+def expand_date_to_upload(date_to_upload, today=None):
+    """
+    Convierte el valor de date_to_upload en la lista de unidades que se procesan por separado.
+    'all', 'today' y una fecha suelta dan una sola unidad; los rangos, listas y ventanas relativas
+    se expanden en un día por unidad (YYYY/MM/DD).
+
+    Formatos admitidos:
+    - 'all', 'today' o 'YYYY/MM/DD'
+    - 'YYYY/MM/DD..YYYY/MM/DD': rango de días, ambos incluidos
+    - 'YYYY/MM/DD,YYYY/MM/DD,...' o una lista en el yaml: días sueltos
+    - 'last_N_days': los N últimos días, incluido hoy
+
+    Parámetros:
+    - date_to_upload: str o list valor de la variable en el config.yaml
+    - today: datetime opcional, día de referencia para 'last_N_days'
+    """
+    def parse_day(value):
+        try:
+            return datetime.strptime(str(value).strip(), '%Y/%m/%d')
+        except ValueError:
+            raise ValueError(f'La fecha "{value}" de "date_to_upload" no tiene el formato YYYY/MM/DD')
+
+    if isinstance(date_to_upload, list):
+        days = [parse_day(value) for value in date_to_upload]
+    elif date_to_upload in ('all', 'today'):
+        return [date_to_upload]
+    elif re.fullmatch(r'last_\d+_days', date_to_upload):
+        n_days = int(date_to_upload.split('_')[1])
+        if n_days < 1:
+            raise ValueError('"date_to_upload" debe incluir al menos un día')
+        end = today or datetime.today()
+        days = [end - timedelta(days=i) for i in range(n_days - 1, -1, -1)]
+    elif '..' in date_to_upload:
+        start, end = (parse_day(value) for value in date_to_upload.split('..', 1))
+        if start > end:
+            raise ValueError(f'El rango "{date_to_upload}" de "date_to_upload" empieza después de terminar')
+        days = [start + timedelta(days=i) for i in range((end - start).days + 1)]
+    else:
+        days = [parse_day(value) for value in date_to_upload.split(',')]
+
+    # Sin repetidos y en orden
+    return sorted({day.strftime('%Y/%m/%d') for day in days})
+
+# Zona horaria al final de un TIMESTAMP (+HH:MM, -HHMM...), ver etl.validate
+_OFFSET = re.compile(r'[T ]\d{2}:\d{2}.*([+-])(\d{2}):?(\d{2})$')
+
+def utc_day(timestamp):
+    """
+    Devuelve el día en UTC (YYYY-MM-DD) de un TIMESTAMP en texto, el mismo en el que BQ lo reparte
+    (TIMESTAMP_TRUNC, DATE o FORMAT_TIMESTAMP sin zona horaria). Si la fecha viene en UTC o sin zona
+    horaria es su prefijo; si trae otra zona se pasa a UTC, que puede caer en el día anterior o siguiente.
+
+    Parámetros:
+    - timestamp: str fecha ya validada (ver etl.validate)
+    """
+    match = _OFFSET.search(timestamp)
+    if match is None or match.group(2) == match.group(3) == '00':
+        return timestamp[:10]
+    sign, hours, minutes = match.groups()
+    offset = timedelta(hours=int(hours), minutes=int(minutes))
+    local = datetime.strptime(timestamp[:16].replace(' ', 'T'), '%Y-%m-%dT%H:%M')
+    return (local - offset if sign == '+' else local + offset).strftime('%Y-%m-%d')
+
+def sqlite_connect(path, timeout=30):
+    """
+    Abre un fichero SQLite que pueden compartir varios procesos (los del backfill local). En modo WAL
+    las lecturas no bloquean a las escrituras, y una escritura espera hasta timeout segundos a que
+    termine la de otro proceso en vez de fallar con "database is locked".
+
+    Parámetros:
+    - path: str fichero SQLite
+    - timeout: float segundos máximos de espera por el bloqueo del fichero
+    """
+    conn = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    return conn
+
 def print_success(message):
     """
     Imprime un mensaje en color verde.
@@ -85,6 +222,20 @@ def print_error(message):
     
     print("\033[91m{}\033[00m".format(message))
 
+def check_option(var, value, allowed):
+    """
+    Comprueba que una variable del config.yaml tiene uno de los valores permitidos.
+
+    Parámetros:
+    - var: str nombre de la variable, para el mensaje de error
+    - value: valor de la variable
+    - allowed: list valores permitidos
+    """
+    if value not in allowed:
+        msg = f'El valor "{value}" de la variable "{var}" no es válido ({", ".join(allowed)}), revisa el config.yaml'
+        logging.critical(msg)
+        raise ValueError(msg)
+
 def check_yaml_vars(yaml_vars):
     """
     Hace varias comprobaciones sobre las variables del config.yaml
@@ -102,25 +253,84 @@ def check_yaml_vars(yaml_vars):
                 logging.critical(msg)
                 raise ValueError(msg)
             
-    # Asegurarse que los nombres de los folders están bien escritos
-    allowed_folders = ['Tweet', 'YoutubeComment']
+    # Asegurarse que los nombres de los folders están bien escritos: sólo se procesan las fuentes
+    # definidas en la sección sources (esquema, tabla raw, limpieza y tablas agregadas)
+    allowed_folders = load_sources(yaml_vars)
     folders = yaml_vars['bucket']['folders']
     invalid_folders = [folder for folder in folders if folder not in allowed_folders]
     yaml_vars['bucket']['folders'] = [folder for folder in folders if folder in allowed_folders]
 
     for folder in invalid_folders:
-        msg = f'La fuente de datos {folder} no existe o no está contemplada.'
+        msg = f'La fuente de datos {folder} no existe o no está contemplada en la sección sources del config.yaml.'
         logging.warning(msg)
         print_error(msg)
 
-    # Comprobación del formato de date_to_upload
-    date_to_upload = yaml_vars['env-vars']['date_to_upload']
-    pattern = r'^(today|all|\d{4}/\d{2}/\d{2})$'
+    # Comprobación de los parámetros de extracción y ejecución
+    int_vars = [('extract', 'max_workers'), ('extract', 'batch_size'), ('extract', 'max_batch_mb'), ('extract', 'list_workers'),
+                ('run', 'parallel_sources'), ('run', 'parallel_days'), ('backfill', 'processes'), ('backfill', 'concurrency'),
+                ('backfill', 'request_timeout'), ('events', 'max_messages'), ('events', 'wait_seconds'),
+                ('bigquery', 'max_bisect_jobs')]
+    for section, var in int_vars:
+        value = yaml_vars[section][var]
+        if not isinstance(value, int) or value < 1:
+            msg = f'La variable "{var}" debe ser un entero mayor que 0, revisa el config.yaml'
+            logging.critical(msg)
+            raise ValueError(msg)
 
-    if re.fullmatch(pattern, date_to_upload):
-        pass
-    else:
-        msg = f'El formato de la variable "date_to_upload" no es válido, revisa el config.yaml'
+    # Límite de tiempo y presupuesto de bytes de la ejecución (0 -> sin límite)
+    for section, var in [('run', 'timeout_seconds'), ('run', 'deadline_margin'), ('bigquery', 'max_scan_gb'),
+                         ('bigquery', 'budget_fallback_days')]:
+        value = yaml_vars[section][var]
+        if not isinstance(value, int) or value < 0:
+            msg = f'La variable "{var}" debe ser un entero mayor o igual que 0, revisa el config.yaml'
+            logging.critical(msg)
+            raise ValueError(msg)
+
+    # Comprobación de la librería de parseo de json
+    check_option('json_backend', yaml_vars['extract']['json_backend'], ['auto', 'orjson', 'msgspec', 'json'])
+
+    # Comprobación del motor de limpieza de los registros
+    check_option('transform_engine', yaml_vars['extract']['transform_engine'], ['python', 'arrow'])
+
+    # Comprobación del formato de carga en BQ
+    check_option('load_format', yaml_vars['bigquery']['load_format'], ['json', 'parquet'])
+
+    # La limpieza por lotes con Arrow se hace al convertir el lote a parquet: con json no tendría efecto
+    if yaml_vars['extract']['transform_engine'] == 'arrow' and yaml_vars['bigquery']['load_format'] != 'parquet':
+        msg = 'El valor "arrow" de la variable "transform_engine" requiere load_format "parquet", revisa el config.yaml'
+        logging.critical(msg)
+        raise ValueError(msg)
+
+    # Comprobación del modo de carga (un solo job o aislando los registros que BQ rechaza)
+    check_option('load_mode', yaml_vars['bigquery']['load_mode'], ['batch', 'bisect'])
+
+    if not isinstance(yaml_vars['bigquery']['dry_run'], bool):
+        msg = 'La variable "dry_run" debe ser true o false, revisa el config.yaml'
+        logging.critical(msg)
+        raise ValueError(msg)
+
+    # Comprobación del modo de cálculo de las tablas agregadas
+    check_option('aggregation_mode', yaml_vars['bigquery']['aggregation_mode'], ['grouping_sets', 'separate', 'delta'])
+
+    # Comprobación del modo de deduplicado de cada fuente (las que no lo indican usan 'query')
+    for folder in yaml_vars['bucket']['folders']:
+        dedup_mode = yaml_vars['bigquery']['dedup_mode'].setdefault(folder, 'query')
+        check_option(f'dedup_mode.{folder}', dedup_mode, ['query', 'merge', 'index'])
+
+    # Comprobación del modo de reparto de las cargas completas
+    check_option('backfill.mode', yaml_vars['backfill']['mode'], ['none', 'local', 'remote'])
+
+    # Comprobación del backend de estado
+    check_option('state.backend', yaml_vars['state']['backend'], ['sqlite', 'bigquery', 'none'])
+
+    # Comprobación del backend de los puntos de avance
+    check_option('checkpoint.backend', yaml_vars['checkpoint']['backend'], ['file', 'object', 'none'])
+
+    # Comprobación del formato de date_to_upload
+    try:
+        expand_date_to_upload(yaml_vars['env-vars']['date_to_upload'])
+    except (ValueError, TypeError) as e:
+        msg = f'El formato de la variable "date_to_upload" no es válido ({e}), revisa el config.yaml'
         logging.critical(msg)
         raise ValueError(msg)
 
@@ -1,6 +1,3 @@
-from etl.utils import connect_s3, bq_connect, load_yaml_to_dict, check_yaml_vars
-from etl.load import upload_raw_data, check_unique, get_table_id, aggregated_tables
-from etl.extract import extract, SkipFolderException
 import logging
 import functions_framework
 
@@ -11,44 +8,141 @@ logging.basicConfig(
     filemode='a'
 )
 
+# Recursos que se crean en la primera petición y se reutilizan en las siguientes mientras la
+# instancia siga viva (min_instance_count = 1 mantiene una caliente): la configuración, los clientes
+# (s3, BQ, SQS) y el índice de ids, que caduca por su cuenta (id_index.max_age_hours). El estado y
+# los puntos de avance guardan en memoria lo que han leído y lo que ha fallado en la ejecución, así
+# que se crean en cada petición: otra instancia puede haberlos actualizado entre medias. Las
+# librerías pesadas (boto3, google-cloud-bigquery, pyarrow) se importan también en la primera
+# petición, no al arrancar.
+_cache = {}
+
+def _cached(name, build):
+    """
+    Devuelve el recurso guardado con ese nombre, creándolo la primera vez.
+    """
+    if name not in _cache:
+        _cache[name] = build()
+    return _cache[name]
+
+def get_config():
+    """
+    Carga y comprueba el config.yaml una sola vez por instancia.
+    """
+    from etl.utils import load_yaml_to_dict, check_yaml_vars
+    return _cached('yaml_vars', lambda: check_yaml_vars(load_yaml_to_dict('config.yaml')))
+
+def get_bucket(yaml_vars):
+    """
+    Conexión al bucket de s3, compartida por todas las fuentes y peticiones.
+    """
+    from etl.utils import connect_s3, get_pool_sizes
+    s3_pool_size, _ = get_pool_sizes(yaml_vars)
+    return _cached('bucket', lambda: connect_s3(yaml_vars['bucket']['bucket_name'], max_pool_connections=s3_pool_size))
+
+def get_bq_client(yaml_vars):
+    """
+    Cliente de BQ, compartido por todas las fuentes y peticiones.
+    """
+    from etl.utils import bq_connect, get_pool_sizes
+    _, bq_pool_size = get_pool_sizes(yaml_vars)
+    return _cached('bq_client', lambda: bq_connect(yaml_vars['env-vars']['credentials'], pool_size=bq_pool_size))
+
+def get_state(yaml_vars, bq_client):
+    """
+    Registro de los objetos ya procesados, nuevo en cada petición con el cliente de BQ compartido:
+    las keys conocidas y las marcas de agua se vuelven a leer, por si otra instancia ha cargado algo.
+    """
+    from etl.state import get_state_store
+    return get_state_store(yaml_vars, bq_client)
+
+def get_index(yaml_vars):
+    """
+    Índice local de ids, con sus filtros de Bloom ya construidos en memoria.
+    """
+    from etl.id_index import get_id_index
+    return _cached('id_index', lambda: get_id_index(yaml_vars))
+
+def get_checkpoint_store(yaml_vars):
+    """
+    Puntos de avance de los prefijos, para reanudar lo que dejó a medias una petición anterior. Se
+    crean en cada petición; sólo se reutiliza la conexión al bucket donde se guardan (backend 'object').
+    """
+    from etl.checkpoint import get_checkpoint, connect_checkpoint_bucket
+    checkpoint_vars = yaml_vars['checkpoint']
+    bucket = None
+    if checkpoint_vars['backend'] == 'object':
+        bucket = _cached('checkpoint_bucket', lambda: connect_checkpoint_bucket(checkpoint_vars['bucket']))
+    return get_checkpoint(yaml_vars, bucket)
+
 @functions_framework.http
 def main(request):
     # Se obtienen las variables guardadas en el config.yaml y comprobación de que están bien definidas
-    yaml_vars = load_yaml_to_dict('config.yaml')
-    yaml_vars = check_yaml_vars(yaml_vars)        
+    yaml_vars = get_config()
+
+    # Límite de tiempo de la petición (timeout_seconds de la función): cerca de él se deja de
+    # empezar trabajo nuevo y se carga lo extraído, antes de que la plataforma corte la ejecución
+    from etl.checkpoint import get_deadline
+    deadline = get_deadline(yaml_vars)
+    # Presupuesto de bytes escaneados en BQ de la petición
+    from etl.query import get_query_budget
+    budget = get_query_budget(yaml_vars)
 
-    project_id = yaml_vars['env-vars']['project_id']
-    bucket_name = yaml_vars['bucket']['bucket_name']
+    # Si la petición trae un fragmento de una carga completa ({"shard": {"folder": ..., "date": "YYYY/MM/DD"}})
+    # se procesa sólo esa fuente y ese día
+    body = request.get_json(silent=True) or {}
+    if 'shard' in body:
+        from etl.backfill import shard_vars
+        try:
+            yaml_vars = shard_vars(yaml_vars, body['shard'])
+        except ValueError as e:
+            logging.error(e)
+            return str(e), 400
+
+    from etl.events import is_event
     folders = yaml_vars['bucket']['folders']
-    date_to_upload = yaml_vars['env-vars']['date_to_upload']
-    credentials = yaml_vars['env-vars']['credentials']
 
-    # Conexión al bucket de s3
-    bucket = connect_s3(bucket_name)
+    # Conexión al bucket de s3 y cliente de BQ, compartidos por todas las fuentes
+    bucket = get_bucket(yaml_vars)
 
-    # Iteramos sobre cada carpeta del bucket para la cual se tenga la ETL lista
-    for folder in folders:
-        print(f'Extrayendo datos de la fuente {folder}')
-        try:
-            all_data, check_list, date_list = extract(date_to_upload, folder, bucket)
-        except SkipFolderException as e:
-            print(e)
-            continue
-
-        # Cliente de BQ y variables
-        bq_client = bq_connect(credentials)
-        col_to_check='id'
-        dataset_id = folder.lower()
-        table_id_raw = get_table_id(dataset_id, yaml_vars)
-
-        # Subimos los datos a BQ. Subimos sólo los registros nuevos, si los hay, para garantizar la idempotencia del sistema
-        data_to_upload = check_unique(all_data, check_list, bq_client, col_to_check, date_list, project_id, dataset_id, table_id_raw)
-        if len(data_to_upload)==0:
-            msg = 'Todos los registros a cargar ya existen en BQ'
-            print(msg)
-            logging.info(msg)
-        else:
-            upload_raw_data(data_to_upload, project_id, dataset_id, table_id_raw, bq_client)
-            aggregated_tables(project_id, dataset_id, table_id_raw, bq_client)
+    # Una carga completa se puede repartir por fuente y día entre varias invocaciones de la función
+    if not is_event(body) and yaml_vars['env-vars']['date_to_upload'] == 'all' and yaml_vars['backfill']['mode'] != 'none':
+        from etl.backfill import run_backfill
+        failed = run_backfill(yaml_vars, bucket, get_bq_client(yaml_vars))
+        return f'Ejecución finalizada ({len(failed)} fragmentos con error)'
+
+    bq_client = get_bq_client(yaml_vars)
+    id_index = get_index(yaml_vars)
+
+    # Notificación del bucket (s3, SQS o SNS) o {"keys": [...]}: sólo se procesan esas keys.
+    # Si algo falla se devuelve un 500 para que quien la envía la reintente
+    if is_event(body):
+        from etl.events import run_event
+        failed = run_event(body, yaml_vars, bucket, bq_client, id_index, budget)
+        if failed:
+            return f'Error en las fuentes {", ".join(failed)}', 500
+        return 'Ejecución finalizada'
+
+    # Con una cola de notificaciones se procesan sólo los objetos nuevos, sin listar el bucket
+    events_vars = yaml_vars['events']
+    if events_vars['queue_url'] != 'none':
+        from etl.events import consume_queue
+        from etl.utils import connect_sqs
+        sqs_client = _cached('sqs_client', lambda: connect_sqs(events_vars['queue_url']))
+        consume_queue(sqs_client, events_vars['queue_url'], yaml_vars, bucket, bq_client,
+                      id_index, events_vars['max_messages'], events_vars['wait_seconds'], deadline, budget)
+        return 'Ejecución finalizada'
+
+    # Registro de los objetos ya procesados
+    state = get_state(yaml_vars, bq_client)
+    checkpoint = get_checkpoint_store(yaml_vars)
+
+    # Procesamos en paralelo cada carpeta del bucket para la cual se tenga la ETL lista
+    # Los fragmentos de una carga completa no recalculan las tablas agregadas: lo hace run_backfill al terminar todos
+    from etl.pipeline import run_folders
+    run_folders(folders, yaml_vars, bucket, bq_client, state, id_index, checkpoint, deadline, budget,
+                refresh='shard' not in body)
 
+    if deadline.expired():
+        return 'Ejecución interrumpida por el límite de tiempo, la siguiente la reanudará'
     return 'Ejecución finalizada'
@@ -0,0 +1,147 @@
+from collections import OrderedDict
+from urllib.parse import unquote_plus
+import json
+import logging
+from etl.utils import print_error
+
+def _records(payload):
+    """
+    Devuelve los registros de notificación de s3 que contiene un payload. Admite la notificación
+    de s3 tal cual, los mensajes de SQS (evento de Lambda o respuesta de receive_message), la
+    notificación envuelta en un mensaje de SNS y el cuerpo en texto de cualquiera de ellos.
+    """
+    if isinstance(payload, (str, bytes)):
+        try:
+            payload = json.loads(payload)
+        except ValueError:
+            return []
+    if not isinstance(payload, dict):
+        return []
+
+    # Mensaje de SNS: la notificación va como texto en Message
+    if payload.get('Type') == 'Notification' and 'Message' in payload:
+        return _records(payload['Message'])
+
+    # Respuesta de receive_message de SQS
+    if 'Messages' in payload:
+        return [record for message in payload['Messages'] for record in _records(message.get('Body'))]
+
+    records = []
+    for record in payload.get('Records', []):
+        if record.get('eventSource') == 'aws:sqs':
+            # Evento de SQS: cada mensaje lleva en body la notificación de s3
+            records.extend(_records(record.get('body')))
+        elif 's3' in record:
+            records.append(record)
+    return records
+
+def is_event(body):
+    """
+    Indica si el cuerpo de una petición es una notificación del bucket o una lista de keys.
+    """
+    return isinstance(body, dict) and ('keys' in body or 'Records' in body or 'Messages' in body
+                                       or body.get('Type') == 'Notification')
+
+def parse_event(payload, bucket_name, folders):
+    """
+    Extrae de un payload las keys de objetos nuevos del bucket, agrupadas por carpeta.
+    Además de las notificaciones de s3 (ver _records) admite {"keys": [...]} con las keys directamente.
+    Se ignoran las keys de otros buckets, de carpetas no configuradas y los eventos de borrado.
+
+    Parámetros:
+    - payload: dict o str cuerpo de la petición o del mensaje
+    - bucket_name: str bucket configurado
+    - folders: list carpetas configuradas
+    """
+    if isinstance(payload, dict) and 'keys' in payload:
+        keys = list(payload['keys'])
+    else:
+        keys = []
+        for record in _records(payload):
+            if not record.get('eventName', 'ObjectCreated').startswith('ObjectCreated'):
+                continue
+            s3 = record['s3']
+            if s3.get('bucket', {}).get('name', bucket_name) != bucket_name:
+                msg = f'Se ignora la notificación del bucket {s3["bucket"]["name"]}'
+                logging.warning(msg)
+                print_error(msg)
+                continue
+            # En las notificaciones las keys vienen codificadas como en una url
+            keys.append(unquote_plus(s3['object']['key']))
+
+    keys_by_folder = OrderedDict()
+    for key in keys:
+        folder = key.split('/', 1)[0]
+        if folder not in folders:
+            msg = f'Se ignora la key {key}, la carpeta {folder} no está configurada'
+            logging.warning(msg)
+            print_error(msg)
+            continue
+        # Sin repetidos, manteniendo el orden de llegada
+        keys_by_folder.setdefault(folder, OrderedDict())[key] = None
+    return {folder: list(folder_keys) for folder, folder_keys in keys_by_folder.items()}
+
+def run_event(payload, yaml_vars, bucket, bq_client, id_index=None, budget=None):
+    """
+    Procesa las keys de una notificación del bucket: extracción, validación, deduplicado y carga
+    sólo de esos objetos. Devuelve la lista de carpetas con algún error (vacía si todo ha ido bien).
+
+    Parámetros:
+    - payload: dict o str notificación de s3, mensaje de SQS/SNS o {"keys": [...]}
+    - yaml_vars: dict variables del config.yaml
+    - bucket: s3 bucket
+    - bq_client: google.cloud.bigquery.client.Client
+    - id_index: etl.id_index.IdIndex opcional
+    - budget: etl.query.QueryBudget opcional, presupuesto de bytes escaneados
+    """
+    keys_by_folder = parse_event(payload, bucket.name, yaml_vars['bucket']['folders'])
+    n_keys = sum(len(keys) for keys in keys_by_folder.values())
+    msg = f'Notificación con {n_keys} keys de {len(keys_by_folder)} fuentes'
+    logging.info(msg)
+    print(msg)
+    if n_keys == 0:
+        return []
+
+    from etl.pipeline import run_keys
+    return run_keys(keys_by_folder, yaml_vars, bucket, bq_client, id_index, budget)
+
+def consume_queue(sqs_client, queue_url, yaml_vars, bucket, bq_client, id_index=None, max_messages=10, wait_seconds=20,
+                  deadline=None, budget=None):
+    """
+    Vacía una cola de SQS con notificaciones del bucket, procesando los mensajes en lotes de hasta
+    max_messages. Los mensajes sólo se borran de la cola si su lote se ha cargado sin errores;
+    si no, SQS los vuelve a entregar y el deduplicado evita duplicar lo que sí llegó a BQ.
+    Termina cuando la cola no devuelve más mensajes o se alcanza el límite de tiempo (los mensajes
+    que quedan se procesan en la siguiente ejecución). Devuelve el número de mensajes procesados.
+
+    Parámetros:
+    - sqs_client: cliente de SQS de boto3 (o etl.fakes.LocalQueue)
+    - queue_url: str url de la cola
+    - yaml_vars: dict variables del config.yaml
+    - bucket: s3 bucket
+    - bq_client: google.cloud.bigquery.client.Client
+    - id_index: etl.id_index.IdIndex opcional
+    - max_messages: int mensajes por lote (máximo 10 en SQS)
+    - wait_seconds: int espera máxima de cada lectura (long polling)
+    - deadline: etl.checkpoint.Deadline opcional, límite de tiempo de la ejecución
+    - budget: etl.query.QueryBudget opcional, presupuesto de bytes escaneados de toda la ejecución
+    """
+    processed = 0
+    while True:
+        if deadline and deadline.expired():
+            msg = f'Límite de tiempo alcanzado, se deja de leer la cola tras {processed} mensajes'
+            logging.warning(msg)
+            print_error(msg)
+            return processed
+        response = sqs_client.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=max_messages,
+                                              WaitTimeSeconds=wait_seconds)
+        messages = response.get('Messages', [])
+        if len(messages) == 0:
+            return processed
+
+        failed = run_event({'Messages': messages}, yaml_vars, bucket, bq_client, id_index, budget)
+        if failed:
+            continue
+        for message in messages:
+            sqs_client.delete_message(QueueUrl=queue_url, ReceiptHandle=message['ReceiptHandle'])
+        processed += len(messages)
@@ -0,0 +1,237 @@
+import codecs
+import gzip
+import importlib.util
+import json
+import logging
+import re
+from etl.utils import print_error
+
+# Extensiones de los objetos que se procesan y compresiones admitidas
+FORMATS = ('.json', '.ndjson', '.jsonl')
+COMPRESSIONS = {'.gz': 'gzip', '.zst': 'zstd', '.zstd': 'zstd'}
+
+def split_key(key):
+    """
+    Devuelve (formato, compresión) de un objeto según su extensión, o None si no se procesa.
+    P.ej. 'x.json' -> ('.json', None), 'x.ndjson.gz' -> ('.ndjson', 'gzip').
+
+    Parámetros:
+    - key: str key del objeto
+    """
+    compression = None
+    for ext, name in COMPRESSIONS.items():
+        if key.endswith(ext):
+            key, compression = key[:-len(ext)], name
+            break
+    for ext in FORMATS:
+        if key.endswith(ext):
+            return ext, compression
+    return None
+
+# El soporte de zstd es opcional (librería zstandard): sin ella los .zst no se procesan
+ZSTD_AVAILABLE = importlib.util.find_spec('zstandard') is not None
+_zstd_warned = False
+
+def is_supported(key):
+    """
+    Indica si un objeto tiene una extensión que se sabe procesar. Los comprimidos con zstd sólo si
+    está instalada la librería zstandard: si no, se ignoran (con un aviso en el log) en lugar de
+    fallar al leerlos, que contaría como error de lectura y bloquearía el punto de avance. Como no
+    se marcan como procesados, se cargan en cuanto se instale.
+    """
+    global _zstd_warned
+    parts = split_key(key)
+    if parts is None:
+        return False
+    if parts[1] == 'zstd' and not ZSTD_AVAILABLE:
+        if not _zstd_warned:
+            _zstd_warned = True
+            msg = f'{key}: los objetos comprimidos con zstd se ignoran, falta la librería zstandard'
+            logging.warning(msg)
+            print_error(msg)
+        return False
+    return True
+
+def is_stream(key):
+    """
+    Indica si un objeto se lee en streaming (comprimido o con un registro por línea) en lugar de
+    descargarse entero: los .json sin comprimir tienen normalmente un solo registro y son pequeños.
+    """
+    fmt, compression = split_key(key)
+    return compression is not None or fmt != '.json'
+
+def decompress(stream, compression):
+    """
+    Envuelve el stream del objeto en un descompresor, sin leerlo.
+    Para zstd hace falta la librería zstandard (ver is_supported).
+
+    Parámetros:
+    - stream: objeto con read() (el Body de get_object)
+    - compression: str 'gzip', 'zstd' o None
+    """
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=stream)
+    if compression == 'zstd':
+        import zstandard
+        return zstandard.ZstdDecompressor().stream_reader(stream)
+    return stream
+
+def _iter_chunks(stream, chunk_size):
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+def _iter_lines(chunks, first=b''):
+    """
+    Parte en líneas un stream de bytes leído por trozos.
+    """
+    rest = first
+    for chunk in chunks:
+        lines = (rest + chunk).split(b'\n')
+        rest = lines.pop()
+        yield from lines
+    if rest:
+        yield rest
+
+# Salta hasta el siguiente carácter que delimita los elementos de un array json, pasando por encima
+# de las cadenas completas: dentro de un elemento sólo interesan {} y [], en el primer nivel también
+# las comas. Una comilla suelta es una cadena que sigue en el siguiente trozo.
+_STRING = r'"[^"\\]*+(?:\\.[^"\\]*+)*+"'
+_NEXT_BRACKET = re.compile(r'[^"\[\]{}]*+(?:' + _STRING + r'[^"\[\]{}]*+)*+(["\[\]{}])', re.S)
+_NEXT_SEPARATOR = re.compile(r'[^"\[\]{},]*+(?:' + _STRING + r'[^"\[\]{},]*+)*+(["\[\]{},])', re.S)
+_BLANK = re.compile(r'\s*')
+
+def _element_end(buffer, pos):
+    """
+    Devuelve dónde termina el elemento de un array json que empieza en pos (la coma o el ']' del
+    primer nivel que lo sigue), sin parsearlo, o None si sigue en el siguiente trozo.
+    """
+    depth = 0
+    while True:
+        match = (_NEXT_BRACKET if depth else _NEXT_SEPARATOR).match(buffer, pos)
+        if match is None or match.group(1) == '"':
+            return None
+        pos = match.end()
+        token = match.group(1)
+        if token in '{[':
+            depth += 1
+        elif depth > 0:
+            depth -= 1
+        elif token in ',]':
+            return match.start(1)
+
+def _iter_array(chunks, first, key, loads):
+    """
+    Devuelve uno a uno los elementos de un array json sin cargarlo entero: se decodifica el texto
+    por trozos y se delimita cada elemento con JSONDecoder.raw_decode (en C) en cuanto está completo.
+    Con el backend json ese es ya el registro; con los demás se parsea el elemento con loads. Un
+    elemento que no se puede parsear se descarta (con un error en el log) y se sigue en el siguiente,
+    que se busca contando {} y [] (ver _element_end), como con las líneas de NDJSON.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = text_decoder.decode(first).lstrip()[1:]   # sin el '['
+    pos, number, eof = 0, 0, False
+
+    while True:
+        # Separadores entre elementos
+        pos = _BLANK.match(buffer, pos).end()
+        if buffer[pos:pos + 1] == ',':
+            pos = _BLANK.match(buffer, pos + 1).end()
+        if buffer[pos:pos + 1] == ']':
+            return
+
+        if pos < len(buffer):
+            try:
+                record, end = decoder.raw_decode(buffer, pos)
+                error = None
+                if loads is not json.loads and (end < len(buffer) or eof):
+                    record = loads(buffer[pos:end])
+            except Exception as e:
+                # Cada backend lanza su propia excepción (msgspec no hereda de ValueError)
+                end, error = _element_end(buffer, pos), e
+            # Si el elemento llega justo al final del buffer puede que siga en el siguiente trozo
+            if end is not None and (end < len(buffer) or eof):
+                number += 1
+                if error is None:
+                    yield end - pos, record
+                else:
+                    msg = f'{key}: el elemento {number} del array no es un json válido, se descarta ({error})'
+                    logging.error(msg)
+                    print_error(msg)
+                pos = end
+                continue
+        if eof:
+            raise ValueError('El array json no está cerrado')
+
+        # Hace falta leer más
+        chunk = next(chunks, None)
+        if chunk is None:
+            eof = True
+            buffer = buffer[pos:] + text_decoder.decode(b'', final=True)
+        else:
+            buffer = buffer[pos:] + text_decoder.decode(chunk)
+        pos = 0
+
+def iter_stream(stream, key, loads, chunk_size=1 << 20):
+    """
+    Devuelve (tamaño, registro) de cada registro de un objeto leyéndolo en streaming, de forma que
+    nunca se tiene el objeto entero en memoria. Admite NDJSON (.ndjson/.jsonl, un registro por
+    línea), arrays json y json de un solo registro, comprimidos o no con gzip o zstd.
+    Una línea de NDJSON o un elemento de un array que no se puede parsear se descarta (con un error
+    en el log) y se sigue con los siguientes: un registro mal formado no hace perder el resto del objeto.
+
+    Parámetros:
+    - stream: objeto con read() (el Body de get_object)
+    - key: str key del objeto, para saber el formato y la compresión
+    - loads: función con la que se parsea cada registro (ver etl.decoders)
+    - chunk_size: int bytes que se leen cada vez
+    """
+    fmt, compression = split_key(key)
+    chunks = _iter_chunks(decompress(stream, compression), chunk_size)
+
+    if fmt in ('.ndjson', '.jsonl'):
+        for number, line in enumerate(_iter_lines(chunks), 1):
+            if not line.strip():
+                continue
+            try:
+                record = loads(line)
+            except Exception as e:
+                # Cada backend lanza su propia excepción (msgspec no hereda de ValueError)
+                msg = f'{key}: la línea {number} no es un json válido, se descarta ({e})'
+                logging.error(msg)
+                print_error(msg)
+                continue
+            yield len(line), record
+        return
+
+    # .json: un array de registros o un solo registro
+    first = b''
+    for chunk in chunks:
+        first += chunk
+        if first.strip():
+            break
+    if first.lstrip()[:1] == b'[':
+        yield from _iter_array(chunks, first, key, loads)
+    else:
+        body = first + b''.join(chunks)
+        yield len(body), loads(body)
+
+def iter_body(body, loads):
+    """
+    Devuelve (tamaño, registro) de cada registro de un .json ya descargado: un solo registro o
+    un array de registros.
+
+    Parámetros:
+    - body: bytes contenido del objeto
+    - loads: función con la que se parsea (ver etl.decoders)
+    """
+    data = loads(body)
+    if isinstance(data, list):
+        size = len(body) // max(len(data), 1)
+        for record in data:
+            yield size, record
+    else:
+        yield len(body), data
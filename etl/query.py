@@ -0,0 +1,106 @@
+import logging
+import threading
+from etl.utils import print_error
+
+class BudgetExceededException(Exception):
+    pass
+
+class QueryBudget:
+    """
+    Presupuesto de bytes escaneados por BQ en una ejecución. Antes de lanzar cada query se estima
+    con un dry run (que no se cobra) cuánto va a leer y sólo se lanza si cabe en lo que queda.
+    Es thread-safe: lo comparten todas las fuentes y días que se procesan en paralelo.
+
+    Parámetros:
+    - max_bytes: int bytes máximos de la ejecución (0 -> sin límite, sólo se estima y se apunta)
+    """
+    def __init__(self, max_bytes=0):
+        self.max_bytes = max_bytes
+        self.spent = 0
+        self._lock = threading.Lock()
+
+    def try_spend(self, nbytes):
+        """
+        Descuenta nbytes del presupuesto si caben. Devuelve False (sin descontar nada) si no.
+
+        Parámetros:
+        - nbytes: int bytes estimados de la query
+        """
+        with self._lock:
+            if self.max_bytes and self.spent + nbytes > self.max_bytes:
+                return False
+            self.spent += nbytes
+            return True
+
+    def remaining(self):
+        """
+        Bytes que quedan del presupuesto (None si no hay límite).
+        """
+        with self._lock:
+            return max(self.max_bytes - self.spent, 0) if self.max_bytes else None
+
+def estimate_bytes(bq_client, query, job_config=None):
+    """
+    Devuelve los bytes que BQ estima que va a procesar una query, con un dry run (no se ejecuta ni se cobra).
+
+    Parámetros:
+    - bq_client: google.cloud.bigquery.client.Client
+    - query: str query a estimar
+    - job_config: bigquery.QueryJobConfig opcional, de él se toman los parámetros de la query
+    """
+    from google.cloud import bigquery
+    dry_run_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False,
+                                             query_parameters=job_config.query_parameters if job_config else [])
+    return bq_client.query(query, job_config=dry_run_config).total_bytes_processed or 0
+
+def run_query(bq_client, query, budget=None, metrics=None, stage='query', estimate=None, fallback=None, job_config=None):
+    """
+    Lanza una query pasando antes por el presupuesto de la ejecución: se estima con un dry run, se
+    apuntan los bytes estimados en la etapa de las métricas y, si no cabe en el presupuesto, se prueba
+    con la variante más barata (fallback). Si tampoco cabe se rechaza con BudgetExceededException.
+    Devuelve el job de BQ sin esperar a que termine. Sin presupuesto se lanza la query directamente.
+
+    Parámetros:
+    - bq_client: google.cloud.bigquery.client.Client
+    - query: str query (o script) a lanzar
+    - budget: QueryBudget opcional
+    - metrics: etl.metrics.RunMetrics opcional, los bytes estimados se apuntan en stage y las
+      queries rechazadas en 'query_refused'
+    - stage: str etapa de las métricas
+    - estimate: str opcional, query cuyo dry run estima el coste de query. En los scripts (DELETE +
+      INSERT, tablas temporales) se estima la lectura de la tabla raw, que es lo que cuesta
+    - fallback: tuple opcional (query, estimate) variante que lee menos particiones
+    - job_config: bigquery.QueryJobConfig opcional (p.ej. con los parámetros de la query)
+    """
+    if budget is None:
+        return bq_client.query(query, job_config=job_config)
+
+    for candidate, candidate_estimate in [(query, estimate)] + ([fallback] if fallback else []):
+        nbytes = estimate_bytes(bq_client, candidate_estimate or candidate, job_config)
+        if metrics:
+            metrics.add(stage, calls=0, bytes_estimated=nbytes)
+        if budget.try_spend(nbytes):
+            if candidate is not query:
+                msg = f'{stage}: la query no cabe en el presupuesto de bytes, se lanza la variante acotada ({nbytes} bytes)'
+                logging.warning(msg)
+                print_error(msg)
+            return bq_client.query(candidate, job_config=job_config)
+
+    if metrics:
+        metrics.add('query_refused', items=1, bytes_estimated=nbytes)
+    msg = (f'{stage}: la query leería {nbytes} bytes y sólo quedan {budget.remaining()} del presupuesto '
+           f'de la ejecución (bigquery.max_scan_gb), no se lanza')
+    raise BudgetExceededException(msg)
+
+def get_query_budget(yaml_vars):
+    """
+    Crea el presupuesto de bytes de la ejecución a partir de la sección bigquery del config.yaml,
+    o None si no se estiman las queries. Se debe llamar al empezar la ejecución (o la petición).
+
+    Parámetros:
+    - yaml_vars: dict variables del config.yaml
+    """
+    bq_vars = yaml_vars['bigquery']
+    if not bq_vars['dry_run'] and bq_vars['max_scan_gb'] == 0:
+        return None
+    return QueryBudget(bq_vars['max_scan_gb'] * 1024 ** 3)
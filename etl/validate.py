@@ -0,0 +1,159 @@
+from functools import lru_cache
+import re
+from etl.sources import get_source
+
+_INTEGER = re.compile(r'^[+-]?\d+$')
+_FLOAT = re.compile(r'^[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?$')
+_TIMESTAMP = re.compile(r'^\d{4}-\d{2}-\d{2}([T ]\d{2}:\d{2}(:\d{2}(\.\d+)?)?)?(Z|[+-]\d{2}:?\d{2}| UTC)?$')
+_DATE = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+
+def _is_integer(value):
+    if isinstance(value, bool):
+        return False
+    return isinstance(value, int) or (isinstance(value, str) and _INTEGER.match(value) is not None)
+
+def _is_float(value):
+    if isinstance(value, bool):
+        return False
+    return isinstance(value, (int, float)) or (isinstance(value, str) and _FLOAT.match(value) is not None)
+
+def _is_boolean(value):
+    return isinstance(value, bool) or value in ('true', 'false', 'True', 'False')
+
+def _is_timestamp(value):
+    # BQ admite también segundos desde epoch, pero la ETL saca el día de la cadena (YYYY-MM-DD...)
+    return isinstance(value, str) and _TIMESTAMP.match(value) is not None
+
+def _is_date(value):
+    return isinstance(value, str) and _DATE.match(value) is not None
+
+# Comprobaciones de tipo equivalentes a lo que acepta una carga de json en BQ
+TYPE_CHECKS = {
+    'STRING': lambda value: isinstance(value, str),
+    'INTEGER': _is_integer,
+    'INT64': _is_integer,
+    'FLOAT': _is_float,
+    'FLOAT64': _is_float,
+    'NUMERIC': _is_float,
+    'BOOLEAN': _is_boolean,
+    'BOOL': _is_boolean,
+    'TIMESTAMP': _is_timestamp,
+    'DATETIME': _is_timestamp,
+    'DATE': _is_date,
+}
+
+def _compile_record(fields, path, exact_keys=False, optional=()):
+    """
+    Compila la comprobación de un diccionario contra los campos de un RECORD del esquema.
+    Devuelve una función que recibe el diccionario y devuelve un mensaje de error o None.
+
+    Parámetros:
+    - fields: list de bigquery.SchemaField
+    - path: str ruta del campo, para los mensajes de error
+    - exact_keys: bool si es True también se exige que estén todas las keys (primer nivel)
+    - optional: iterable keys que pueden faltar aunque exact_keys sea True
+    """
+    checks = {field.name: _compile_field(field, f'{path}{field.name}') for field in fields}
+    names = frozenset(checks)
+    required = frozenset(field.name for field in fields
+                         if field.mode == 'REQUIRED' or (exact_keys and field.name not in optional))
+    label = f'"{path[:-1]}"' if path else 'el registro'
+
+    def check(value):
+        if not isinstance(value, dict):
+            return f'{label} debería ser un objeto'
+        keys = value.keys()
+        if not names.issuperset(keys):
+            return f'Hay keys nuevas en {label}: {sorted(set(keys) - names)}'
+        if not required.issubset(keys):
+            return f'Faltan keys en {label}: {sorted(required - set(keys))}'
+        for name, item in value.items():
+            error = checks[name](item)
+            if error:
+                return error
+        return None
+
+    return check
+
+def _compile_field(field, path):
+    """
+    Compila la comprobación de un campo del esquema según su tipo y modo.
+
+    Parámetros:
+    - field: bigquery.SchemaField
+    - path: str ruta del campo, para los mensajes de error
+    """
+    if field.field_type in ('RECORD', 'STRUCT'):
+        check_value = _compile_record(field.fields, f'{path}.')
+    else:
+        type_check = TYPE_CHECKS.get(field.field_type, lambda value: True)
+        field_type = field.field_type
+
+        def check_value(value):
+            if not type_check(value):
+                return f'"{path}" debería ser de tipo {field_type}: {value!r}'
+            return None
+
+    if field.mode == 'REPEATED':
+        def check(value):
+            if value is None:
+                return None
+            if not isinstance(value, list):
+                return f'"{path}" debería ser una lista'
+            for item in value:
+                error = check_value(item)
+                if error:
+                    return error
+            return None
+    elif field.mode == 'REQUIRED':
+        def check(value):
+            if value is None:
+                return f'"{path}" no puede ser nulo'
+            return check_value(value)
+    else:
+        def check(value):
+            if value is None:
+                return None
+            return check_value(value)
+
+    return check
+
+def compile_validator(schema, optional=()):
+    """
+    Compila un esquema de BQ en una función que valida un registro completo, incluidos los campos
+    anidados (RECORD/REPEATED) y los tipos escalares. La función devuelve True si el registro es
+    válido o un mensaje con el error en caso contrario.
+
+    Parámetros:
+    - schema: list de bigquery.SchemaField
+    - optional: iterable keys del primer nivel que pueden faltar (las que rellena la limpieza por lotes)
+    """
+    # En el primer nivel se exigen exactamente las keys del esquema, como hasta ahora
+    check_record = _compile_record(schema, '', exact_keys=True, optional=optional)
+
+    def validate(json_obj):
+        error = check_record(json_obj)
+        if error:
+            record_id = json_obj.get('id') if isinstance(json_obj, dict) else None
+            return f'Registro {record_id} no válido. {error}'
+        return True
+
+    return validate
+
+def get_validator(dataset_id, optional=()):
+    """
+    Devuelve el validador compilado de una fuente. Se compila una sola vez por cada fuente cargada:
+    si load_sources vuelve a cargar las fuentes (p.ej. con otro esquema) se compila de nuevo.
+
+    Parámetros:
+    - dataset_id: str dataset de BQ
+    - optional: tuple keys del primer nivel que pueden faltar
+    """
+    return _source_validator(get_source(dataset_id), tuple(optional))
+
+@lru_cache(maxsize=None)
+def _source_validator(source, optional):
+    """
+    Validador compilado de una fuente (etl.sources.Source), cacheado por el objeto de la fuente.
+    """
+    return compile_validator(source.schema, optional)
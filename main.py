@@ -1,6 +1,11 @@
-from etl.utils import connect_s3, bq_connect, load_yaml_to_dict, check_yaml_vars
-from etl.load import upload_raw_data, check_unique, get_table_id, aggregated_tables
-from etl.extract import extract, SkipFolderException
+from etl.utils import connect_s3, connect_sqs, bq_connect, load_yaml_to_dict, check_yaml_vars, get_pool_sizes
+from etl.pipeline import run_folders
+from etl.state import get_state_store
+from etl.id_index import get_id_index
+from etl.backfill import run_backfill
+from etl.events import consume_queue
+from etl.checkpoint import get_checkpoint, get_deadline
+from etl.query import get_query_budget
 import logging
 
 logging.basicConfig(
@@ -14,40 +19,42 @@ def main():
     # Se obtienen las variables guardadas en el config.yaml y comprobación de que están bien definidas
     yaml_vars = load_yaml_to_dict('config.yaml')
     yaml_vars = check_yaml_vars(yaml_vars)        
+    # Límite de tiempo de la ejecución, contado desde que empieza
+    deadline = get_deadline(yaml_vars)
+    # Presupuesto de bytes escaneados en BQ de la ejecución
+    budget = get_query_budget(yaml_vars)
 
-    project_id = yaml_vars['env-vars']['project_id']
     bucket_name = yaml_vars['bucket']['bucket_name']
     folders = yaml_vars['bucket']['folders']
-    date_to_upload = yaml_vars['env-vars']['date_to_upload']
     credentials = yaml_vars['env-vars']['credentials']
-
-    # Conexión al bucket de s3
-    bucket = connect_s3(bucket_name)
-
-    # Iteramos sobre cada carpeta del bucket para la cual se tenga la ETL lista
-    for folder in folders:
-        print(f'Extrayendo datos de la fuente {folder}')
-        try:
-            all_data, check_list, date_list = extract(date_to_upload, folder, bucket)
-        except SkipFolderException as e:
-            print(e)
-            continue
-
-        # Cliente de BQ y variables
-        bq_client = bq_connect(credentials)
-        col_to_check='id'
-        dataset_id = folder.lower()
-        table_id_raw = get_table_id(dataset_id, yaml_vars)
-
-        # Subimos los datos a BQ. Subimos sólo los registros nuevos, si los hay, para garantizar la idempotencia del sistema
-        data_to_upload = check_unique(all_data, check_list, bq_client, col_to_check, date_list, project_id, dataset_id, table_id_raw)
-        if len(data_to_upload)==0:
-            msg = 'Todos los registros a cargar ya existen en BQ'
-            print(msg)
-            logging.info(msg)
-        else:
-            upload_raw_data(data_to_upload, project_id, dataset_id, table_id_raw, bq_client)
-            aggregated_tables(project_id, dataset_id, table_id_raw, bq_client)
+    # Los pools http se dimensionan para todas las fuentes y días que se procesan a la vez
+    s3_pool_size, bq_pool_size = get_pool_sizes(yaml_vars)
+
+    # Conexión al bucket de s3 y cliente de BQ, compartidos por todas las fuentes
+    bucket = connect_s3(bucket_name, max_pool_connections=s3_pool_size)
+
+    # Una carga completa se puede repartir por fuente y día entre varios procesos
+    if yaml_vars['env-vars']['date_to_upload'] == 'all' and yaml_vars['backfill']['mode'] != 'none':
+        run_backfill(yaml_vars, bucket)
+        return
+
+    bq_client = bq_connect(credentials, pool_size=bq_pool_size)
+    id_index = get_id_index(yaml_vars)
+
+    # Con una cola de notificaciones se procesan sólo los objetos nuevos, sin listar el bucket
+    events_vars = yaml_vars['events']
+    if events_vars['queue_url'] != 'none':
+        consume_queue(connect_sqs(events_vars['queue_url']), events_vars['queue_url'], yaml_vars, bucket, bq_client,
+                      id_index, events_vars['max_messages'], events_vars['wait_seconds'], deadline, budget)
+        return
+
+    # Registro de los objetos ya procesados
+    state = get_state_store(yaml_vars, bq_client)
+    # Punto de avance de cada prefijo, para seguir donde se quedó una ejecución cortada
+    checkpoint = get_checkpoint(yaml_vars)
+
+    # Procesamos en paralelo cada carpeta del bucket para la cual se tenga la ETL lista
+    run_folders(folders, yaml_vars, bucket, bq_client, state, id_index, checkpoint, deadline, budget)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,51 @@
+"""
+Fixtures comunes de los tests: el config.yaml del repo con las rutas absolutas, un bucket local
+(etl.fakes.LocalBucket) y el cliente de BQ en memoria (etl.fakes.FakeBigQueryClient).
+"""
+import os
+import pytest
+from etl.fakes import LocalBucket, FakeBigQueryClient
+from etl.utils import load_yaml_to_dict, check_yaml_vars
+from benchmarks.generate import generate_objects
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.fixture
+def yaml_vars(tmp_path):
+    """
+    Variables del config.yaml del repo, sin estado ni puntos de avance y con los ficheros en tmp_path.
+    """
+    yaml_vars = load_yaml_to_dict(os.path.join(ROOT, 'config.yaml'))
+    for source in yaml_vars['sources'].values():
+        source['schema'] = os.path.join(ROOT, source['schema'])
+    yaml_vars['env-vars']['project_id'] = 'p'
+    yaml_vars['extract'].update(max_workers=2, list_workers=1)
+    yaml_vars['state'].update(backend='none', path=str(tmp_path / 'etl_state.db'))
+    yaml_vars['checkpoint'].update(backend='none', path=str(tmp_path / 'etl_checkpoints'))
+    yaml_vars['bigquery']['quarantine_path'] = str(tmp_path / 'quarantine.ndjson')
+    yaml_vars['id_index']['path'] = str(tmp_path / 'etl_ids.db')
+    return check_yaml_vars(yaml_vars)
+
+@pytest.fixture
+def bucket(tmp_path):
+    return LocalBucket(str(tmp_path / 'bucket'))
+
+@pytest.fixture
+def bq_client():
+    return FakeBigQueryClient('p')
+
+def fill_bucket(bucket, source='Tweet', records=30, start_date='2024/08/01', days=1, seed=0):
+    """
+    Sube al bucket registros sintéticos de una fuente (un objeto .json por registro) y devuelve sus keys.
+    """
+    keys = []
+    for key, body in generate_objects(source, records, start_date, days, seed):
+        bucket.put_object(key, body)
+        keys.append(key)
+    return keys
+
+def raw_ids(bq_client, table='p.tweet.raw_tweet'):
+    """
+    Ids de la tabla raw de la fuente en el cliente en memoria.
+    """
+    return [row['id'] for row in bq_client.tables.get(table, [])]
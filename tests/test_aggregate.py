@@ -0,0 +1,79 @@
+import re
+import pytest
+from google.api_core.exceptions import BadRequest
+from benchmarks.payloads import sample_tweet
+from etl.aggregate import aggregated_tables, get_aggregates, grouping_sets_query, refresh_query, AggregateDeltas
+
+RAW = 'p.tweet.raw_tweet'
+
+def test_grouping_sets_reads_the_raw_table_once(yaml_vars, bq_client):
+    aggregated_tables('p', 'tweet', 'raw_tweet', bq_client, ['2024-08-01', '2024-08-02'], 'grouping_sets')
+
+    (query, _), = bq_client.queries
+    assert query.count(f'`{RAW}`') == 1
+    assert 'GROUP BY GROUPING SETS ((DATE(t.date), category IS NOT NULL, category.name), ' \
+           '(DATE(t.date), t.user.location.country), (DATE(t.date), t.sentiment))' in query
+    # Cada tabla se rellena desde la misma lectura, sólo con los días del lote y en una transacción
+    for aggregate in get_aggregates('p', 'tweet'):
+        assert f"DELETE FROM `{aggregate['table']}` WHERE date IN (DATE \"2024-08-01\", DATE \"2024-08-02\")" in query
+        assert re.search(rf"INSERT INTO `{aggregate['table']}` .*?FROM daily_counts WHERE grouping_{aggregate['dimension']} = 0",
+                         query, re.S)
+    assert query.index('BEGIN TRANSACTION') < query.index('DELETE FROM') < query.index('COMMIT TRANSACTION')
+    assert "WHERE TIMESTAMP_TRUNC(t.date, DAY) IN (TIMESTAMP(\"2024-08-01\"), TIMESTAMP(\"2024-08-02\"))" in query
+
+def test_categories_keep_records_without_categories_in_other_dimensions(yaml_vars):
+    query = grouping_sets_query(RAW, get_aggregates('p', 'tweet'), ['2024-08-01'])
+
+    assert 'LEFT JOIN UNNEST(t.categories) AS category' in query
+    assert 'WHERE grouping_category_name = 0 AND has_category' in query
+    assert re.search(r'WHERE grouping_country = 0\s*;', query)
+
+def test_separate_mode_runs_one_query_per_table(yaml_vars, bq_client):
+    aggregated_tables('p', 'tweet', 'raw_tweet', bq_client, ['2024-08-01'], 'separate')
+
+    queries = [query for query, _ in bq_client.queries]
+    assert len(queries) == 3
+    assert all(query.count(f'`{RAW}`') == 1 for query in queries)
+
+def test_dated_refresh_only_replaces_the_partitions_of_those_days(yaml_vars):
+    aggregate = get_aggregates('p', 'tweet')[1]
+    query = refresh_query(RAW, aggregate, ['2024-08-01'])
+
+    assert 'CREATE OR REPLACE' not in query
+    assert f"CREATE TABLE IF NOT EXISTS `{aggregate['table']}`" in query
+    assert re.search(rf"PARTITION BY date\s+CLUSTER BY {aggregate['dimension']};", query)
+    assert f"DELETE FROM `{aggregate['table']}` WHERE date IN (DATE \"2024-08-01\")" in query
+    assert "WHERE TIMESTAMP_TRUNC(t.date, DAY) IN (TIMESTAMP(\"2024-08-01\"))" in query
+
+@pytest.mark.parametrize('mode', ['separate', 'grouping_sets'])
+def test_unpartitioned_tables_are_migrated_before_the_refresh(yaml_vars, bq_client, mode):
+    # Tablas creadas por versiones anteriores con CREATE OR REPLACE ... CLUSTER BY date, sin particionar
+    aggregates = get_aggregates('p', 'tweet')
+    for aggregate in aggregates:
+        bq_client.tables[aggregate['table']] = [{'date': '2024-07-31', aggregate['dimension']: 'x', 'count': 3}]
+    with pytest.raises(BadRequest, match='different partitioning spec'):
+        bq_client.query(refresh_query(RAW, aggregates[0])).result()
+
+    aggregated_tables('p', 'tweet', 'raw_tweet', bq_client, ['2024-08-01'], mode)
+    aggregated_tables('p', 'tweet', 'raw_tweet', bq_client, None, mode, fallback_days=0)
+
+    migrations = [query for query, _ in bq_client.queries if 'RENAME TO' in query]
+    assert len(migrations) == len(aggregates)
+    for aggregate in aggregates:
+        assert bq_client.get_table(aggregate['table']).time_partitioning.field == 'date'
+        assert f"{aggregate['table']}_partitioned" not in bq_client.tables
+    # La reconstrucción completa ya no choca con el particionado
+    refresh = [query for query, _ in bq_client.queries if 'CREATE OR REPLACE TABLE' in query and 'RENAME TO' not in query]
+    assert refresh and all(bq_client.query(query).result() == [] for query in refresh)
+
+def test_migration_keeps_the_rows_and_runs_before_the_deltas(yaml_vars, bq_client):
+    aggregate = get_aggregates('p', 'tweet')[2]
+    table, dimension = aggregate['table'], aggregate['dimension']
+    bq_client.tables[table] = [{'date': '2024-07-31', dimension: 'positive', 'count': 3}]
+
+    deltas = AggregateDeltas('p', 'tweet')
+    assert deltas.apply([sample_tweet(1, date='2024-08-01T10:00:00.000Z')], bq_client)
+
+    assert bq_client.get_table(table).time_partitioning.field == 'date'
+    rows = {row['date']: row['count'] for row in bq_client.tables[table]}
+    assert rows['2024-07-31'] == 3 and rows['2024-08-01'] == 1
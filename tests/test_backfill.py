@@ -0,0 +1,24 @@
+import sqlite3
+from etl.backfill import plan_backfill, run_shards_local
+from etl.fakes import LocalBucket, FakeBigQueryClient
+from conftest import fill_bucket
+
+def local_clients(yaml_vars):
+    # A nivel de módulo para que se pueda pasar a los procesos del pool
+    return LocalBucket(yaml_vars['bucket']['bucket_name']), FakeBigQueryClient('p')
+
+def test_local_shards_share_one_state_db(yaml_vars, bucket, tmp_path):
+    keys = fill_bucket(bucket, records=40, start_date='2024/08/01', days=2)
+    yaml_vars['bucket'].update(bucket_name=str(tmp_path / 'bucket'), folders=['Tweet'])
+    yaml_vars['state']['backend'] = 'sqlite'
+    shards = plan_backfill(bucket, ['Tweet'])
+    assert [shard['date'] for shard in shards] == ['2024/08/01', '2024/08/02']
+
+    assert run_shards_local(shards, yaml_vars, processes=2, connect=local_clients) == []
+
+    with sqlite3.connect(yaml_vars['state']['path']) as conn:
+        assert conn.execute('PRAGMA journal_mode').fetchone() == ('wal',)
+        processed = sorted(row[0] for row in conn.execute('SELECT key FROM processed_keys'))
+        watermarks = conn.execute('SELECT prefix FROM prefix_watermarks ORDER BY prefix').fetchall()
+    assert processed == sorted(keys)
+    assert watermarks == [('Tweet/2024/08/01/',), ('Tweet/2024/08/02/',)]
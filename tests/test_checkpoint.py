@@ -0,0 +1,61 @@
+import pytest
+from etl.checkpoint import Deadline, FileCheckpoint, ObjectCheckpoint
+from etl.fakes import LocalBucket
+from etl.pipeline import run_folders
+from conftest import fill_bucket, raw_ids
+
+class StepDeadline(Deadline):
+    """
+    Límite de tiempo que se alcanza después de n consultas, para cortar las ejecuciones a mitad.
+    """
+    def __init__(self, n):
+        super().__init__(0)
+        self.n = n
+
+    def expired(self):
+        self.n -= 1
+        return self.n < 0
+
+@pytest.fixture(params=['file', 'object'])
+def checkpoint(request, tmp_path):
+    if request.param == 'file':
+        return FileCheckpoint(str(tmp_path / 'checkpoints'))
+    return ObjectCheckpoint(LocalBucket(str(tmp_path / 'checkpoint_bucket')), 'etl_checkpoints')
+
+def test_interrupted_runs_resume_until_the_prefix_is_done(yaml_vars, bucket, bq_client, checkpoint):
+    fill_bucket(bucket, records=300, start_date='2024/08/01', days=3)
+    yaml_vars['env-vars']['date_to_upload'] = 'all'
+    yaml_vars['extract'].update(batch_size=20, list_workers=3)
+
+    cursors = []
+    for _ in range(20):
+        run_folders(['Tweet'], yaml_vars, bucket, bq_client, checkpoint=checkpoint, deadline=StepDeadline(60))
+        cursor = checkpoint.get('Tweet/')
+        if cursor is None:
+            break
+        cursors.append(cursor)
+
+    # Cada ejecución ha avanzado y la última ha terminado el prefijo y borrado su punto de avance
+    assert len(cursors) > 1 and cursors == sorted(set(cursors))
+    assert checkpoint.get('Tweet/') is None
+    ids = raw_ids(bq_client)
+    assert len(ids) == len(set(ids)) == 300
+
+def test_failed_batch_does_not_move_the_checkpoint(yaml_vars, bucket, bq_client, checkpoint):
+    keys = sorted(fill_bucket(bucket, records=40, start_date='2024/08/01'))
+    ids = [key.rsplit('/', 1)[1][:-len('.json')] for key in keys]
+    yaml_vars['env-vars']['date_to_upload'] = '2024/08/01'
+    yaml_vars['bigquery']['load_mode'] = 'batch'
+    yaml_vars['extract'].update(batch_size=10, max_workers=1)
+    # El tercer lote falla al cargarse: el punto de avance se queda en el último objeto del segundo
+    # aunque el cuarto se cargue, para no saltarse el tercero al reanudar
+    bq_client.reject_rows(lambda row: row['id'] == ids[25])
+    run_folders(['Tweet'], yaml_vars, bucket, bq_client, checkpoint=checkpoint, deadline=StepDeadline(10 ** 6))
+    assert checkpoint.get('Tweet/2024/08/01/') == keys[19]
+    assert sorted(raw_ids(bq_client)) == sorted(ids[:20] + ids[30:])
+
+    # La siguiente ejecución reanuda desde ahí, carga el lote que faltaba y termina el prefijo
+    bq_client.reject_rows(lambda row: False)
+    run_folders(['Tweet'], yaml_vars, bucket, bq_client, checkpoint=checkpoint, deadline=StepDeadline(10 ** 6))
+    assert checkpoint.get('Tweet/2024/08/01/') is None
+    assert sorted(raw_ids(bq_client)) == sorted(ids)
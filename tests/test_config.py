@@ -0,0 +1,11 @@
+import pytest
+from etl.utils import check_yaml_vars
+
+def test_arrow_engine_requires_parquet_loads(yaml_vars):
+    yaml_vars['extract']['transform_engine'] = 'arrow'
+    yaml_vars['bigquery']['load_format'] = 'json'
+    with pytest.raises(ValueError, match='parquet'):
+        check_yaml_vars(yaml_vars)
+
+    yaml_vars['bigquery']['load_format'] = 'parquet'
+    assert check_yaml_vars(yaml_vars)['extract']['transform_engine'] == 'arrow'
@@ -0,0 +1,37 @@
+import json
+from etl.events import consume_queue, run_event
+from etl.fakes import LocalBucket, LocalQueue
+from conftest import fill_bucket, raw_ids
+
+def notification(key):
+    return json.dumps({'Records': [{'eventSource': 'aws:s3', 'eventName': 'ObjectCreated:Put',
+                                    's3': {'bucket': {'name': 'bucket'}, 'object': {'key': key}}}]})
+
+def test_message_is_kept_when_its_key_cannot_be_downloaded(yaml_vars, tmp_path, bq_client):
+    queue = LocalQueue(visibility_timeout=30)
+    bucket = LocalBucket(str(tmp_path / 'bucket'))
+    queue.send_message(QueueUrl=queue.url, MessageBody=notification('Tweet/2024/08/01/missing.json'))
+
+    processed = consume_queue(queue, queue.url, yaml_vars, bucket, bq_client, wait_seconds=0)
+
+    assert processed == 0
+    assert len(queue) == 1
+
+def test_event_with_a_missing_key_fails_but_loads_the_rest(yaml_vars, bucket, bq_client):
+    keys = fill_bucket(bucket, records=5)
+
+    failed = run_event({'keys': keys + ['Tweet/2024/08/01/missing.json']}, yaml_vars, bucket, bq_client)
+
+    assert failed == ['Tweet']
+    assert len(raw_ids(bq_client)) == 5
+
+def test_queue_is_emptied_when_every_key_is_loaded(yaml_vars, tmp_path, bq_client):
+    queue = LocalQueue(visibility_timeout=30)
+    bucket = LocalBucket(str(tmp_path / 'bucket'), queue=queue)
+    fill_bucket(bucket, records=12)
+
+    processed = consume_queue(queue, queue.url, yaml_vars, bucket, bq_client, max_messages=5, wait_seconds=0)
+
+    assert processed == 12
+    assert len(queue) == 0
+    assert len(raw_ids(bq_client)) == 12
@@ -0,0 +1,77 @@
+import json
+import time
+from etl.extract import extract, fetch_objects
+from etl.fakes import LocalS3Client
+from etl.state import SQLiteStateStore
+from benchmarks.payloads import sample_tweet
+from conftest import fill_bucket
+
+def test_records_with_wrong_id_or_date_types_are_rejected_not_retried(yaml_vars, bucket, tmp_path):
+    records = {
+        'ok': sample_tweet(0, date='2024-08-01T10:00:00.000Z'),
+        'numeric_date': sample_tweet(1, date=1722506400),
+        'null_date': sample_tweet(2, date=None),
+        'numeric_id': dict(sample_tweet(3, date='2024-08-01T10:00:00.000Z'), id=3),
+        'space_date': sample_tweet(4, date='2024-08-01 10:00:00'),
+    }
+    for name, record in records.items():
+        bucket.put_object(f'Tweet/2024/08/01/{name}.json', json.dumps(record).encode())
+
+    state = SQLiteStateStore(str(tmp_path / 'state.db'))
+    batches = list(extract('2024/08/01', 'Tweet', bucket, state=state))
+    state.commit('Tweet', 'Tweet/2024/08/01/')
+
+    assert [(ids, dates) for _, ids, dates in batches] == [(['tweet-0', 'tweet-4'], ['2024-08-01'])]
+    # Todos los objetos quedan procesados: los registros no válidos no se reintentan en cada ejecución
+    processed = state._conn.execute('SELECT COUNT(*) FROM processed_keys').fetchone()[0]
+    assert processed == len(records)
+
+class JitteryS3Client(LocalS3Client):
+    """
+    Cliente local en el que las primeras keys tardan más en descargarse que las últimas, para que
+    las descargas en paralelo terminen en otro orden.
+    """
+    def get_object(self, Bucket, Key):
+        time.sleep(0.002 * (20 - int(Key.rsplit('-', 1)[1].split('.')[0]) % 20))
+        return super().get_object(Bucket, Key)
+
+def test_concurrent_fetch_keeps_the_listing_order(bucket):
+    keys = fill_bucket(bucket, records=40)
+    bucket.meta.client = JitteryS3Client(bucket.meta.client.root)
+    objs = [{'Key': key} for key in keys]
+
+    fetched = list(fetch_objects(bucket, objs, max_workers=8))
+
+    assert [obj['Key'] for obj, _, _ in fetched] == keys
+    assert all(error is None and json.loads(body)['id'] == obj['Key'].rsplit('/', 1)[1][:-len('.json')]
+               for obj, body, error in fetched)
+
+def test_concurrent_fetch_reports_errors_in_place(bucket):
+    keys = fill_bucket(bucket, records=5)
+    objs = [{'Key': key} for key in keys[:2]] + [{'Key': 'Tweet/2024/08/01/missing.json'}] + [{'Key': key} for key in keys[2:]]
+
+    fetched = list(fetch_objects(bucket, objs, max_workers=3))
+
+    assert [obj['Key'] for obj, _, _ in fetched] == [obj['Key'] for obj in objs]
+    assert [error is not None for _, _, error in fetched] == [False, False, True, False, False, False]
+
+def test_batches_are_bounded_by_record_count(yaml_vars, bucket):
+    fill_bucket(bucket, records=23)
+
+    batches = list(extract('2024/08/01', 'Tweet', bucket, max_workers=4, batch_size=5))
+
+    assert [len(all_data) for all_data, _, _ in batches] == [5, 5, 5, 5, 3]
+    # Cada lote lleva sus ids y sus días, sin arrastrar los del anterior
+    assert all(id_list == [record['id'] for record in all_data] for all_data, id_list, _ in batches)
+    assert all(date_list == ['2024-08-01'] for _, _, date_list in batches)
+
+def test_batches_are_bounded_by_downloaded_bytes(yaml_vars, bucket):
+    keys = fill_bucket(bucket, records=12)
+    size = min(len(bucket.meta.client.get_object(Bucket=bucket.name, Key=key)['Body'].read()) for key in keys)
+    # Con tres objetos cualesquiera ya se llega al límite del lote
+    max_batch_mb = 3 * size / 1024 / 1024
+
+    batches = list(extract('2024/08/01', 'Tweet', bucket, batch_size=1000, max_batch_mb=max_batch_mb))
+
+    assert sum(len(all_data) for all_data, _, _ in batches) == 12
+    assert all(len(all_data) <= 3 for all_data, _, _ in batches)
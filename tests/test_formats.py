@@ -0,0 +1,84 @@
+import gzip
+import io
+import json
+import pytest
+from etl.decoders import get_decoder
+from etl.extract import extract
+from etl import formats
+from etl.formats import iter_stream
+from etl.state import SQLiteStateStore
+from benchmarks.payloads import sample_tweet
+
+def ndjson_bundle(n_records, bad_line):
+    lines = [json.dumps(sample_tweet(i, date='2024-08-01T10:00:00.000Z')).encode() for i in range(n_records)]
+    lines[bad_line] = lines[bad_line][:40]
+    return gzip.compress(b'\n'.join(lines) + b'\n')
+
+@pytest.mark.parametrize('backend', ['json', 'orjson'])
+def test_malformed_ndjson_line_is_skipped(backend):
+    name, loads = get_decoder(backend)
+    if name != backend:
+        pytest.skip(f'{backend} no está instalado')
+    records = [record for _, record in iter_stream(io.BytesIO(ndjson_bundle(10, 5)), 'x.ndjson.gz', loads)]
+    assert [record['id'] for record in records] == [f'tweet-{i}' for i in range(10) if i != 5]
+
+def test_partial_bundle_loads_every_valid_record(yaml_vars, bucket, tmp_path):
+    bucket.put_object('Tweet/2024/08/01/bundle.ndjson.gz', ndjson_bundle(10, 5))
+    state = SQLiteStateStore(str(tmp_path / 'state.db'))
+
+    batches = list(extract('2024/08/01', 'Tweet', bucket, state=state))
+    state.commit('Tweet', 'Tweet/2024/08/01/')
+
+    ids = [record_id for _, id_list, _ in batches for record_id in id_list]
+    assert ids == [f'tweet-{i}' for i in range(10) if i != 5]
+    assert state._conn.execute('SELECT COUNT(*) FROM processed_keys').fetchone()[0] == 1
+
+def test_truncated_json_array_keeps_the_records_before_the_error(yaml_vars, bucket):
+    records = [json.dumps(sample_tweet(i, date='2024-08-01T10:00:00.000Z')) for i in range(3)]
+    body = ('[' + ', '.join(records))[:-20].encode()
+    bucket.put_object('Tweet/2024/08/01/array.json.gz', gzip.compress(body))
+
+    batches = list(extract('2024/08/01', 'Tweet', bucket))
+
+    assert [id_list for _, id_list, _ in batches] == [['tweet-0', 'tweet-1']]
+
+def array_bundle(n_records, bad_element):
+    elements = [json.dumps(sample_tweet(i, date='2024-08-01T10:00:00.000Z')) for i in range(n_records)]
+    elements[bad_element] = '{"id": "tweet-%d", "text": nope, "categories": [{"id": "x"}]}' % bad_element
+    return gzip.compress(('[' + ',\n'.join(elements) + ']').encode())
+
+@pytest.mark.parametrize('backend', ['json', 'orjson'])
+@pytest.mark.parametrize('chunk_size', [64, 1 << 20])
+def test_malformed_array_element_is_skipped(backend, chunk_size):
+    name, loads = get_decoder(backend)
+    if name != backend:
+        pytest.skip(f'{backend} no está instalado')
+    stream = io.BytesIO(array_bundle(10, 5))
+    records = [record for _, record in iter_stream(stream, 'x.json.gz', loads, chunk_size)]
+    assert [record['id'] for record in records] == [f'tweet-{i}' for i in range(10) if i != 5]
+
+def test_array_elements_are_parsed_with_the_configured_backend():
+    parsed = []
+    def loads(body):
+        parsed.append(body)
+        return json.loads(body)
+
+    records = [record for _, record in iter_stream(io.BytesIO(array_bundle(4, 1)), 'x.json.gz', loads, 128)]
+    assert [record['id'] for record in records] == ['tweet-0', 'tweet-2', 'tweet-3']
+    assert len(parsed) == 3
+
+def test_zstd_objects_are_skipped_without_zstandard(yaml_vars, bucket, tmp_path, monkeypatch):
+    monkeypatch.setattr(formats, 'ZSTD_AVAILABLE', False)
+    bucket.put_object('Tweet/2024/08/01/bundle.ndjson.zst', b'no se puede leer sin zstandard')
+    bucket.put_object('Tweet/2024/08/01/bundle.ndjson.gz', ndjson_bundle(3, 0))
+    state = SQLiteStateStore(str(tmp_path / 'state.db'))
+
+    batches = list(extract('2024/08/01', 'Tweet', bucket, state=state))
+    state.commit('Tweet', 'Tweet/2024/08/01/')
+
+    assert [id_list for _, id_list, _ in batches] == [['tweet-1', 'tweet-2']]
+    # No cuenta como error de lectura ni se marca como procesado: se carga al instalar zstandard
+    processed = [row[0] for row in state._conn.execute('SELECT key FROM processed_keys')]
+    assert processed == ['Tweet/2024/08/01/bundle.ndjson.gz']
+    monkeypatch.setattr(formats, 'ZSTD_AVAILABLE', True)
+    assert formats.is_supported('Tweet/2024/08/01/bundle.ndjson.zst')
@@ -0,0 +1,79 @@
+import time
+import pytest
+from benchmarks.payloads import sample_tweet
+from etl.id_index import IdIndex
+from etl.metrics import RunMetrics
+from etl.query import BudgetExceededException, QueryBudget
+from etl.pipeline import run_folder
+from conftest import fill_bucket, raw_ids
+
+def test_days_are_keyed_in_utc(tmp_path, bq_client):
+    # 22:00 en UTC-5 es ya el día siguiente en UTC, que es donde lo reparte BQ
+    late = sample_tweet(1, date='2024-08-01T22:00:00-05:00')
+    early = sample_tweet(2, date='2024-08-02T01:00:00+02:00')
+    bq_client.tables['p.tweet.raw_tweet'] = [late]
+    index = IdIndex(str(tmp_path / 'ids.db'))
+
+    new = index.check_unique([late, early], bq_client, 'id', ['2024-08-02', '2024-08-01'], 'p', 'tweet', 'raw_tweet')
+    assert [record['id'] for record in new] == ['tweet-2']
+
+    index.add('tweet', new)
+    assert index.filter_new('tweet', [early]) == []
+    days = dict(index._conn.execute('SELECT id, day FROM ids').fetchall())
+    assert days == {'tweet-1': '2024-08-02', 'tweet-2': '2024-08-01'}
+
+def test_index_dedups_reruns_without_querying_bq(yaml_vars, bucket, bq_client):
+    fill_bucket(bucket, records=30)
+    yaml_vars['bigquery']['dedup_mode']['Tweet'] = 'index'
+    index = IdIndex(yaml_vars['id_index']['path'])
+
+    run_folder('Tweet', yaml_vars, bucket, bq_client, id_index=index, date_to_upload='2024/08/01')
+    run_folder('Tweet', yaml_vars, bucket, bq_client, id_index=index, date_to_upload='2024/08/01')
+
+    ids = raw_ids(bq_client)
+    assert len(ids) == len(set(ids)) == 30
+    rebuilds = [query for query, _ in bq_client.queries if 'FORMAT_TIMESTAMP' in query]
+    assert len(rebuilds) == 1
+
+def test_cold_index_is_rebuilt_once(tmp_path, bq_client):
+    path = str(tmp_path / 'ids.db')
+    first = IdIndex(path)
+    first.rebuild('tweet', ['2024-08-01'], bq_client, 'p.tweet.raw_tweet')
+    assert first.stale_days('tweet', ['2024-08-01']) == []
+
+    # Otro proceso ha cargado un id después de que se construyera el índice
+    bq_client.tables['p.tweet.raw_tweet'] = [sample_tweet(7, date='2024-08-01T10:00:00.000Z')]
+    time.sleep(0.01)
+    second = IdIndex(path)
+    assert second.stale_days('tweet', ['2024-08-01']) == ['2024-08-01']
+
+    new = second.check_unique([sample_tweet(7, date='2024-08-01T10:00:00.000Z')], bq_client, 'id', ['2024-08-01'],
+                              'p', 'tweet', 'raw_tweet')
+    assert new == []
+    assert second.stale_days('tweet', ['2024-08-01']) == []
+
+def test_bloom_filter_has_no_false_negatives(tmp_path):
+    index = IdIndex(str(tmp_path / 'ids.db'))
+    records = [sample_tweet(i, date='2024-08-01T10:00:00.000Z') for i in range(2000)]
+    index.add('tweet', records[:1000])
+
+    new = index.filter_new('tweet', records)
+    assert [record['id'] for record in new] == [record['id'] for record in records[1000:]]
+
+def test_rebuild_over_budget_is_refused(tmp_path, bq_client):
+    bq_client.tables['p.tweet.raw_tweet'] = [sample_tweet(i, date='2024-08-01T10:00:00.000Z') for i in range(50)]
+    index = IdIndex(str(tmp_path / 'ids.db'))
+    metrics = RunMetrics('test')
+    batch = [sample_tweet(i, date='2024-08-01T10:00:00.000Z') for i in range(40, 60)]
+
+    with pytest.raises(BudgetExceededException):
+        index.check_unique(batch, bq_client, 'id', ['2024-08-01'], 'p', 'tweet', 'raw_tweet', metrics, QueryBudget(100))
+
+    # Sólo se ha lanzado el dry run y el índice sigue sin ese día
+    assert len(bq_client.dry_runs) == 1 and bq_client.queries == []
+    assert index.stale_days('tweet', ['2024-08-01']) == ['2024-08-01']
+    stages = metrics.summary()['stages']
+    assert stages['query_refused']['items'] == 1
+
+    new = index.check_unique(batch, bq_client, 'id', ['2024-08-01'], 'p', 'tweet', 'raw_tweet', metrics, QueryBudget(10 ** 9))
+    assert [record['id'] for record in new] == [f'tweet-{i}' for i in range(50, 60)]
@@ -0,0 +1,62 @@
+import pytest
+from etl.listing import list_objects, list_objects_parallel
+
+def count_pages(bucket):
+    """
+    Cuenta las páginas (peticiones) de list_objects_v2 que se hacen al bucket.
+    """
+    client = bucket.meta.client
+    get_paginator = client.get_paginator
+    counter = {'pages': 0}
+
+    class Paginator:
+        def paginate(self, **kwargs):
+            for page in get_paginator('list_objects_v2').paginate(**kwargs):
+                counter['pages'] += 1
+                yield page
+
+    client.get_paginator = lambda operation_name: Paginator()
+    return counter
+
+@pytest.fixture
+def irregular_bucket(bucket):
+    # Días con objetos, un mes con objetos sueltos y sin días, y un objeto suelto en la carpeta
+    for day in ('01', '02', '15'):
+        for i in range(30):
+            bucket.put_object(f'Tweet/2024/08/{day}/{i:04d}.json', b'{}')
+    for i in range(20):
+        bucket.put_object(f'Tweet/2024/09/{i:04d}.json', b'{}')
+    bucket.put_object('Tweet/loose.json', b'{}')
+    return bucket
+
+@pytest.mark.parametrize('start_after', [None, 'Tweet/2024/08/02/', 'Tweet/2024/08/02/0010.json', 'Tweet/2024/09/0005.json'])
+def test_parallel_listing_matches_single_listing(irregular_bucket, start_after):
+    expected = [obj['Key'] for obj in list_objects(irregular_bucket, 'Tweet/', start_after)]
+    keys = [obj['Key'] for obj in list_objects_parallel(irregular_bucket, 'Tweet/', 3, start_after)]
+    assert keys == expected
+
+def test_leaf_prefix_is_listed_once(bucket):
+    for i in range(2500):
+        bucket.put_object(f'Tweet/2024/08/01/{i:05d}.json', b'{}')
+    counter = count_pages(bucket)
+
+    keys = list(list_objects_parallel(bucket, 'Tweet/2024/08/01/', 8))
+
+    assert len(keys) == 2500
+    assert counter['pages'] == 3
+
+def test_sub_prefixes_are_streamed_page_by_page(bucket):
+    for day in ('01', '02'):
+        for i in range(2500):
+            bucket.put_object(f'Tweet/2024/08/{day}/{i:05d}.json', b'{}')
+    counter = count_pages(bucket)
+
+    listing = list_objects_parallel(bucket, 'Tweet/', 1)
+    first = next(listing)
+    # Con un solo hilo hay como mucho 2 páginas pedidas por delante de la que se está consumiendo
+    pages_when_started = counter['pages']
+    rest = list(listing)
+
+    assert first['Key'] == 'Tweet/2024/08/01/00000.json' and len(rest) == 4999
+    assert pages_when_started <= 3 + 3
+    assert counter['pages'] == 3 + 6
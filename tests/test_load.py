@@ -0,0 +1,112 @@
+import json
+import pytest
+from datetime import datetime, timezone
+from google.api_core.exceptions import BadRequest, ServiceUnavailable
+from google.cloud import bigquery
+from benchmarks.payloads import sample_tweet
+from etl.fakes import FakeJob
+from etl.load import isolate_bad_rows, load_rows, merge_raw_data, upload_raw_data
+from etl.pipeline import run_folder
+from etl.sources import get_source
+from conftest import fill_bucket, raw_ids
+
+RAW = 'p.tweet.raw_tweet'
+
+@pytest.mark.parametrize('load_format', ['json', 'parquet'])
+def test_merge_inserts_only_new_ids(yaml_vars, bq_client, load_format):
+    source = get_source('tweet')
+    first = [source.clean(sample_tweet(i)) for i in range(10)]
+    # El lote repite ids dentro de sí mismo y con los que ya están en la tabla raw
+    second = [source.clean(sample_tweet(i)) for i in range(5, 15)]
+    assert merge_raw_data(first + first[:2], 'p', 'tweet', 'raw_tweet', bq_client, 'id', ['2024-08-08'], load_format)
+    assert merge_raw_data(second, 'p', 'tweet', 'raw_tweet', bq_client, 'id', ['2024-08-08'], load_format)
+
+    ids = raw_ids(bq_client)
+    assert sorted(ids) == sorted(f'tweet-{i}' for i in range(15))
+    # Las tablas de staging se borran al terminar
+    assert [table for table in bq_client.tables if '_staging_' in table] == []
+
+def test_merge_mode_reruns_do_not_duplicate(yaml_vars, bucket, bq_client):
+    fill_bucket(bucket, records=30, start_date='2024/08/01')
+    yaml_vars['env-vars']['date_to_upload'] = '2024/08/01'
+    yaml_vars['bigquery']['dedup_mode']['Tweet'] = 'merge'
+    run_folder('Tweet', yaml_vars, bucket, bq_client)
+    # La segunda ejecución vuelve a leer los mismos objetos: el MERGE no inserta ninguno
+    run_folder('Tweet', yaml_vars, bucket, bq_client)
+
+    ids = raw_ids(bq_client)
+    assert len(ids) == len(set(ids)) == 30
+    merges = [query for query, _ in bq_client.queries if '_staging_' in query]
+    assert len(merges) >= 2
+
+def test_parquet_load_keeps_types_and_nested_fields(yaml_vars, bq_client):
+    source = get_source('tweet')
+    data = [source.clean(sample_tweet(i, date='2024-08-01T10:15:00.000Z')) for i in range(4)]
+
+    assert upload_raw_data(data, 'p', 'tweet', 'raw_tweet', bq_client, 'parquet', 'zstd')
+
+    (table_id, n_rows, job_config), = bq_client.loads
+    assert (table_id, n_rows, job_config.source_format) == ('p.tweet.raw_tweet', 4, 'PARQUET')
+    rows = bq_client.tables['p.tweet.raw_tweet']
+    assert [row['id'] for row in rows] == [f'tweet-{i}' for i in range(4)]
+    # Los TIMESTAMP llegan como tales y los campos anidados y repetidos se conservan
+    assert rows[0]['date'] == datetime(2024, 8, 1, 10, 15, tzinfo=timezone.utc)
+    assert rows[1]['categories'] == data[1]['categories']
+    assert rows[2]['user']['location']['country'] == 'Portugal'
+
+def test_parquet_conversion_error_falls_back_to_json(yaml_vars, bq_client):
+    source = get_source('tweet')
+    data = [source.clean(sample_tweet(i)) for i in range(2)]
+    data[1]['user']['followers'] = 'muchos'
+
+    assert upload_raw_data(data, 'p', 'tweet', 'raw_tweet', bq_client, 'parquet')
+
+    # load_table_from_json, con el esquema de la tabla
+    (_, _, job_config), = bq_client.loads
+    assert job_config.source_format != 'PARQUET' and job_config.schema == source.schema
+    assert len(bq_client.tables['p.tweet.raw_tweet']) == 2
+
+def test_bad_rows_are_isolated_and_quarantined(yaml_vars, bq_client, tmp_path):
+    source = get_source('tweet')
+    data = [source.clean(sample_tweet(i)) for i in range(16)]
+    bq_client.reject_rows(lambda row: row['id'] in ('tweet-3', 'tweet-11'))
+    quarantine = tmp_path / 'quarantine.ndjson'
+
+    loaded = load_rows(data, bigquery.TableReference.from_string(RAW), source.schema, bq_client,
+                       quarantine_path=str(quarantine))
+
+    assert sorted(record['id'] for record in loaded) == sorted(f'tweet-{i}' for i in range(16) if i not in (3, 11))
+    assert sorted(raw_ids(bq_client)) == sorted(record['id'] for record in loaded)
+    assert sorted(json.loads(line)['row']['id'] for line in quarantine.read_text().splitlines()) == ['tweet-11', 'tweet-3']
+
+@pytest.mark.parametrize('error', [ServiceUnavailable('Backend error'),
+                                   BadRequest('Provided Schema does not match Table p.tweet.raw_tweet')])
+def test_batch_wide_failure_is_not_bisected(yaml_vars, bq_client, tmp_path, monkeypatch, error):
+    source = get_source('tweet')
+    data = [source.clean(sample_tweet(i)) for i in range(16)]
+    loads = []
+    def failing_load(json_rows, destination, job_config=None):
+        loads.append(destination)
+        return FakeJob('load', error=error)
+    monkeypatch.setattr(bq_client, 'load_table_from_json', failing_load)
+    quarantine = tmp_path / 'quarantine.ndjson'
+
+    with pytest.raises(type(error)):
+        load_rows(data, bigquery.TableReference.from_string(RAW), source.schema, bq_client,
+                  quarantine_path=str(quarantine))
+    assert len(loads) == 1
+    assert not quarantine.exists()
+
+def test_bisection_stops_when_both_halves_fail_the_same_way(yaml_vars, bq_client, monkeypatch):
+    source = get_source('tweet')
+    data = [source.clean(sample_tweet(i)) for i in range(16)]
+    loads = []
+    def failing_load(json_rows, destination, job_config=None):
+        loads.append(destination)
+        return FakeJob('load', error=ServiceUnavailable('Backend error'))
+    monkeypatch.setattr(bq_client, 'load_table_from_json', failing_load)
+
+    with pytest.raises(ServiceUnavailable):
+        isolate_bad_rows(data, bigquery.TableReference.from_string(RAW), source.schema, bq_client)
+    assert len(loads) == 1
+    assert not any('_probe_' in table_id for table_id in bq_client.tables)
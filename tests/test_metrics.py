@@ -0,0 +1,51 @@
+import json
+import threading
+from etl.metrics import RunMetrics
+from etl.pipeline import run_folder, run_folders
+from conftest import fill_bucket
+
+def test_run_records_every_stage(yaml_vars, bucket, bq_client):
+    fill_bucket(bucket, records=25)
+    yaml_vars['extract']['batch_size'] = 10
+    metrics = RunMetrics('Tweet')
+
+    run_folder('Tweet', yaml_vars, bucket, bq_client, metrics=metrics, date_to_upload='2024/08/01')
+
+    stages = metrics.summary()['stages']
+    assert stages['listing']['items'] == 25
+    assert (stages['get']['calls'], stages['get']['items']) == (25, 25)
+    assert stages['get']['bytes'] == stages['parse']['bytes'] > 0
+    assert stages['parse']['items'] == stages['validate']['items'] == stages['clean']['items'] == 25
+    # Un job de deduplicado y otro de carga por lote
+    assert (stages['dedup_query']['calls'], stages['dedup_query']['items']) == (3, 25)
+    assert (stages['load_job']['calls'], stages['load_job']['items']) == (3, 25)
+    assert stages['aggregate:daily_cat_tweet,daily_country_tweet,daily_sentiment_tweet']['calls'] == 1
+
+def test_metrics_are_thread_safe_and_merge():
+    metrics = RunMetrics('Tweet')
+    def add():
+        for _ in range(1000):
+            metrics.add('get', 0.001, 1, 10)
+    threads = [threading.Thread(target=add) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    run_metrics = RunMetrics('run')
+    run_metrics.merge(metrics)
+    run_metrics.merge(metrics)
+    stats = run_metrics.summary()['stages']['get']
+    assert (stats['calls'], stats['items'], stats['bytes']) == (16000, 16000, 160000)
+    assert stats['items_per_second'] == round(16000 / stats['seconds'], 1)
+
+def test_run_logs_one_json_line_per_unit_and_run(yaml_vars, bucket, bq_client, capsys):
+    fill_bucket(bucket, records=10, days=2)
+    yaml_vars['env-vars']['date_to_upload'] = '2024/08/01..2024/08/02'
+
+    run_metrics = run_folders(['Tweet'], yaml_vars, bucket, bq_client)
+
+    lines = [json.loads(line) for line in capsys.readouterr().out.splitlines() if line.startswith('{"metrics"')]
+    assert [line['scope'] for line in lines] == ['Tweet 2024/08/01', 'Tweet 2024/08/02', 'Tweet agregados', 'run']
+    assert lines[-1] == {**run_metrics.summary(), 'wall_seconds': lines[-1]['wall_seconds']}
+    assert lines[-1]['stages']['get']['items'] == 10
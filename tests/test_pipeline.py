@@ -0,0 +1,130 @@
+import threading
+import time
+import pytest
+from etl.aggregate import AggregateDeltas, get_aggregates
+from etl.fakes import LocalS3Client
+from etl.id_index import IdIndex
+from etl.pipeline import run_folder, run_folders
+from etl.query import BudgetExceededException, QueryBudget
+from etl.utils import get_pool_sizes
+from conftest import fill_bucket, raw_ids
+
+def aggregate_scripts(bq_client):
+    return [query for query, _ in bq_client.queries if 'CREATE TEMP TABLE daily_counts' in query]
+
+def test_multi_day_run_refreshes_each_folder_once(yaml_vars, bucket, bq_client):
+    fill_bucket(bucket, records=40, start_date='2024/08/01', days=4)
+    yaml_vars['env-vars']['date_to_upload'] = '2024/08/01..2024/08/04'
+
+    run_folders(['Tweet'], yaml_vars, bucket, bq_client)
+
+    assert len(raw_ids(bq_client)) == 40
+    scripts = aggregate_scripts(bq_client)
+    assert len(scripts) == 1
+    assert all(f'"2024-08-0{day}"' in scripts[0] for day in range(1, 5))
+
+def test_backfill_shard_does_not_refresh(yaml_vars, bucket, bq_client):
+    fill_bucket(bucket, records=10, start_date='2024/08/01')
+    yaml_vars['env-vars']['date_to_upload'] = '2024/08/01'
+
+    run_folders(['Tweet'], yaml_vars, bucket, bq_client, refresh=False)
+
+    assert len(raw_ids(bq_client)) == 10
+    assert aggregate_scripts(bq_client) == []
+
+def test_budget_overrun_still_refreshes_loaded_batches(yaml_vars, bucket, bq_client):
+    fill_bucket(bucket, records=100, start_date='2024/08/01')
+    yaml_vars['extract'].update(batch_size=50, max_workers=1)
+    # La consulta de ids del primer lote cabe y la del segundo no; las tablas agregadas sí caben
+    dedup_estimates = []
+    def estimate(query):
+        if 'GROUPING SETS' in query:
+            return 0
+        dedup_estimates.append(query)
+        return 0 if len(dedup_estimates) == 1 else 10 ** 12
+
+    bq_client.estimate = estimate
+    with pytest.raises(BudgetExceededException):
+        run_folder('Tweet', yaml_vars, bucket, bq_client, date_to_upload='2024/08/01', budget=QueryBudget(10 ** 9))
+
+    assert len(raw_ids(bq_client)) == 50
+    scripts = aggregate_scripts(bq_client)
+    assert len(scripts) == 1 and '"2024-08-01"' in scripts[0]
+
+class FolderTrackingS3Client(LocalS3Client):
+    """
+    Cliente local que apunta cuántas fuentes distintas están descargando objetos a la vez.
+    """
+    def __init__(self, root):
+        super().__init__(root)
+        self.active = {}
+        self.max_sources = 0
+        self._lock = threading.Lock()
+
+    def get_object(self, Bucket, Key):
+        folder = Key.split('/', 1)[0]
+        with self._lock:
+            self.active[folder] = self.active.get(folder, 0) + 1
+            self.max_sources = max(self.max_sources, sum(1 for n in self.active.values() if n))
+        try:
+            time.sleep(0.005)
+            return super().get_object(Bucket, Key)
+        finally:
+            with self._lock:
+                self.active[folder] -= 1
+
+@pytest.mark.parametrize('parallel_sources', [1, 2])
+def test_sources_run_in_parallel_up_to_the_limit(yaml_vars, bucket, bq_client, parallel_sources):
+    fill_bucket(bucket, records=20)
+    fill_bucket(bucket, 'YoutubeComment', records=20)
+    bucket.meta.client = FolderTrackingS3Client(bucket.meta.client.root)
+    yaml_vars['env-vars']['date_to_upload'] = '2024/08/01'
+    yaml_vars['run']['parallel_sources'] = parallel_sources
+
+    run_folders(['Tweet', 'YoutubeComment'], yaml_vars, bucket, bq_client)
+
+    assert bucket.meta.client.max_sources == parallel_sources
+    assert len(raw_ids(bq_client)) == 20
+    assert len(raw_ids(bq_client, 'p.youtubecomment.raw_youtube_comment')) == 20
+
+def test_a_failing_source_does_not_stop_the_others(yaml_vars, bucket, bq_client):
+    fill_bucket(bucket, records=10)
+    fill_bucket(bucket, 'YoutubeComment', records=10)
+    yaml_vars['env-vars']['date_to_upload'] = '2024/08/01'
+    yaml_vars['bigquery']['load_mode'] = 'batch'
+    bq_client.reject_rows(lambda row: row['id'].startswith('tweet-'))
+
+    run_folders(['Tweet', 'YoutubeComment'], yaml_vars, bucket, bq_client)
+
+    assert raw_ids(bq_client) == []
+    assert len(raw_ids(bq_client, 'p.youtubecomment.raw_youtube_comment')) == 10
+
+def test_pool_sizes_cover_every_parallel_unit(yaml_vars):
+    yaml_vars['extract'].update(max_workers=8, list_workers=4)
+    yaml_vars['run'].update(parallel_sources=2, parallel_days=3)
+
+    assert get_pool_sizes(yaml_vars) == ((8 + 4) * 2 * 3, 12)
+
+def test_deltas_match_a_full_refresh_after_an_overlapping_rerun(yaml_vars, bucket, bq_client, tmp_path):
+    fill_bucket(bucket, records=60, start_date='2024/08/01', days=3)
+    yaml_vars['bigquery']['aggregation_mode'] = 'delta'
+    yaml_vars['bigquery']['dedup_mode']['Tweet'] = 'index'
+    # Otra instancia, con su propio índice, ha leído los días antes de que la primera cargue nada
+    other_index = IdIndex(str(tmp_path / 'other_ids.db'))
+    other_index.rebuild('tweet', ['2024-08-01', '2024-08-02', '2024-08-03'], bq_client, 'p.tweet.raw_tweet')
+
+    yaml_vars['env-vars']['date_to_upload'] = '2024/08/01..2024/08/02'
+    run_folders(['Tweet'], yaml_vars, bucket, bq_client, id_index=IdIndex(str(tmp_path / 'ids.db')))
+    yaml_vars['env-vars']['date_to_upload'] = '2024/08/02..2024/08/03'
+    run_folders(['Tweet'], yaml_vars, bucket, bq_client, id_index=other_index)
+
+    # Lo que daría recalcular las tablas enteras: ids distintos por día y dimensión de la raw
+    expected = AggregateDeltas('p', 'tweet').count(bq_client.tables['p.tweet.raw_tweet'])
+    assert aggregate_scripts(bq_client) == []
+    # Un MERGE por tabla y ejecución, cuando han terminado todos los días
+    merges = [query for query, _ in bq_client.queries if 'UNNEST(@deltas)' in query]
+    assert len(merges) == 2 * len(get_aggregates('p', 'tweet'))
+    for aggregate in get_aggregates('p', 'tweet'):
+        dimension = aggregate['dimension']
+        rows = {(str(row['date']), row[dimension]): row['count'] for row in bq_client.tables[aggregate['table']]}
+        assert rows == expected[aggregate['table']]
@@ -0,0 +1,68 @@
+from etl.pipeline import run_folder, run_folders
+from etl.query import QueryBudget
+from etl.state import BigQueryStateStore, SQLiteStateStore
+from benchmarks.payloads import sample_tweet, encode
+from conftest import fill_bucket, raw_ids
+
+def test_day_run_does_not_skip_earlier_days_in_all_run(yaml_vars, bucket, bq_client, tmp_path):
+    fill_bucket(bucket, records=300, start_date='2024/08/01', days=3)
+    state = SQLiteStateStore(str(tmp_path / 'state.db'))
+
+    run_folder('Tweet', yaml_vars, bucket, bq_client, state, date_to_upload='2024/08/03')
+    rows = bq_client.tables['p.tweet.raw_tweet']
+    assert rows and all(row['date'].startswith('2024-08-03') for row in rows)
+
+    # Un estado nuevo sobre el mismo fichero, como en la siguiente ejecución
+    state = SQLiteStateStore(str(tmp_path / 'state.db'))
+    assert state.get_start_after('Tweet', 'Tweet/') is None
+    run_folder('Tweet', yaml_vars, bucket, bq_client, state, date_to_upload='all')
+
+    ids = raw_ids(bq_client)
+    assert len(ids) == len(set(ids)) == 300
+
+def test_all_run_resumes_from_its_own_watermark(yaml_vars, bucket, bq_client, tmp_path):
+    fill_bucket(bucket, records=60, start_date='2024/08/01', days=3)
+    state = SQLiteStateStore(str(tmp_path / 'state.db'))
+    run_folder('Tweet', yaml_vars, bucket, bq_client, state, date_to_upload='all')
+    assert len(raw_ids(bq_client)) == 60
+
+    state = SQLiteStateStore(str(tmp_path / 'state.db'))
+    assert state.get_start_after('Tweet', 'Tweet/') == 'Tweet/2024/08/03/'
+    # Los objetos nuevos del último día se cargan; los ya procesados no se vuelven a descargar
+    for i in range(1000, 1005):
+        bucket.put_object(f'Tweet/2024/08/03/tweet-{i}.json', encode(sample_tweet(i, date='2024-08-03T10:00:00.000Z')))
+    run_folder('Tweet', yaml_vars, bucket, bq_client, state, date_to_upload='all')
+    assert len(raw_ids(bq_client)) == 65
+
+def test_known_keys_are_loaded_per_prefix_and_upserted(bucket, tmp_path):
+    keys = fill_bucket(bucket, records=20, start_date='2024/08/01', days=2)
+    client = bucket.meta.client
+    objs = [client._summary(key) for key in keys]
+
+    state = SQLiteStateStore(str(tmp_path / 'state.db'))
+    for prefix in ('Tweet/2024/08/01/', 'Tweet/2024/08/02/'):
+        state.begin('Tweet', prefix)
+        for obj in objs:
+            if obj['Key'].startswith(prefix):
+                state.stage('Tweet', obj, prefix)
+        state.commit('Tweet', prefix)
+    # Reprocesar un objeto no lo repite
+    state.begin('Tweet', 'Tweet/2024/08/01/')
+    state.stage('Tweet', objs[0], objs[0]['Key'].rsplit('/', 1)[0] + '/')
+    state.commit('Tweet', objs[0]['Key'].rsplit('/', 1)[0] + '/')
+
+    rows = state._conn.execute('SELECT COUNT(*), COUNT(DISTINCT key) FROM processed_keys').fetchone()
+    assert rows == (20, 20)
+    known = state._load_known('Tweet', 'Tweet/2024/08/02/', 'Tweet/2024/08/02/')
+    assert known and all(key.startswith('Tweet/2024/08/02/') for key in known)
+
+def test_bigquery_state_queries_go_through_the_budget(yaml_vars, bucket, bq_client):
+    fill_bucket(bucket, records=5, start_date='2024/08/01')
+    yaml_vars['env-vars']['date_to_upload'] = '2024/08/01'
+    state = BigQueryStateStore(bq_client, 'p', 'etl_state')
+
+    metrics = run_folders(['Tweet'], yaml_vars, bucket, bq_client, state, budget=QueryBudget(10 ** 9))
+
+    state_queries = [query for query, _ in bq_client.queries if 'etl_state' in query]
+    assert state_queries and all(query in bq_client.dry_runs for query in state_queries)
+    assert metrics.summary()['stages']['state_query']['calls'] == len(state_queries)
@@ -0,0 +1,47 @@
+import copy
+from datetime import datetime, timezone
+import pyarrow as pa
+import pytest
+from benchmarks.payloads import sample_tweet, sample_yt_comment
+from etl.columnar import clean_table, records_to_arrow, schema_to_arrow
+from etl.sources import get_source
+
+def test_clean_record_fills_defaults_and_strips_brackets(yaml_vars):
+    record = sample_tweet(1)
+    del record['media'], record['parentId']
+
+    cleaned = get_source('tweet').clean_record(record)
+
+    assert cleaned['media'] is None and cleaned['parentId'] is None
+    assert [category['name'] for category in cleaned['categories']] == ['Categoría 1', 'Categoría 1']
+    assert cleaned['id'] == 'tweet-1' and cleaned['user'] == sample_tweet(1)['user']
+
+def test_clean_records_matches_clean_record(yaml_vars):
+    source = get_source('youtubecomment')
+    records = [sample_yt_comment(i) for i in range(5)]
+
+    assert source.clean_records([dict(r, categories=[dict(c) for c in r['categories']]) for r in records]) == \
+           [source.clean_record(record) for record in records]
+
+def reference_table(source, records):
+    # Limpieza registro a registro y fechas parseadas en python (sin zona -> UTC, como BQ)
+    cleaned = [source.clean_record(copy.deepcopy(record)) for record in records]
+    for record in cleaned:
+        date = datetime.fromisoformat(record['date'])
+        record['date'] = date.replace(tzinfo=timezone.utc) if date.tzinfo is None else date.astimezone(timezone.utc)
+    return pa.Table.from_pylist(cleaned, schema=schema_to_arrow(source.schema))
+
+@pytest.mark.parametrize('folder, sample', [('tweet', sample_tweet), ('youtubecomment', sample_yt_comment)])
+def test_arrow_engine_matches_the_reference(yaml_vars, folder, sample):
+    source = get_source(folder)
+    dates = ['2024-08-01T10:15:00.000Z', '2024-08-01T22:00:00-05:00', '2024-08-01T10:15:00',
+             '2024-08-01 23:59:59.123456', '2024-08-02T01:00:00+02:00']
+    records = [sample(i, date=dates[i % len(dates)]) for i in range(20)]
+    for record in records[::3]:
+        for column in source.defaults:
+            del record[column]
+
+    arrow = clean_table(records_to_arrow(copy.deepcopy(records), source.schema), source.strip_brackets)
+
+    assert arrow.schema == schema_to_arrow(source.schema)
+    assert arrow.to_pylist() == reference_table(source, records).to_pylist()
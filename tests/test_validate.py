@@ -0,0 +1,20 @@
+import copy
+import json
+from etl.sources import load_sources
+from etl.validate import get_validator
+from benchmarks.payloads import sample_tweet
+
+def test_validator_follows_reloaded_sources(yaml_vars, tmp_path):
+    record = sample_tweet(0)
+    assert get_validator('tweet')(record) is True
+
+    # Mismo dataset con un esquema sin la columna link
+    with open(yaml_vars['sources']['Tweet']['schema']) as f:
+        schema = [field for field in json.load(f) if field['name'] != 'link']
+    schema_path = tmp_path / 'schema_tweet.json'
+    schema_path.write_text(json.dumps(schema))
+    reloaded = copy.deepcopy(yaml_vars)
+    reloaded['sources']['Tweet']['schema'] = str(schema_path)
+    load_sources(reloaded)
+
+    assert 'link' in get_validator('tweet')(record)